@@ -0,0 +1,46 @@
+"""
+Measures the time to build a GmailResource object and
+to access the methods used by this library.
+
+Run `python -m benchmarks.bench_build` at the root of the repository.
+"""
+
+import argparse
+import tempfile
+import timeit
+import typing as t
+
+from google.oauth2 import credentials
+from googleapiclient import discovery
+
+from labmail import cache, gmail_api
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=100)
+    args = parser.parse_args()
+
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+
+    def use(rsc: t.Any) -> None:
+        rsc.users().messages().send
+        rsc.users().settings().sendAs().list
+
+    def build_default() -> None:
+        use(discovery.build(serviceName="gmail", version="v1", credentials=creds))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        discovery_cache = cache.DiscoveryCache(cache_dir)
+        discovery_cache.load()
+
+        def build_cached() -> None:
+            use(gmail_api.build(creds, document=discovery_cache.load()))
+
+        for name, func in [("default", build_default), ("cached", build_cached)]:
+            elapsed = timeit.timeit(func, number=args.number) / args.number
+            print(f"{name:>8}: {elapsed * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Measures the import time of the command line interface and checks it
+against the budget.
+
+Run `python -m benchmarks.bench_import` at the root of the repository.
+It exits with status 1 if the import time exceeds the budget.
+"""
+
+import argparse
+import subprocess
+import sys
+
+MODULE = "labmail.__main__"
+BUDGET_MS = 100.0
+
+
+def measure_import_time(module: str) -> float:
+    """Returns the cumulative import time of the module in milliseconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1000
+    raise RuntimeError(f"The import time of {module} is not found")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=BUDGET_MS)
+    args = parser.parse_args()
+
+    elapsed = min(measure_import_time(MODULE) for _ in range(args.number))
+    print(f"{MODULE}: {elapsed:.1f} ms (budget: {args.budget:.1f} ms)")
+    if elapsed > args.budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
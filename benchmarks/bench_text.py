@@ -0,0 +1,58 @@
+"""
+Measures the time to convert texts to HTML with `convert_text_to_html()`
+and `HTMLConverter`.
+
+Run `python -m benchmarks.bench_text` at the root of the repository.
+"""
+
+import argparse
+import timeit
+
+from labmail import text_utils
+
+MARKDOWN_TEXT = """\
+# Weekly report
+
+Hello, **everyone**.
+
+- Item 1
+- Item 2
+  - [Link](https://example.com)
+
+```python
+print("Hello")
+```
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=1000)
+    args = parser.parse_args()
+
+    texts = [f"{MARKDOWN_TEXT}\n{i}\n" for i in range(args.number)]
+    text_type = text_utils.TextType.MARKDOWN
+
+    def convert_function(texts: list[str]) -> None:
+        for text in texts:
+            text_utils.convert_text_to_html(text, text_type)
+
+    def convert_converter(texts: list[str]) -> None:
+        converter = text_utils.HTMLConverter()
+        for text in texts:
+            converter.convert(text, text_type)
+
+    for case, case_texts in [
+        ("unique", texts),
+        ("same", [MARKDOWN_TEXT] * args.number),
+    ]:
+        for name, func in [
+            ("function", convert_function),
+            ("converter", convert_converter),
+        ]:
+            elapsed = timeit.timeit(lambda: func(case_texts), number=1) / args.number
+            print(f"{case:>6} {name:>9}: {elapsed * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
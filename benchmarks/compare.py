@@ -0,0 +1,59 @@
+"""
+Compares two result files of `python -m benchmarks.suite`
+and shows the ratio of the minimum time of each case.
+
+Run `python -m benchmarks.compare BASE HEAD` at the root of the repository,
+e.g. with `benchmarks/results/baseline.json` as BASE.
+It exits with status 1 if any case is slower than the threshold.
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import typing as t
+
+
+def load_results(filepath: pathlib.Path) -> dict[str, dict[str, t.Any]]:
+    """Loads the results keyed by the names and the parameters of the cases."""
+    with filepath.open() as f:
+        data = json.load(f)
+    results = dict()
+    for result in data["results"]:
+        params = ",".join(f"{key}={value}" for key, value in result["params"].items())
+        results[f"{result['name']}[{params}]"] = result
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base", type=pathlib.Path)
+    parser.add_argument("head", type=pathlib.Path)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="ratio of head to base regarded as a regression (default: 1.2)",
+    )
+    args = parser.parse_args()
+
+    base = load_results(args.base)
+    head = load_results(args.head)
+    regressions = 0
+    for key, result in head.items():
+        if key not in base:
+            print(f"{key:<50} {result['min'] * 1000:>10.3f} ms          (new)")
+            continue
+        ratio = result["min"] / base[key]["min"]
+        mark = ""
+        if ratio > args.threshold:
+            mark = "  (slower)"
+            regressions += 1
+        print(f"{key:<50} {result['min'] * 1000:>10.3f} ms {ratio:>8.2f}x{mark}")
+    if regressions:
+        print(f"{regressions} cases are slower than {args.threshold}x", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Runs the benchmarks of the send pipeline end to end and writes the results
+to a JSON file, so that they can be compared between releases
+with `python -m benchmarks.compare`.
+The results of a local run are written to `benchmarks/results/<version>.json`,
+which is ignored by git, while `benchmarks/results/baseline.json` is committed
+as the baseline to compare with.
+
+The cases are:
+
+- text.convert: `text_utils.convert_text_to_html()` by the body size and type
+- mime.build_encode: `Session.build_message()` and `gmail_api.encode_message()`
+- mime.write_attachment: `mime.write_message()` of a message with an attachment
+- gmail_api.send_message: `gmail_api.send_message()` to the fake server
+- gmail_api.find_subjects: `gmail_api.find_subjects()` of the subjects
+  half of which have been used, on the fake server
+- gmail_api.build: `gmail_api.build()` without (cold) and with (warm)
+  the cached discovery document
+- send: `labmail.send()` to the fake server by the injected latency
+
+The requests are sent to `labmail.testing.FakeGmailServer` on localhost.
+
+Run `python -m benchmarks.suite` at the root of the repository.
+"""
+
+import argparse
+import dataclasses
+import datetime
+import email.mime.multipart as mime_multipart
+import email.mime.text as mime_text
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+import typing as t
+from collections import abc
+from unittest import mock
+
+from google.oauth2 import credentials
+from googleapiclient import version as googleapiclient_version
+
+import labmail
+from benchmarks.bench_text import MARKDOWN_TEXT
+from labmail import _env, cache, gmail_api, mime, session, testing, text_utils, timing
+
+SIZES = [1024, 16 * 1024, 256 * 1024]
+"""The sizes of the bodies in bytes."""
+
+ATTACHMENT_SIZE = 4 * 1024 * 1024
+"""The size of the attachment in bytes."""
+
+SUBJECT_COUNT = 200
+"""The number of the subjects to find."""
+
+
+@dataclasses.dataclass
+class Result:
+    """
+    The result of a benchmark case.
+
+    Attributes
+    ----------
+    name : str
+        The name of the case.
+    params : dict[str, typing.Any]
+        The parameters of the case.
+    number : int
+        The number of the calls per repeat.
+    times : list[float]
+        The mean seconds per call of each repeat.
+    phases : dict[str, float]
+        The mean seconds per call of each phase recorded by `labmail.timing`.
+    """
+
+    name: str
+    params: dict[str, t.Any]
+    number: int
+    times: list[float]
+    phases: dict[str, float] = dataclasses.field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        """The key to identify the case across the result files."""
+        params = ",".join(f"{key}={value}" for key, value in self.params.items())
+        return f"{self.name}[{params}]"
+
+    def to_dict(self) -> dict[str, t.Any]:
+        """Converts the result into a JSON object with the statistics."""
+        return {
+            "name": self.name,
+            "params": self.params,
+            "unit": "s",
+            "number": self.number,
+            "repeat": len(self.times),
+            "min": min(self.times),
+            "median": statistics.median(self.times),
+            "mean": statistics.mean(self.times),
+            "stdev": statistics.stdev(self.times) if len(self.times) > 1 else 0.0,
+            "times": self.times,
+            "phases": self.phases,
+        }
+
+
+def measure(
+    name: str,
+    params: dict[str, t.Any],
+    func: abc.Callable[[], object],
+    *,
+    number: int,
+    repeat: int,
+) -> Result:
+    """
+    Measures a function, recording the phases of `labmail.timing`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the case.
+    params : dict[str, typing.Any]
+        The parameters of the case.
+    func : Callable[[], object]
+        The function to measure.
+    number : int
+        The number of the calls per repeat.
+    repeat : int
+        The number of the repeats.
+
+    Returns
+    -------
+    benchmarks.suite.Result
+        The result of the case.
+    """
+    func()  # warm up
+    with timing.Timer() as timer:
+        times = timeit.repeat(func, number=number, repeat=repeat)
+    calls = number * repeat
+    return Result(
+        name,
+        params,
+        number,
+        [elapsed / number for elapsed in times],
+        {
+            phase.value: seconds / calls
+            for phase, seconds in timer.timings.phases.items()
+        },
+    )
+
+
+def make_body(size: int, text_type: text_utils.TextType) -> str:
+    """Makes a body of about `size` bytes of the text type."""
+    unit = MARKDOWN_TEXT
+    if text_type is text_utils.TextType.HTML:
+        unit = text_utils.convert_text_to_html(
+            MARKDOWN_TEXT, text_utils.TextType.MARKDOWN
+        )
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def redirect(root_url: str) -> t.ContextManager[object]:
+    """Makes the sessions built in the context request to `root_url`."""
+    return mock.patch.object(_env, "GMAIL_API_ROOT_URL", root_url)
+
+
+def get_metadata() -> dict[str, t.Any]:
+    """Gets the environment of the benchmarks."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "labmail": labmail.__version__,
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "googleapiclient": googleapiclient_version.__version__,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def run(
+    work_dir: pathlib.Path, *, repeat: int, latencies: list[float], keyword: str
+) -> abc.Iterator[Result]:
+    """
+    Runs the benchmark cases.
+
+    Parameters
+    ----------
+    work_dir : pathlib.Path
+        The directory to write the credentials, the caches and the files in.
+    repeat : int
+        The number of the repeats of each case.
+    latencies : list[float]
+        The latencies of the fake server in seconds for the send cases.
+    keyword : str
+        Only the cases whose names contain it are run.
+
+    Yields
+    ------
+    benchmarks.suite.Result
+        The result of each case.
+    """
+
+    def case(
+        name: str,
+        params: dict[str, t.Any],
+        func: abc.Callable[[], object],
+        number: int,
+    ) -> abc.Iterator[Result]:
+        if keyword in name:
+            yield measure(name, params, func, number=number, repeat=repeat)
+
+    creds_filepath = os.fspath(work_dir / "credentials.json")
+    testing.write_credentials(creds_filepath)
+    cache_dir = work_dir / "cache"
+
+    for text_type in [
+        text_utils.TextType.PLAIN,
+        text_utils.TextType.HTML,
+        text_utils.TextType.MARKDOWN,
+    ]:
+        for size in SIZES:
+            body = make_body(size, text_type)
+            yield from case(
+                "text.convert",
+                {"text_type": text_type.value, "size": size},
+                lambda: text_utils.convert_text_to_html(body, text_type),
+                max(1, 4 * 1024 * 1024 // size // 16),
+            )
+
+    with testing.FakeGmailServer() as server, redirect(server.root_url):
+        with session.Session(creds_filepath, cache_dir=cache_dir) as sess:
+            for size in SIZES:
+                body = make_body(size, text_utils.TextType.MARKDOWN)
+                yield from case(
+                    "mime.build_encode",
+                    {"size": size},
+                    lambda: gmail_api.encode_message(
+                        sess.build_message(
+                            "foo@example.com",
+                            body,
+                            "Subject",
+                            text_type=text_utils.TextType.MARKDOWN,
+                        )
+                    ),
+                    max(1, 1024 * 1024 // size // 4),
+                )
+                message = sess.build_message("foo@example.com", body, "Subject")
+                yield from case(
+                    "gmail_api.send_message",
+                    {"size": size},
+                    lambda: gmail_api.send_message(sess.rsc, message=message),
+                    20,
+                )
+            subjects = [f"Subject {i}" for i in range(SUBJECT_COUNT)]
+            for subject in subjects[::2]:
+                server.add_message(sess.build_message("foo@example.com", "", subject))
+            yield from case(
+                "gmail_api.find_subjects",
+                {"count": SUBJECT_COUNT},
+                lambda: gmail_api.find_subjects(sess.rsc, subjects=subjects),
+                5,
+            )
+
+    attachment_filepath = work_dir / "attachment.bin"
+    attachment_filepath.write_bytes(os.urandom(ATTACHMENT_SIZE))
+
+    def write_attachment() -> None:
+        message = mime_multipart.MIMEMultipart()
+        message.attach(mime_text.MIMEText("Body", "html"))
+        message.attach(mime.FileAttachment(attachment_filepath))
+        with tempfile.TemporaryFile() as f:
+            mime.write_message(message, f)
+
+    yield from case(
+        "mime.write_attachment", {"size": ATTACHMENT_SIZE}, write_attachment, 5
+    )
+
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    discovery_cache = cache.DiscoveryCache(cache_dir)
+    yield from case(
+        "gmail_api.build", {"cache": "cold"}, lambda: gmail_api.build(creds), 10
+    )
+    yield from case(
+        "gmail_api.build",
+        {"cache": "warm"},
+        lambda: gmail_api.build(creds, document=discovery_cache.load()),
+        10,
+    )
+
+    for latency in latencies:
+        with testing.FakeGmailServer(latency=latency) as server:
+            with redirect(server.root_url):
+                yield from case(
+                    "send",
+                    {"latency": latency},
+                    lambda: labmail.send(
+                        "foo@example.com",
+                        MARKDOWN_TEXT,
+                        "Subject",
+                        text_type=text_utils.TextType.MARKDOWN,
+                        credentials_filepath=creds_filepath,
+                        cache_dir=cache_dir,
+                    ),
+                    10,
+                )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        action="append",
+        help="latency of the fake server in seconds (default: 0 and 0.05)",
+    )
+    parser.add_argument("-k", "--keyword", default="", help="run only matching cases")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmarks", "results", f"{labmail.__version__}.json"),
+    )
+    args = parser.parse_args()
+
+    results = list()
+    with tempfile.TemporaryDirectory() as work_dir:
+        for result in run(
+            pathlib.Path(work_dir),
+            repeat=args.repeat,
+            latencies=args.latency or [0.0, 0.05],
+            keyword=args.keyword,
+        ):
+            print(f"{result.key:<50} {min(result.times) * 1000:>10.3f} ms")
+            results.append(result.to_dict())
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with args.output.open("w") as f:
+        json.dump({"metadata": get_metadata(), "results": results}, f, indent=2)
+        f.write("\n")
+    print(f"Wrote the results to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
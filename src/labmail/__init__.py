@@ -1,28 +1,80 @@
+from __future__ import annotations
+
 __version__ = "1.0.0"
 
-import email.mime.text as mime_text
-import logging
+import importlib
 import os
-import pprint
+import typing as t
+from collections import abc
 
-from . import gmail_api, text_utils
+from . import text_utils
 from .text_utils import TextType
 
-logger = logging.getLogger(__name__)
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+    from . import aio, gmail_api, ledger, timing
+    from .session import Draft, SendResult, Session, SubjectUsedError
+
+# The submodules depending on Google API client are imported on first access,
+# so that the command line interface starts up quickly.
+_LAZY_ATTRIBUTES = {
+    "aio": (".aio", None),
+    "gmail_api": (".gmail_api", None),
+    "ledger": (".ledger", None),
+    "timing": (".timing", None),
+    "Draft": (".session", "Draft"),
+    "SendResult": (".session", "SendResult"),
+    "Session": (".session", "Session"),
+    "SubjectUsedError": (".session", "SubjectUsedError"),
+}
+
+__all__ = [
+    "Draft",
+    "SendResult",
+    "Session",
+    "SubjectUsedError",
+    "TextType",
+    "aio",
+    "gmail_api",
+    "ledger",
+    "send",
+    "send_async",
+    "send_many",
+    "send_many_async",
+    "text_utils",
+    "timing",
+]
+
+
+def __getattr__(name: str) -> t.Any:
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attr_name = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module(module_name, __name__)
+    value = module if attr_name is None else getattr(module, attr_name)
+    globals()[name] = value
+    return value
 
 
 def send(
     recipient: str | list[str],
-    body: str = "",
+    body: str | abc.Iterable[str] = "",
     subject: str = "",
     *,
     text_type: TextType = TextType.PLAIN,
     headers: dict[str, str] | None = None,
     disallow_same_subjects: bool = False,
     sendas_address: str | None = None,
+    attachments: abc.Sequence[str | os.PathLike[str]] | None = None,
     dry_run: bool = False,
     credentials_filepath: str | os.PathLike[str] = "credentials.json",
-) -> None:
+    cache_dir: str | os.PathLike[str] | None = None,
+    refresh_signature: bool = False,
+    on_phase: timing.PhaseHook | None = None,
+    ledger_filepath: str | os.PathLike[str] | None = None,
+    idempotency_key: str | None = None,
+) -> SendResult:
     """
     Sends a message via Gmail.
 
@@ -32,8 +84,8 @@ def send(
         The email address(es) of recipient.
     subject : str
         The subject of the message.
-    body : str
-        The body text of the message.
+    body : str | Iterable[str]
+        The body text of the message, or its lines such as a file object.
     text_type : labmail.TextType
         The text type of the body.
     headers : dict[str, str] | None
@@ -43,63 +95,217 @@ def send(
     sendas_address : str | None
         The address for the signature.
         If None, the default signature will be used.
+    attachments : Sequence[str | os.PathLike[str]] | None
+        The paths to the files to attach. The message with attachments is
+        uploaded chunk by chunk without loading the files into memory.
     dry_run : bool
         If true, does not post the send request to Gmail API.
     credentials_filepath : str | os.PathLike[str]
         The path to the authorized user json file.
+    cache_dir : str | os.PathLike[str] | None
+        The directory to cache the discovery document of Gmail API
+        and the sendas in. If None, they are not cached on disk.
+    refresh_signature : bool
+        If true, the sendas are retrieved from Gmail ignoring the cache on disk.
+    on_phase : Callable[[labmail.timing.Phase, float], None] | None
+        The callback called with each phase and its duration in seconds.
+    ledger_filepath : str | os.PathLike[str] | None
+        The path to the ledger of the sent messages (see `labmail.ledger`).
+        If given, the message already sent with the same idempotency key
+        is not sent again.
+    idempotency_key : str | None
+        The key to identify the message in the ledger. If None, the fingerprint
+        of the recipients, the subject and the body is used.
+
+    Returns
+    -------
+    labmail.SendResult
+        The sent Message object and the durations of the phases.
 
     Raises
     ------
     labmail.SubjectUsedError
         If the subject has been already used to send the message.
+    labmail.ledger.SendInProgressError
+        If a message with the same idempotency key is being sent.
 
     Examples
     --------
     >>> import labmail
-    >>> labmail.send("foo@example.com", "Body text here", "Subject here")
+    >>> result = labmail.send("foo@example.com", "Body text here", "Subject here")
+    >>> print(result.timings.format())
+
+    Use `labmail.Session` to send many messages without rebuilding
+    the Gmail Resource object for each message.
     """
-    logger.info("Building a Gmail Resource object")
-    with gmail_api.credentials(credentials_filepath) as creds:
-        rsc = gmail_api.build(creds)
-    logger.info("Successfully built the Gmail Resource")
-
-    if disallow_same_subjects:
-        logger.info("Checking whether the subject has been already used")
-        _, _, size = gmail_api.list_message(rsc, query=f'in:sent subject:("{subject}")')
-        if size > 0:
-            raise SubjectUsedError(f"The subject has been already used: {subject}")
-        logger.info("The subject is not used yet")
-
-    logger.info("Retrieving the default sendas from Gmail")
-    sendas = gmail_api.get_sendas(rsc, address=sendas_address)
-    logger.info(f"Successfully retrieved the sendas of {sendas['sendAsEmail']}")
-    logger.debug("The retrieved sendas is...\n" + pprint.pformat(sendas))
-
-    logger.info("Building the HTML body")
-    html_body = (
-        text_utils.convert_text_to_html(body, text_type)
-        + "<div>--</div>"
-        + sendas["signature"]
-    )
-    logger.info("Successfully built the HTML body")
-    logger.debug("The HTML body is...\n" + html_body)
-
-    logger.info("Building the HTML message")
-    message = mime_text.MIMEText(html_body, "html")
-    message["subject"] = subject
-    message["to"] = recipient if isinstance(recipient, str) else ",".join(recipient)
-    for name, value in (headers or dict()).items():
-        message.add_header(name, value)
-    logger.info("Successfully built the HTML message")
-    logger.debug("The message is...\n" + message.as_string())
-
-    logger.info("Sending the message")
-    if dry_run:
-        logger.info("The message is not sent for dry-run mode")
-    else:
-        gmail_api.send_message(rsc, message=message)
-        logger.info("Successfully sent the message")
-
-
-class SubjectUsedError(ValueError):
-    """If the subject has already been used."""
+    from .ledger import SendLedger
+    from .session import SendResult, Session
+    from .timing import Timer
+
+    with (
+        Timer(on_phase) as timer,
+        Session(
+            credentials_filepath,
+            cache_dir=cache_dir,
+            refresh_signature=refresh_signature,
+            ledger=None if ledger_filepath is None else SendLedger(ledger_filepath),
+        ) as session,
+    ):
+        message = session.send(
+            recipient,
+            body,
+            subject,
+            text_type=text_type,
+            headers=headers,
+            disallow_same_subjects=disallow_same_subjects,
+            sendas_address=sendas_address,
+            attachments=attachments,
+            dry_run=dry_run,
+            idempotency_key=idempotency_key,
+        )
+    return SendResult(message, timer.timings)
+
+
+def send_many(
+    drafts: abc.Iterable[Draft],
+    *,
+    disallow_same_subjects: bool = False,
+    dry_run: bool = False,
+    batch_size: int = 50,
+    credentials_filepath: str | os.PathLike[str] = "credentials.json",
+    ledger_filepath: str | os.PathLike[str] | None = None,
+) -> list[schemas.Message | Exception | None]:
+    """
+    Sends messages via Gmail with batch requests.
+
+    Parameters
+    ----------
+    drafts : Iterable[labmail.Draft]
+        The messages to send.
+    disallow_same_subjects : bool
+        If true, the messages whose subjects have been already used are not sent.
+    dry_run : bool
+        If true, does not post the send requests to Gmail API.
+    batch_size : int
+        The number of messages in a batch request.
+    credentials_filepath : str | os.PathLike[str]
+        The path to the authorized user json file.
+    ledger_filepath : str | os.PathLike[str] | None
+        The path to the ledger of the sent messages (see `labmail.ledger`).
+        If given, the messages already sent with the same idempotency keys
+        are not sent again.
+
+    Returns
+    -------
+    list[Message | Exception | None]
+        The sent Message objects or the errors, in the order of `drafts`.
+        See `labmail.Session.send_many()` for details.
+
+    Examples
+    --------
+    >>> import labmail
+    >>> labmail.send_many(
+    ...     labmail.Draft(address, "Body text here", "Subject here")
+    ...     for address in ["foo@example.com", "bar@example.com"]
+    ... )
+    """
+    from .ledger import SendLedger
+    from .session import Session
+
+    with Session(
+        credentials_filepath,
+        ledger=None if ledger_filepath is None else SendLedger(ledger_filepath),
+    ) as session:
+        return session.send_many(
+            drafts,
+            disallow_same_subjects=disallow_same_subjects,
+            dry_run=dry_run,
+            batch_size=batch_size,
+        )
+
+
+async def send_async(
+    recipient: str | list[str],
+    body: str = "",
+    subject: str = "",
+    *,
+    text_type: TextType = TextType.PLAIN,
+    headers: dict[str, str] | None = None,
+    disallow_same_subjects: bool = False,
+    sendas_address: str | None = None,
+    dry_run: bool = False,
+    credentials_filepath: str | os.PathLike[str] = "credentials.json",
+) -> SendResult:
+    """
+    Sends a message via Gmail from asyncio code.
+
+    See `labmail.send()` for the parameters.
+
+    Returns
+    -------
+    labmail.SendResult
+        The sent Message object and the durations of the phases.
+
+    Examples
+    --------
+    >>> import labmail
+    >>> result = await labmail.send_async("foo@example.com", "Body", "Subject")
+    """
+    from .aio import AsyncSession
+    from .session import SendResult
+    from .timing import Timer
+
+    with Timer() as timer:
+        async with AsyncSession(credentials_filepath, concurrency=1) as session:
+            message = await session.send(
+                recipient,
+                body,
+                subject,
+                text_type=text_type,
+                headers=headers,
+                disallow_same_subjects=disallow_same_subjects,
+                sendas_address=sendas_address,
+                dry_run=dry_run,
+            )
+    return SendResult(message, timer.timings)
+
+
+async def send_many_async(
+    drafts: abc.Iterable[Draft],
+    *,
+    concurrency: int = 10,
+    disallow_same_subjects: bool = False,
+    dry_run: bool = False,
+    credentials_filepath: str | os.PathLike[str] = "credentials.json",
+) -> list[schemas.Message | Exception | None]:
+    """
+    Sends messages via Gmail concurrently from asyncio code.
+
+    Parameters
+    ----------
+    drafts : Iterable[labmail.Draft]
+        The messages to send.
+    concurrency : int
+        The maximum number of messages being sent at the same time.
+    disallow_same_subjects : bool
+        If true, the messages whose subjects have been already used are not sent.
+    dry_run : bool
+        If true, does not post the send requests to Gmail API.
+    credentials_filepath : str | os.PathLike[str]
+        The path to the authorized user json file.
+
+    Returns
+    -------
+    list[Message | Exception | None]
+        The sent Message objects or the errors, in the order of `drafts`.
+        See `labmail.Session.send_many()` for details.
+    """
+    from .aio import AsyncSession
+
+    async with AsyncSession(credentials_filepath, concurrency=concurrency) as session:
+        return await session.send_many(
+            drafts,
+            concurrency=concurrency,
+            disallow_same_subjects=disallow_same_subjects,
+            dry_run=dry_run,
+        )
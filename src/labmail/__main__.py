@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import contextlib
 import logging
 import pathlib
 import pprint
+import sys
 import typing as t
 
 import click
@@ -15,9 +17,29 @@ logger = logging.getLogger(__name__)
 APPNAME = pathlib.Path(__file__).parent.name
 APPDIR = pathlib.Path(click.get_app_dir(APPNAME, roaming=False))
 CREDENTIALS_FILEPATH = APPDIR / "credentials.json"
+CACHE_DIR = APPDIR / "cache"
+SOCKET_FILEPATH = APPDIR / "labmail.sock"
 
 
-@click.command(
+class _DefaultCommandGroup(click.Group):
+    """A group of commands which runs the default command if no command is given."""
+
+    def __init__(self, *args: t.Any, default_command: str, **kwargs: t.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx: click.Context, args: list[str]) -> list[str]:
+        if not args or (
+            args[0] not in self.commands
+            and args[0] not in ctx.help_option_names + ["--version"]
+        ):
+            args = [self.default_command] + args
+        return super().parse_args(ctx, args)
+
+
+@click.group(
+    cls=_DefaultCommandGroup,
+    default_command="send",
     help="""\b
   _          _                     _ _
  | |    __ _| |__  _ __ ___   __ _(_) |
@@ -25,24 +47,35 @@ CREDENTIALS_FILEPATH = APPDIR / "credentials.json"
  | |__| (_| | |_) | | | | | | (_| | | |
  |_____\\__,_|_.__/|_| |_| |_|\\__,_|_|_|
 
-Send a message of FILE with signature via Gmail to ADDRESS.
+Send messages with signature via Gmail.
 
-\b
-ADDRESS     Email addresses(seperated with comma) of recipients
-FILE        Filepath or stdin(default) for the message to send
-"""
+The send command runs if no command is given.
+""",
 )
-@click.argument("address", type=str)
-@click.argument("file", type=click.File("r"), default="-")
-@click.option(
-    "-s",
-    "--subject",
-    type=str,
-    default="",
-    help="Subject of the message",
+@click.version_option()
+def main() -> None:
+    pass
+
+
+_credentials_option = click.option(
+    "-c",
+    "--creds",
+    "credentials_filepath",
+    type=click.Path(dir_okay=False),
+    default=str(CREDENTIALS_FILEPATH),
+    help="Path to credentials for Gmail API",
     show_default=True,
 )
-@click.option(
+
+_verbose_option = click.option(
+    "-v",
+    "--verbose",
+    count=True,
+    default=0,
+    help="Increase verbosity (can be used additively)",
+)
+
+_headers_option = click.option(
     "-a",
     "--append",
     "headers",
@@ -51,7 +84,8 @@ FILE        Filepath or stdin(default) for the message to send
     metavar="NAME: VALUE",
     help="Append a header to the message",
 )
-@click.option(
+
+_text_type_option = click.option(
     "-t",
     "--text-type",
     type=click.Choice(
@@ -66,79 +100,517 @@ FILE        Filepath or stdin(default) for the message to send
     help="Text type of the body",
     show_default=True,
 )
-@click.option(
+
+_disallow_same_subjects_option = click.option(
     "--disallow-same-subjects",
     is_flag=True,
     default=False,
-    help="Exit without sending the message if the subject has been already used",
+    help="Do not send the message if the subject has been already used",
 )
-@click.option(
+
+_sendas_option = click.option(
     "--sendas",
     "sendas_address",
     type=str,
     metavar="ADDRESS",
     help="Address of the signature",
 )
-@click.option(
+
+_refresh_signature_option = click.option(
+    "--refresh-signature",
+    is_flag=True,
+    default=False,
+    help="Retrieve the signature from Gmail instead of the cache",
+)
+
+_dry_run_option = click.option(
     "--dry-run",
     is_flag=True,
     default=False,
     help="Run the program without sending message",
 )
-@click.option(
-    "-c",
-    "--creds",
-    "credentials_filepath",
+
+_ledger_option = click.option(
+    "--ledger",
+    "ledger_filepath",
     type=click.Path(dir_okay=False),
-    default=str(CREDENTIALS_FILEPATH),
-    help="Path to credentials for Gmail API",
+    metavar="PATH",
+    help="Skip the messages already sent according to the ledger at PATH",
+)
+
+_socket_option = click.option(
+    "--socket",
+    "socket_filepath",
+    type=click.Path(dir_okay=False),
+    default=str(SOCKET_FILEPATH),
+    help="Path to the socket of the daemon",
+    show_default=True,
+)
+
+
+def _setup_logging(verbose: int) -> None:
+    logging.basicConfig(
+        format="%(levelname)-8s: %(message)s",
+        level=40 - 20 * verbose,
+    )
+
+
+@main.command(
+    help="""\b
+Send a message of FILE with signature via Gmail to ADDRESS.
+
+\b
+ADDRESS     Email addresses(seperated with comma) of recipients
+FILE        Filepath or stdin(default) for the message to send
+"""
+)
+@click.argument("address", type=str)
+@click.argument("file", type=click.File("r"), default="-")
+@click.option(
+    "-s",
+    "--subject",
+    type=str,
+    default="",
+    help="Subject of the message",
     show_default=True,
 )
+@_headers_option
 @click.option(
-    "-v",
-    "--verbose",
-    count=True,
-    default=0,
-    help="Increase verbosity (can be used additively)",
+    "--attach",
+    "attachments",
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    metavar="PATH",
+    help="Attach a file to the message",
 )
-@click.version_option()
-def main(
+@_text_type_option
+@_disallow_same_subjects_option
+@_sendas_option
+@_refresh_signature_option
+@_dry_run_option
+@click.option(
+    "--no-daemon",
+    is_flag=True,
+    default=False,
+    help="Send the message without the daemon even if it is running",
+)
+@_socket_option
+@click.option(
+    "--profile",
+    "profile_filepath",
+    type=click.Path(dir_okay=False),
+    metavar="PATH",
+    help="Write the phase timings and a cProfile/tracemalloc report to PATH",
+)
+@_ledger_option
+@click.option(
+    "--idempotency-key",
+    type=str,
+    metavar="KEY",
+    help="Key of the message in the ledger  [default: hash of the message]",
+)
+@_credentials_option
+@_verbose_option
+def send(
     address: str,
     file: t.IO[str],
     subject: str,
     headers: tuple[str],
+    attachments: tuple[str, ...],
     text_type: text_utils.TextType,
     disallow_same_subjects: bool,
     sendas_address: str | None,
+    refresh_signature: bool,
     dry_run: bool,
+    no_daemon: bool,
+    socket_filepath: str,
+    profile_filepath: str | None,
+    ledger_filepath: str | None,
+    idempotency_key: str | None,
     credentials_filepath: str,
     verbose: int,
 ) -> None:
-    logging.basicConfig(
-        format="%(levelname)-8s: %(message)s",
-        level=40 - 20 * verbose,
-    )
-    logger.debug("The given parameters are:\n" + pprint.pformat(locals()))
+    _setup_logging(verbose)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("The given parameters are:\n" + pprint.pformat(locals()))
 
     if not address:
         raise click.BadArgumentUsage("ADDRESS must not be an empty string")
-    try:
-        labmail.send(
-            recipient=address,
-            body=file.read(),
-            subject=subject,
-            headers=dict(header.split(": ") for header in headers),
-            text_type=text_type,
-            disallow_same_subjects=disallow_same_subjects,
-            sendas_address=sendas_address,
-            dry_run=dry_run,
-            credentials_filepath=credentials_filepath,
+    if idempotency_key is not None and ledger_filepath is None:
+        raise click.BadOptionUsage(
+            "idempotency_key", "--idempotency-key requires --ledger"
         )
+    # the daemon is bypassed for profiling, since the work is done in the daemon,
+    # and for the ledger, which the daemon does not have
+    if not (
+        no_daemon or refresh_signature or profile_filepath or ledger_filepath
+    ) and _send_via_daemon(
+        socket_filepath,
+        credentials_filepath,
+        recipient=address,
+        body=file,
+        subject=subject,
+        headers=dict(header.split(": ") for header in headers),
+        text_type=text_type,
+        disallow_same_subjects=disallow_same_subjects,
+        sendas_address=sendas_address,
+        attachments=attachments,
+        dry_run=dry_run,
+    ):
+        return
+    body: str | t.IO[str] = file
+    if ledger_filepath is not None and idempotency_key is None:
+        # the whole body is needed for the fingerprint of the message
+        body = file.read()
+    try:
+        with (
+            _profile(profile_filepath) if profile_filepath else contextlib.nullcontext()
+        ):
+            labmail.send(
+                recipient=address,
+                body=body,
+                subject=subject,
+                headers=dict(header.split(": ") for header in headers),
+                text_type=text_type,
+                disallow_same_subjects=disallow_same_subjects,
+                sendas_address=sendas_address,
+                attachments=attachments,
+                dry_run=dry_run,
+                credentials_filepath=credentials_filepath,
+                cache_dir=CACHE_DIR,
+                refresh_signature=refresh_signature,
+                ledger_filepath=ledger_filepath,
+                idempotency_key=idempotency_key,
+            )
     except labmail.SubjectUsedError as err:
         raise click.ClickException(str(err))
     except Exception as err:
         raise click.ClickException(f"Internal Error: {err}")
 
 
+@contextlib.contextmanager
+def _profile(filepath: str) -> t.Iterator[None]:
+    """Profiles the block and writes the report to the file, even if it fails."""
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    import labmail.timing
+
+    profiler = cProfile.Profile()
+    timer = labmail.timing.Timer()
+    tracemalloc.start()
+    try:
+        with timer:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(filepath, "w") as f:
+            f.write("Phase timings\n\n" + timer.timings.format() + "\n\n")
+            f.write(f"Peak traced memory: {peak / 2**20:.1f} MiB\n\n")
+            f.write("Top allocations\n\n")
+            for stat in snapshot.statistics("lineno")[:10]:
+                f.write(f"{stat}\n")
+            f.write("\n")
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(30)
+        logger.info(f"Wrote the profile to {filepath}")
+
+
+def _send_via_daemon(
+    socket_filepath: str,
+    credentials_filepath: str,
+    *,
+    body: t.IO[str],
+    **kwargs: t.Any,
+) -> bool:
+    """Sends a message through the daemon, or returns False if it is unavailable."""
+    if not pathlib.Path(socket_filepath).exists():
+        return False
+
+    import labmail.daemon
+
+    client = labmail.daemon.Client(socket_filepath)
+    try:
+        client.connect()
+    except OSError:
+        return False
+    with client:
+        try:
+            account = str(pathlib.Path(credentials_filepath).resolve())
+            if client.info()["account"] != account:
+                logger.info("The daemon is running with other credentials")
+                return False
+            logger.info("Sending the message through the daemon")
+            client.send(body=body.read(), **kwargs)
+        except labmail.daemon.DaemonError as err:
+            if err.type == "SubjectUsedError":
+                raise click.ClickException(str(err))
+            raise click.ClickException(f"Internal Error: {err}")
+        except OSError as err:
+            raise click.ClickException(f"Internal Error: {err}")
+    logger.info("Successfully sent the message through the daemon")
+    return True
+
+
+@main.command(
+    short_help="Send a personalized message to each row of ROWS via Gmail.",
+    help="""\b
+Send a message of FILE personalized with each row of ROWS via Gmail.
+
+The placeholders $name or ${name} in FILE, the subject, the headers and
+the recipient are substituted with the value of the column name of each row.
+
+\b
+ROWS        Filepath of the CSV file with a header row or the JSON Lines file
+FILE        Filepath or stdin(default) for the template of the message
+""",
+)
+@click.argument("rows", type=click.Path(exists=True, dir_okay=False))
+@click.argument("file", type=click.File("r"), default="-")
+@click.option(
+    "--to",
+    "recipient",
+    type=str,
+    default="$email",
+    help="Template of the email addresses of recipients",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--subject",
+    type=str,
+    default="",
+    help="Template of the subject of the message",
+    show_default=True,
+)
+@_headers_option
+@_text_type_option
+@_disallow_same_subjects_option
+@_sendas_option
+@_refresh_signature_option
+@_dry_run_option
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=500,
+    help="Number of rows to render and send at a time",
+    show_default=True,
+)
+@_credentials_option
+@_verbose_option
+def merge(
+    rows: str,
+    file: t.IO[str],
+    recipient: str,
+    subject: str,
+    headers: tuple[str],
+    text_type: text_utils.TextType,
+    disallow_same_subjects: bool,
+    sendas_address: str | None,
+    refresh_signature: bool,
+    dry_run: bool,
+    chunk_size: int,
+    credentials_filepath: str,
+    verbose: int,
+) -> None:
+    _setup_logging(verbose)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("The given parameters are:\n" + pprint.pformat(locals()))
+
+    import labmail.merge
+
+    template = labmail.merge.Template(
+        recipient,
+        file.read(),
+        subject,
+        text_type=text_type,
+        headers=dict(header.split(": ") for header in headers),
+        sendas_address=sendas_address,
+    )
+    total = failed = 0
+    try:
+        with labmail.Session(
+            credentials_filepath,
+            cache_dir=CACHE_DIR,
+            refresh_signature=refresh_signature,
+        ) as session:
+            for result in labmail.merge.merge(
+                session,
+                template,
+                labmail.merge.read_rows(rows),
+                chunk_size=chunk_size,
+                disallow_same_subjects=disallow_same_subjects,
+                dry_run=dry_run,
+            ):
+                total += 1
+                if result.failed:
+                    failed += 1
+                    click.echo(
+                        f"Row {result.index + 1}: "
+                        f"{type(result.result).__name__}: {result.result}",
+                        err=True,
+                    )
+    except Exception as err:
+        raise click.ClickException(f"Internal Error: {err}")
+    click.echo(f"Merged {total} rows ({failed} failed)")
+    if failed > 0:
+        raise click.exceptions.Exit(1)
+
+
+@main.command(
+    short_help="Send the messages of the jobs in JOBS through one session.",
+    help="""\b
+Send the messages of the jobs in JOBS through one session via Gmail.
+
+Each line of JOBS is a JSON object with "recipient" and optionally "id",
+"body", "subject", "text_type", "headers", "sendas" and "idempotency_key".
+The results are appended to the journal, and the jobs succeeded
+in the journal are skipped when the command is run again.
+With --ledger, the messages already sent are skipped even if their jobs
+failed in the journal, such as for a timeout.
+
+\b
+JOBS        Filepath or stdin(default) for the JSON Lines of the jobs
+""",
+)
+@click.argument("jobs", type=click.File("r"), default="-")
+@click.option(
+    "--journal",
+    type=click.Path(dir_okay=False),
+    help="Path to the journal of the results  [default: JOBS.journal]",
+)
+@click.option(
+    "-p",
+    "--parallel",
+    type=click.IntRange(min=1),
+    default=8,
+    help="Number of messages sent at the same time",
+    show_default=True,
+)
+@_disallow_same_subjects_option
+@_refresh_signature_option
+@_dry_run_option
+@_ledger_option
+@_credentials_option
+@_verbose_option
+def batch(
+    jobs: t.IO[str],
+    journal: str | None,
+    parallel: int,
+    disallow_same_subjects: bool,
+    refresh_signature: bool,
+    dry_run: bool,
+    ledger_filepath: str | None,
+    credentials_filepath: str,
+    verbose: int,
+) -> None:
+    _setup_logging(verbose)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("The given parameters are:\n" + pprint.pformat(locals()))
+
+    import labmail.batch
+    import labmail.ledger
+
+    if journal is None and jobs.name != "<stdin>":
+        journal = f"{jobs.name}.journal"
+    total = failed = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            job_journal = None
+            if journal is not None:
+                job_journal = stack.enter_context(labmail.batch.Journal(journal))
+            session = stack.enter_context(
+                labmail.Session(
+                    credentials_filepath,
+                    thread_safe=True,
+                    cache_dir=CACHE_DIR,
+                    refresh_signature=refresh_signature,
+                    ledger=(
+                        None
+                        if ledger_filepath is None
+                        else labmail.ledger.SendLedger(ledger_filepath)
+                    ),
+                )
+            )
+            for result in labmail.batch.run(
+                session,
+                labmail.batch.read_jobs(jobs),
+                journal=job_journal,
+                max_workers=parallel,
+                disallow_same_subjects=disallow_same_subjects,
+                dry_run=dry_run,
+            ):
+                total += 1
+                if result.failed:
+                    failed += 1
+                    click.echo(f"Job {result.key}: {result.error}", err=True)
+    except Exception as err:
+        raise click.ClickException(f"Internal Error: {err}")
+    click.echo(f"Ran {total} jobs ({failed} failed)")
+    if failed > 0:
+        raise click.exceptions.Exit(1)
+
+
+@main.command(
+    short_help="Run a daemon sending messages on requests from send command.",
+    help="""\b
+Run a daemon which keeps the credentials, the Gmail Resource and
+the signature, and sends messages on requests over a Unix domain socket.
+
+While the daemon is running, send command sends the message through it
+if the credentials are the same, which saves the startup time.
+Stop the daemon with Ctrl+C or SIGTERM.
+""",
+)
+@_socket_option
+@_refresh_signature_option
+@_credentials_option
+@_verbose_option
+def serve(
+    socket_filepath: str,
+    refresh_signature: bool,
+    credentials_filepath: str,
+    verbose: int,
+) -> None:
+    _setup_logging(verbose)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("The given parameters are:\n" + pprint.pformat(locals()))
+
+    import signal
+
+    import labmail.daemon
+
+    if sys.platform == "win32":
+        raise click.ClickException(labmail.daemon.UNSUPPORTED_MESSAGE)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        with labmail.Session(
+            credentials_filepath,
+            thread_safe=True,
+            cache_dir=CACHE_DIR,
+            refresh_signature=refresh_signature,
+        ) as session:
+            session.get_sendas()
+            with labmail.daemon.Server(
+                session,
+                socket_filepath,
+                account=str(pathlib.Path(credentials_filepath).resolve()),
+            ) as server:
+                click.echo(f"Serving on {socket_filepath}")
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    logger.info("Stopping the daemon")
+    except Exception as err:
+        raise click.ClickException(f"Internal Error: {err}")
+
+
 if __name__ == "__main__":  # pragma: no cover
     main()
@@ -10,3 +10,4 @@ import os
 GOOGLE_OAUTH_FLOW_HOST = os.environ.get("LABMAIL_GOOGLE_OAUTH_FLOW_HOST", "localhost")
 GOOGLE_OAUTH_FLOW_PORT = os.environ.get("LABMAIL_GOOGLE_OAUTH_FLOW_PORT", 8080)
 GOOGLE_OAUTH_FLOW_BIND = os.environ.get("LABMAIL_GOOGLE_OAUTH_FLOW_BIND", None)
+GMAIL_API_ROOT_URL = os.environ.get("LABMAIL_GMAIL_API_ROOT_URL", None)
@@ -0,0 +1,96 @@
+import contextlib
+import os
+import pathlib
+import sys
+import tempfile
+from collections import abc
+
+
+def write_text_atomic(filepath: str | os.PathLike[str], text: str) -> None:
+    """
+    Writes the text to the file atomically.
+
+    The text is written to a temporary file in the same directory first,
+    and then the temporary file is renamed to `filepath`,
+    so that readers never see a partially written file.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the file to write.
+    text : str
+        The text to write.
+    """
+    filepath = pathlib.Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_filepath = tempfile.mkstemp(
+        dir=filepath.parent, prefix=f".{filepath.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
+
+
+def read_text_or_none(filepath: str | os.PathLike[str]) -> str | None:
+    """
+    Reads the text of the file.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the file to read.
+
+    Returns
+    -------
+    str | None
+        The text of the file, or None if the file cannot be read.
+    """
+    try:
+        return pathlib.Path(filepath).read_text()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+@contextlib.contextmanager
+def file_lock(filepath: str | os.PathLike[str]) -> abc.Iterator[None]:
+    """
+    Holds an exclusive advisory lock on the file across processes.
+
+    The lock file is created if it does not exist, and never removed.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the lock file.
+    """
+    filepath = pathlib.Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    with filepath.open("a") as f:
+        if sys.platform == "win32":  # pragma: no cover
+            import msvcrt
+
+            # msvcrt.locking() locks the bytes from the current position
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
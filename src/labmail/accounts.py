@@ -0,0 +1,477 @@
+"""
+This module provides a pool of Gmail accounts to spread messages across,
+since the quotas of Gmail API and the sending limits are per user.
+
+Each account has its own session, which keeps the credentials, a warm
+Resource object and the signatures of the account.
+The number of the messages sent by each account in the last 24 hours is
+counted in the process to stay within its daily sending limit.
+"""
+
+from __future__ import annotations
+
+import collections
+import contextlib
+import enum
+import itertools
+import logging
+import os
+import threading
+import time
+import types
+import typing as t
+from collections import abc
+from concurrent import futures
+
+from labmail import cache
+from labmail.session import Draft, Session, SubjectUsedError
+from labmail.text_utils import TextType
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DAILY_QUOTA = 500
+"""The default number of the messages an account can send per day,
+which is the sending limit of the personal Gmail accounts."""
+
+QUOTA_WINDOW = 24 * 60 * 60
+"""The seconds of the rolling window in which the sent messages are counted."""
+
+
+class Policy(enum.Enum):
+    ROUND_ROBIN = "round_robin"
+    """Takes turns among the accounts."""
+    LEAST_LOADED = "least_loaded"
+    """Chooses the account sending the fewest messages at the moment."""
+    QUOTA = "quota"
+    """Chooses the account with the most remaining daily quota."""
+
+
+class QuotaExceededError(RuntimeError):
+    """If all the accounts have used up their daily quotas."""
+
+
+class Account:
+    """
+    An account of `AccountPool`.
+
+    Parameters
+    ----------
+    session : labmail.Session
+        The session of the account.
+    daily_quota : int
+        The number of the messages the account can send per day.
+
+    Attributes
+    ----------
+    in_flight : int
+        The number of the messages being sent by the account.
+    """
+
+    def __init__(self, session: Session, daily_quota: int) -> None:
+        self.session = session
+        self.daily_quota = daily_quota
+        self.in_flight = 0
+        self._sent_at: collections.deque[float] = collections.deque()
+
+    @property
+    def name(self) -> str:
+        """The path to the credentials of the account."""
+        return os.fspath(self.session.credentials_filepath)
+
+    @property
+    def sent(self) -> int:
+        """The number of the messages sent or being sent in the last 24 hours."""
+        threshold = time.time() - QUOTA_WINDOW
+        while self._sent_at and self._sent_at[0] <= threshold:
+            self._sent_at.popleft()
+        return len(self._sent_at)
+
+    @property
+    def remaining(self) -> int:
+        """The number of the messages the account can send in the window."""
+        return max(self.daily_quota - self.sent, 0)
+
+    def _reserve(self) -> None:
+        self.in_flight += 1
+        self._sent_at.append(time.time())
+
+    def _release(self, sent: bool) -> None:
+        self.in_flight -= 1
+        if not sent and self._sent_at:
+            self._sent_at.pop()
+
+
+class AccountPool:
+    """
+    A pool of Gmail accounts which distributes messages across them.
+
+    The pool can be shared across threads.
+
+    Parameters
+    ----------
+    credentials_filepaths : Sequence[str | os.PathLike[str]]
+        The paths to the authorized user json files of the accounts.
+    policy : labmail.accounts.Policy
+        The policy to choose the account to send each message.
+    daily_quota : int | Mapping[str, int]
+        The number of the messages each account can send per day,
+        or the numbers keyed by the paths to the credentials as given.
+        The accounts missing in the mapping have `DEFAULT_DAILY_QUOTA`.
+    scopes : list[str] | None
+        The list of scopes for the credentials.
+    cache_dir : str | os.PathLike[str] | None
+        The directory to cache the discovery document, the sendas and
+        the indices of the sent subjects in. See `labmail.Session`.
+    sendas_ttl : float
+        The time to live of the sendas cached on disk in seconds.
+    refresh_signature : bool
+        If true, the sendas are retrieved from Gmail ignoring the cache on disk.
+
+    Examples
+    --------
+    >>> with AccountPool(["alice.json", "bob.json"], policy=Policy.QUOTA) as pool:
+    ...     for address in addresses:
+    ...         pool.send(address, "Body text here", "Subject here")
+    """
+
+    def __init__(
+        self,
+        credentials_filepaths: abc.Sequence[str | os.PathLike[str]],
+        *,
+        policy: Policy = Policy.ROUND_ROBIN,
+        daily_quota: int | abc.Mapping[str, int] = DEFAULT_DAILY_QUOTA,
+        scopes: list[str] | None = None,
+        cache_dir: str | os.PathLike[str] | None = None,
+        sendas_ttl: float = cache.SendAsCache.DEFAULT_TTL,
+        refresh_signature: bool = False,
+    ) -> None:
+        if not credentials_filepaths:
+            raise ValueError("No credentials are given")
+        self.policy = policy
+        self.accounts = [
+            Account(
+                Session(
+                    filepath,
+                    scopes,
+                    thread_safe=True,
+                    cache_dir=cache_dir,
+                    sendas_ttl=sendas_ttl,
+                    refresh_signature=refresh_signature,
+                ),
+                daily_quota
+                if isinstance(daily_quota, int)
+                else daily_quota.get(os.fspath(filepath), DEFAULT_DAILY_QUOTA),
+            )
+            for filepath in credentials_filepaths
+        ]
+        self._turns = itertools.cycle(range(len(self.accounts)))
+        self._lock = threading.Lock()
+        self._reserved_subjects: set[str] = set()
+        self._exit_stack: contextlib.ExitStack | None = None
+
+    def __enter__(self) -> AccountPool:
+        return self.open()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.close(exc_type, exc_value, traceback)
+
+    def open(self) -> AccountPool:
+        """
+        Opens the sessions of the accounts and retrieves their signatures.
+
+        Returns
+        -------
+        labmail.accounts.AccountPool
+            The pool itself.
+        """
+        if self._exit_stack is not None:
+            return self
+        with contextlib.ExitStack() as stack:
+            for account in self.accounts:
+                stack.enter_context(account.session)
+            with futures.ThreadPoolExecutor(len(self.accounts)) as executor:
+                for _ in executor.map(
+                    lambda account: account.session.get_sendas(), self.accounts
+                ):
+                    pass
+            self._exit_stack = stack.pop_all()
+        logger.info(f"Opened {len(self.accounts)} accounts")
+        return self
+
+    def close(
+        self,
+        exc_type: type[BaseException] | None = None,
+        exc_value: BaseException | None = None,
+        traceback: types.TracebackType | None = None,
+    ) -> None:
+        """Closes the sessions of the accounts and saves their credentials."""
+        if self._exit_stack is None:
+            return
+        exit_stack, self._exit_stack = self._exit_stack, None
+        exit_stack.__exit__(exc_type, exc_value, traceback)
+
+    def acquire(self) -> Account:
+        """
+        Chooses an account by the policy and reserves a message of its quota.
+
+        Call `release()` after sending the message.
+
+        Returns
+        -------
+        labmail.accounts.Account
+            The chosen account.
+
+        Raises
+        ------
+        labmail.accounts.QuotaExceededError
+            If all the accounts have used up their daily quotas.
+        """
+        with self._lock:
+            available = [account for account in self.accounts if account.remaining > 0]
+            if not available:
+                raise QuotaExceededError("All the accounts have used up their quotas")
+            match self.policy:
+                case Policy.ROUND_ROBIN:
+                    account = next(
+                        self.accounts[idx]
+                        for idx in self._turns
+                        if self.accounts[idx].remaining > 0
+                    )
+                case Policy.LEAST_LOADED:
+                    account = min(
+                        available, key=lambda account: (account.in_flight, account.sent)
+                    )
+                case Policy.QUOTA:
+                    account = max(available, key=lambda account: account.remaining)
+            account._reserve()
+            return account
+
+    def release(self, account: Account, *, sent: bool) -> None:
+        """
+        Releases a message reserved by `acquire()`.
+
+        Parameters
+        ----------
+        account : labmail.accounts.Account
+            The account returned by `acquire()`.
+        sent : bool
+            Whether the message has been sent.
+            If false, the reserved quota is given back.
+        """
+        with self._lock:
+            account._release(sent)
+
+    def is_subject_used(self, subject: str) -> bool:
+        """
+        Checks whether any account has already used the subject.
+
+        Parameters
+        ----------
+        subject : str
+            The subject to check.
+
+        Returns
+        -------
+        bool
+            True if a message with the subject has been sent by any account.
+        """
+        return subject in self.find_used_subjects([subject])
+
+    def find_used_subjects(self, subjects: abc.Iterable[str]) -> set[str]:
+        """
+        Finds the subjects which have been already used by any account.
+
+        See `labmail.Session.find_used_subjects()` for details.
+
+        Parameters
+        ----------
+        subjects : Iterable[str]
+            The subjects to check.
+
+        Returns
+        -------
+        set[str]
+            The subjects in `subjects` used by any account.
+        """
+        subjects = set(subjects)
+        found: set[str] = set()
+        for account in self.accounts:
+            if not subjects - found:
+                break
+            found |= account.session.find_used_subjects(subjects - found)
+        return found
+
+    @contextlib.contextmanager
+    def _reserve_subjects(self, subjects: abc.Iterable[str]) -> abc.Iterator[set[str]]:
+        """
+        Reserves the subjects to send messages with them until the exit,
+        yielding the ones not reserved by the other threads.
+        """
+        with self._lock:
+            reserved = set(subjects) - self._reserved_subjects
+            self._reserved_subjects |= reserved
+        try:
+            yield reserved
+        finally:
+            with self._lock:
+                self._reserved_subjects -= reserved
+
+    def send(
+        self,
+        recipient: str | list[str],
+        body: str | abc.Iterable[str] = "",
+        subject: str = "",
+        *,
+        text_type: TextType = TextType.PLAIN,
+        headers: dict[str, str] | None = None,
+        disallow_same_subjects: bool = False,
+        sendas_address: str | None = None,
+        attachments: abc.Sequence[str | os.PathLike[str]] | None = None,
+        dry_run: bool = False,
+    ) -> schemas.Message | None:
+        """
+        Sends a message via the account chosen by the policy,
+        with the signature of the account.
+
+        See `labmail.send()` for the parameters.
+        `sendas_address` must be registered in every account if given.
+
+        Returns
+        -------
+        Message | None
+            The sent Message object, or None for dry-run mode.
+
+        Raises
+        ------
+        labmail.SubjectUsedError
+            If the subject has been already used by any account,
+            or is being used by the message sent in the other thread.
+        labmail.accounts.QuotaExceededError
+            If all the accounts have used up their daily quotas.
+        """
+        with self._reserve_subjects(
+            [subject] if disallow_same_subjects else []
+        ) as reserved:
+            if disallow_same_subjects and (
+                subject not in reserved or self.is_subject_used(subject)
+            ):
+                raise SubjectUsedError(f"The subject has been already used: {subject}")
+            account = self.acquire()
+            logger.info(f"Sending the message via {account.name}")
+            response = None
+            try:
+                # the subject is recorded by the session before the exit
+                response = account.session.send(
+                    recipient,
+                    body,
+                    subject,
+                    text_type=text_type,
+                    headers=headers,
+                    sendas_address=sendas_address,
+                    attachments=attachments,
+                    dry_run=dry_run,
+                )
+            finally:
+                self.release(account, sent=response is not None)
+            return response
+
+    def send_many(
+        self,
+        drafts: abc.Iterable[Draft],
+        *,
+        disallow_same_subjects: bool = False,
+        dry_run: bool = False,
+        batch_size: int = 50,
+    ) -> list[schemas.Message | Exception | None]:
+        """
+        Sends messages with batch requests, distributing them across the accounts
+        by the policy and sending via the accounts in parallel.
+
+        Parameters
+        ----------
+        drafts : Iterable[labmail.Draft]
+            The messages to send.
+        disallow_same_subjects : bool
+            If true, the messages whose subjects have been already used
+            by any account, including by the preceding drafts and by the messages
+            being sent in the other threads, are not sent.
+        dry_run : bool
+            If true, does not post the send requests to Gmail API.
+        batch_size : int
+            The number of messages in a batch request.
+
+        Returns
+        -------
+        list[Message | Exception | None]
+            The sent Message objects or the errors, in the order of `drafts`.
+            labmail.SubjectUsedError is returned for the message whose subject
+            has been already used, labmail.accounts.QuotaExceededError for
+            the message beyond the quotas, and None for dry-run mode.
+        """
+        results: list[schemas.Message | Exception | None] = list()
+        assigned: dict[int, list[tuple[int, Draft]]] = collections.defaultdict(list)
+        used_subjects: set[str] = set()
+        found_subjects: set[str] = set()
+        if disallow_same_subjects:
+            drafts = list(drafts)
+        with self._reserve_subjects(
+            [draft.subject for draft in drafts] if disallow_same_subjects else []
+        ) as reserved:
+            if disallow_same_subjects:
+                found_subjects = self.find_used_subjects(reserved)
+                # the subjects reserved by the other threads are being used
+                found_subjects |= {draft.subject for draft in drafts} - reserved
+            indices = {id(account): idx for idx, account in enumerate(self.accounts)}
+            for draft in drafts:
+                results.append(None)
+                if disallow_same_subjects:
+                    if (
+                        draft.subject in used_subjects
+                        or draft.subject in found_subjects
+                    ):
+                        results[-1] = SubjectUsedError(
+                            f"The subject has been already used: {draft.subject}"
+                        )
+                        continue
+                    used_subjects.add(draft.subject)
+                try:
+                    account = self.acquire()
+                except QuotaExceededError as err:
+                    results[-1] = err
+                    continue
+                assigned[indices[id(account)]].append((len(results) - 1, draft))
+
+            def send(idx: int) -> None:
+                account = self.accounts[idx]
+                try:
+                    responses = account.session.send_many(
+                        [draft for _, draft in assigned[idx]],
+                        dry_run=dry_run,
+                        batch_size=batch_size,
+                    )
+                except Exception as err:
+                    responses = [err] * len(assigned[idx])
+                for (result_idx, _), response in zip(assigned[idx], responses):
+                    results[result_idx] = response
+                    self.release(
+                        account,
+                        sent=response is not None
+                        and not isinstance(response, Exception),
+                    )
+
+            logger.info(
+                f"Sending {sum(map(len, assigned.values()))} messages"
+                f" via {len(assigned)} accounts"
+            )
+            with futures.ThreadPoolExecutor(max(len(assigned), 1)) as executor:
+                for _ in executor.map(send, assigned):
+                    pass
+            return results
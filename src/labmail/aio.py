@@ -0,0 +1,244 @@
+"""
+This module provides asyncio APIs to interact with Gmail API.
+
+The Google API client has no asynchronous transport, so the blocking requests
+run in worker threads, and each request in flight still holds a thread.
+`AsyncSession` runs them in its own thread pool sized to its concurrency,
+while the functions of this module run in the event loop's default executor,
+which has at most min(32, os.cpu_count() + 4) threads.
+Each worker thread has its own HTTP connection
+when the Resource object is built with `thread_safe=True`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import os
+import types
+import typing as t
+from collections import abc
+from concurrent import futures
+
+from labmail import gmail_api
+from labmail.session import Draft, Session, SubjectUsedError
+from labmail.text_utils import TextType
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+P = t.ParamSpec("P")
+R = t.TypeVar("R")
+
+
+def _to_async(
+    func: abc.Callable[P, R],
+) -> abc.Callable[P, abc.Coroutine[t.Any, t.Any, R]]:
+    @functools.wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    return wrapper
+
+
+list_message = _to_async(gmail_api.list_message)
+get_message = _to_async(gmail_api.get_message)
+send_message = _to_async(gmail_api.send_message)
+send_messages = _to_async(gmail_api.send_messages)
+get_sendas = _to_async(gmail_api.get_sendas)
+
+
+class AsyncSession:
+    """
+    A long-lived session to send messages via Gmail from asyncio code.
+
+    The blocking requests run in the thread pool owned by the session,
+    so up to `concurrency` requests are in flight at the same time.
+
+    Parameters
+    ----------
+    credentials_filepath : str | os.PathLike[str]
+        The path to the authorized user json file.
+    scopes : list[str] | None
+        The list of scopes for the credentials.
+    concurrency : int
+        The number of the worker threads, i.e. the maximum number of
+        messages being sent at the same time.
+
+    Examples
+    --------
+    >>> from labmail import aio
+    >>> async with aio.AsyncSession(concurrency=50) as session:
+    ...     await session.send("foo@example.com", "Body text here", "Subject here")
+    """
+
+    def __init__(
+        self,
+        credentials_filepath: str | os.PathLike[str] = "credentials.json",
+        scopes: list[str] | None = None,
+        *,
+        concurrency: int = 10,
+    ) -> None:
+        if concurrency < 1:
+            raise ValueError("concurrency must be positive")
+        self.session = Session(credentials_filepath, scopes, thread_safe=True)
+        self.concurrency = concurrency
+        self._executor: futures.ThreadPoolExecutor | None = None
+
+    async def __aenter__(self) -> AsyncSession:
+        return await self.open()
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        await self.close(exc_type, exc_value, traceback)
+
+    async def _run(
+        self, func: abc.Callable[P, R], *args: P.args, **kwargs: P.kwargs
+    ) -> R:
+        if self._executor is None:
+            raise RuntimeError("The session is not open")
+        # the context is copied as asyncio.to_thread() does for labmail.timing
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def open(self) -> AsyncSession:
+        """
+        Starts the worker threads, loads the credentials and builds
+        a GmailResource object.
+
+        Returns
+        -------
+        labmail.aio.AsyncSession
+            The session itself.
+        """
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix="labmail-aio"
+            )
+        await self._run(self.session.open)
+        return self
+
+    async def close(
+        self,
+        exc_type: type[BaseException] | None = None,
+        exc_value: BaseException | None = None,
+        traceback: types.TracebackType | None = None,
+    ) -> None:
+        """Closes the session, saves the credentials and stops the worker threads."""
+        if self._executor is None:
+            return
+        try:
+            await self._run(self.session.close, exc_type, exc_value, traceback)
+        finally:
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False)
+
+    async def send(
+        self,
+        recipient: str | list[str],
+        body: str = "",
+        subject: str = "",
+        *,
+        text_type: TextType = TextType.PLAIN,
+        headers: dict[str, str] | None = None,
+        disallow_same_subjects: bool = False,
+        sendas_address: str | None = None,
+        dry_run: bool = False,
+    ) -> schemas.Message | None:
+        """
+        Sends a message via Gmail.
+
+        See `labmail.Session.send()` for details.
+        """
+        return await self._run(
+            self.session.send,
+            recipient,
+            body,
+            subject,
+            text_type=text_type,
+            headers=headers,
+            disallow_same_subjects=disallow_same_subjects,
+            sendas_address=sendas_address,
+            dry_run=dry_run,
+        )
+
+    async def send_many(
+        self,
+        drafts: abc.Iterable[Draft],
+        *,
+        concurrency: int | None = None,
+        disallow_same_subjects: bool = False,
+        dry_run: bool = False,
+    ) -> list[schemas.Message | Exception | None]:
+        """
+        Sends messages via Gmail concurrently.
+
+        Parameters
+        ----------
+        drafts : Iterable[labmail.Draft]
+            The messages to send.
+        concurrency : int | None
+            The maximum number of messages being sent at the same time.
+            It must not exceed the concurrency of the session.
+            If None, the concurrency of the session is used.
+        disallow_same_subjects : bool
+            If true, the messages whose subjects have been already used,
+            including by the preceding drafts, are not sent.
+        dry_run : bool
+            If true, does not post the send requests to Gmail API.
+
+        Returns
+        -------
+        list[Message | Exception | None]
+            The sent Message objects or the errors, in the order of `drafts`.
+            See `labmail.Session.send_many()` for details.
+
+        Raises
+        ------
+        ValueError
+            If `concurrency` exceeds the concurrency of the session.
+        """
+        if concurrency is None:
+            concurrency = self.concurrency
+        elif concurrency > self.concurrency:
+            raise ValueError(
+                f"concurrency must not exceed that of the session: {self.concurrency}"
+            )
+        semaphore = asyncio.Semaphore(concurrency)
+        used_subjects: set[str] = set()
+        if disallow_same_subjects:
+            drafts = list(drafts)
+            # searched at once and kept in the session for the sends
+            await self._run(
+                self.session.find_used_subjects, [draft.subject for draft in drafts]
+            )
+
+        async def send(draft: Draft) -> schemas.Message | Exception | None:
+            if disallow_same_subjects:
+                if draft.subject in used_subjects:
+                    return SubjectUsedError(
+                        f"The subject has been already used: {draft.subject}"
+                    )
+                used_subjects.add(draft.subject)
+            async with semaphore:
+                try:
+                    return await self.send(
+                        draft.recipient,
+                        draft.body,
+                        draft.subject,
+                        text_type=draft.text_type,
+                        headers=draft.headers,
+                        disallow_same_subjects=disallow_same_subjects,
+                        sendas_address=draft.sendas_address,
+                        dry_run=dry_run,
+                    )
+                except Exception as err:
+                    return err
+
+        return list(await asyncio.gather(*(send(draft) for draft in drafts)))
@@ -0,0 +1,297 @@
+"""
+This module provides a batch of jobs to send messages through one session,
+with a journal of the results to resume the batch after a crash.
+
+A job is a JSON object on a line of JSON Lines, such as::
+
+    {"id": "1", "recipient": "foo@example.com", "body": "Hello", "subject": "Hi"}
+
+The keys other than "id" and "recipient" are optional, and "text_type" is
+one of `labmail.TextType` values and "sendas" is the address for the signature.
+The jobs are identified by "id", or by their line numbers if it is missing.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import time
+import types
+import typing as t
+from collections import abc
+from concurrent import futures
+
+from labmail.session import Draft, Session
+from labmail.text_utils import TextType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Job:
+    """
+    A job to send a message.
+
+    Attributes
+    ----------
+    key : str
+        The key to identify the job in the journal.
+    draft : labmail.Draft | None
+        The message to send, or None if the job is invalid.
+    error : Exception | None
+        The error to parse the job.
+    """
+
+    key: str
+    draft: Draft | None
+    error: Exception | None = None
+
+
+@dataclasses.dataclass
+class JobResult:
+    """
+    The result of a job, recorded as a line of the journal.
+
+    Attributes
+    ----------
+    key : str
+        The key of the job.
+    message_id : str | None
+        The ID of the sent message, or None if it is not sent.
+    latency : float
+        The time to send the message in seconds.
+    error : str | None
+        The error message if the job failed.
+    """
+
+    key: str
+    message_id: str | None
+    latency: float
+    error: str | None = None
+
+    @property
+    def failed(self) -> bool:
+        """Whether the job failed."""
+        return self.error is not None
+
+
+def read_jobs(lines: abc.Iterable[str]) -> abc.Iterator[Job]:
+    """
+    Reads the jobs from lines of JSON Lines one by one.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        The lines of JSON Lines, such as a file object. Blank lines are skipped.
+
+    Yields
+    ------
+    labmail.batch.Job
+        The jobs. The invalid lines are yielded as the jobs with the errors.
+    """
+    for lineno, line in enumerate(lines, 1):
+        if line.strip() == "":
+            continue
+        key = str(lineno)
+        try:
+            spec = json.loads(line)
+            if not isinstance(spec, dict):
+                raise ValueError("The job is not a JSON object")
+            key = str(spec.get("id", key))
+            draft = Draft(
+                recipient=spec["recipient"],
+                body=spec.get("body", ""),
+                subject=spec.get("subject", ""),
+                text_type=TextType(spec.get("text_type", TextType.PLAIN.value)),
+                headers=spec.get("headers"),
+                sendas_address=spec.get("sendas"),
+                idempotency_key=spec.get("idempotency_key"),
+            )
+        except (KeyError, ValueError) as err:
+            yield Job(key, None, err)
+        else:
+            yield Job(key, draft)
+
+
+class Journal:
+    """
+    A journal of the results of jobs, appended line by line as JSON Lines.
+
+    Each line is flushed to the disk as soon as it is appended,
+    so that the journal survives a crash of the process.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the journal file.
+    """
+
+    def __init__(self, filepath: str | os.PathLike[str]) -> None:
+        self.filepath = pathlib.Path(filepath)
+        self._file: t.TextIO | None = None
+
+    def __enter__(self) -> Journal:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def load(self) -> dict[str, JobResult]:
+        """
+        Loads the results of the jobs.
+
+        A truncated last line, written at a crash, is ignored.
+
+        Returns
+        -------
+        dict[str, labmail.batch.JobResult]
+            The last results of the jobs keyed by the keys of the jobs.
+        """
+        results: dict[str, JobResult] = dict()
+        try:
+            with self.filepath.open() as f:
+                for line in f:
+                    try:
+                        result = JobResult(**json.loads(line))
+                    except (ValueError, TypeError):
+                        logger.warning(f"Ignored an invalid line of {self.filepath}")
+                        continue
+                    results[result.key] = result
+        except FileNotFoundError:
+            pass
+        return results
+
+    def append(self, result: JobResult) -> None:
+        """
+        Appends the result of a job.
+
+        Parameters
+        ----------
+        result : labmail.batch.JobResult
+            The result to append.
+        """
+        if self._file is None:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.filepath.open("a")
+        self._file.write(json.dumps(dataclasses.asdict(result)) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """Closes the journal file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def run(
+    session: Session,
+    jobs: abc.Iterable[Job],
+    *,
+    journal: Journal | None = None,
+    max_workers: int = 8,
+    disallow_same_subjects: bool = False,
+    dry_run: bool = False,
+) -> abc.Generator[JobResult, None, None]:
+    """
+    Sends the messages of the jobs via Gmail concurrently.
+
+    The jobs already succeeded in `journal` and the jobs with the same key as
+    a preceding one are skipped, and the results of the others are appended to
+    `journal` as they complete.
+    At most twice as many jobs as the worker threads are taken
+    from `jobs` at a time.
+    If `session` has a ledger, the messages already sent are not sent again,
+    keyed by the idempotency keys of the jobs if given.
+
+    Parameters
+    ----------
+    session : labmail.Session
+        The open session to send the messages with.
+        It must be thread-safe if `max_workers` is more than 1.
+    jobs : Iterable[labmail.batch.Job]
+        The jobs to run, such as `read_jobs()`.
+    journal : labmail.batch.Journal | None
+        The journal to resume from and record the results in.
+    max_workers : int
+        The number of the worker threads.
+    disallow_same_subjects : bool
+        If true, the messages whose subjects have been already used are not sent.
+    dry_run : bool
+        If true, does not post the send requests to Gmail API.
+        The results are not recorded in `journal` then.
+
+    Yields
+    ------
+    labmail.batch.JobResult
+        The results of the jobs run, as they complete.
+
+    Examples
+    --------
+    >>> with (
+    ...     open("jobs.jsonl") as f,
+    ...     Journal("jobs.jsonl.journal") as journal,
+    ...     labmail.Session(thread_safe=True) as session,
+    ... ):
+    ...     for result in run(session, read_jobs(f), journal=journal):
+    ...         print(result)
+    """
+    done_keys: set[str] = set()
+    if journal is not None:
+        done_keys = {key for key, result in journal.load().items() if not result.failed}
+        logger.info(f"Skipping {len(done_keys)} jobs succeeded in the journal")
+
+    def send(key: str, draft: Draft) -> JobResult:
+        start = time.perf_counter()
+        try:
+            response = session.send(
+                draft.recipient,
+                draft.body,
+                draft.subject,
+                text_type=draft.text_type,
+                headers=draft.headers,
+                disallow_same_subjects=disallow_same_subjects,
+                sendas_address=draft.sendas_address,
+                dry_run=dry_run,
+                idempotency_key=(
+                    draft.idempotency_key if session.ledger is not None else None
+                ),
+            )
+        except Exception as err:
+            return JobResult(key, None, time.perf_counter() - start, str(err))
+        message_id = None if response is None else response["id"]
+        return JobResult(key, message_id, time.perf_counter() - start)
+
+    def record(result: JobResult) -> JobResult:
+        if journal is not None and not dry_run:
+            journal.append(result)
+        return result
+
+    pending: set[futures.Future[JobResult]] = set()
+    with futures.ThreadPoolExecutor(
+        max_workers, thread_name_prefix="labmail"
+    ) as executor:
+        for job in jobs:
+            if job.key in done_keys:
+                continue
+            done_keys.add(job.key)
+            if job.draft is None:
+                yield record(JobResult(job.key, None, 0.0, str(job.error)))
+                continue
+            if len(pending) >= 2 * max_workers:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield record(future.result())
+            pending.add(executor.submit(send, job.key, job.draft))
+        for future in futures.as_completed(pending):
+            yield record(future.result())
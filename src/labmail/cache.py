@@ -0,0 +1,499 @@
+"""
+This module provides on-disk caches to skip the repeated work across processes.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import typing as t
+from collections import abc
+
+from googleapiclient import errors
+from googleapiclient import version as googleapiclient_version
+
+from labmail import _fileutils, gmail_api
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import resources, schemas
+
+logger = logging.getLogger(__name__)
+
+
+class DiscoveryCache:
+    """
+    An on-disk cache of the trimmed discovery document of Gmail API.
+
+    The cache is invalidated when the cache format, the version of
+    the Google API client or the methods used by this library change.
+
+    Parameters
+    ----------
+    cache_dir : str | os.PathLike[str]
+        The directory to store the cache in.
+
+    Examples
+    --------
+    >>> document = DiscoveryCache(cache_dir).load()
+    >>> rsc = gmail_api.build(creds, document=document)
+    """
+
+    FORMAT_VERSION = 1
+    """The version of the cache format."""
+
+    def __init__(self, cache_dir: str | os.PathLike[str]) -> None:
+        self.cache_dir = pathlib.Path(cache_dir)
+
+    @property
+    def filepath(self) -> pathlib.Path:
+        """The path to the cache file."""
+        return self.cache_dir / "discovery" / "gmail.v1.json"
+
+    @property
+    def key(self) -> dict[str, t.Any]:
+        """The key to validate the cache."""
+        return {
+            "format": self.FORMAT_VERSION,
+            "client": googleapiclient_version.__version__,
+            "methods": list(gmail_api.USED_METHODS),
+        }
+
+    def load(self) -> dict[str, t.Any]:
+        """
+        Loads the trimmed discovery document from the cache.
+
+        If the cache is missing or invalid, the document is trimmed
+        from the one bundled with the Google API client and saved to the cache.
+
+        Returns
+        -------
+        dict[str, typing.Any]
+            The trimmed discovery document.
+        """
+        try:
+            with self.filepath.open() as f:
+                cache = json.load(f)
+            if cache["key"] == self.key:
+                return t.cast("dict[str, t.Any]", cache["document"])
+            logger.info("The discovery cache is outdated")
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.info("The discovery cache is not available")
+        document = gmail_api.trim_discovery_document(gmail_api.get_discovery_document())
+        try:
+            _fileutils.write_text_atomic(
+                self.filepath, json.dumps({"key": self.key, "document": document})
+            )
+        except OSError as err:
+            logger.warning(f"Failed to save the discovery cache: {err}")
+        return document
+
+    def clear(self) -> None:
+        """Removes the cache file."""
+        self.filepath.unlink(missing_ok=True)
+
+
+class SendAsCache:
+    """
+    An on-disk cache of the sendas registered on Gmail for an account.
+
+    Parameters
+    ----------
+    cache_dir : str | os.PathLike[str]
+        The directory to store the cache in.
+    account : str
+        The identifier of the account, such as the path to the credentials.
+    ttl : float
+        The time to live of the cache in seconds.
+
+    Examples
+    --------
+    >>> sendas_cache = SendAsCache(cache_dir, account="credentials.json")
+    >>> sendas_list = sendas_cache.load()
+    >>> if sendas_list is None:
+    ...     sendas_list = gmail_api.list_sendas(rsc)
+    ...     sendas_cache.save(sendas_list)
+    """
+
+    FORMAT_VERSION = 1
+    """The version of the cache format."""
+
+    DEFAULT_TTL = 24 * 60 * 60
+    """The default time to live of the cache in seconds."""
+
+    def __init__(
+        self,
+        cache_dir: str | os.PathLike[str],
+        account: str,
+        ttl: float = DEFAULT_TTL,
+    ) -> None:
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.account = account
+        self.ttl = ttl
+
+    @property
+    def filepath(self) -> pathlib.Path:
+        """The path to the cache file."""
+        digest = hashlib.sha256(self.account.encode()).hexdigest()[:16]
+        return self.cache_dir / "sendas" / f"{digest}.json"
+
+    @property
+    def key(self) -> dict[str, t.Any]:
+        """The key to validate the cache."""
+        return {"format": self.FORMAT_VERSION, "account": self.account}
+
+    def load(self) -> list[schemas.SendAs] | None:
+        """
+        Loads the sendas from the cache.
+
+        Returns
+        -------
+        list[SendAs] | None
+            The cached SendAs objects,
+            or None if the cache is missing, invalid or expired.
+        """
+        try:
+            with self.filepath.open() as f:
+                cache = json.load(f)
+            if cache["key"] != self.key:
+                return None
+            if time.time() - cache["saved_at"] > self.ttl:
+                logger.info("The sendas cache is expired")
+                return None
+            return t.cast("list[schemas.SendAs]", cache["sendas"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, sendas_list: list[schemas.SendAs]) -> None:
+        """
+        Saves the sendas to the cache.
+
+        Parameters
+        ----------
+        sendas_list : list[SendAs]
+            The SendAs objects to save.
+        """
+        cache = {"key": self.key, "saved_at": time.time(), "sendas": sendas_list}
+        try:
+            _fileutils.write_text_atomic(self.filepath, json.dumps(cache))
+        except OSError as err:
+            logger.warning(f"Failed to save the sendas cache: {err}")
+
+    def clear(self) -> None:
+        """Removes the cache file."""
+        self.filepath.unlink(missing_ok=True)
+
+
+class SubjectIndex:
+    """
+    An on-disk index of the subjects of the messages sent from an account.
+
+    The index is stored in a SQLite database and updated incrementally:
+    `sync()` retrieves the subjects of only the messages sent since the last sync,
+    and `add()` records the subjects of the messages sent by this library.
+    The subjects are compared exactly except for consecutive whitespace,
+    unlike the search of Gmail which matches words.
+
+    The index is complete only after the first sync has scanned
+    all the sent messages, which is called the backfill.
+    The backfill can be split into the syncs scanning a limited number of
+    messages each, from the newest to the oldest, and it is resumed
+    across processes until `synced_at` is set.
+
+    The database connection is kept open and shared across threads
+    until `close()` is called.
+
+    Parameters
+    ----------
+    cache_dir : str | os.PathLike[str]
+        The directory to store the index in.
+    account : str
+        The identifier of the account, such as the path to the credentials.
+
+    Examples
+    --------
+    >>> subject_index = SubjectIndex(cache_dir, account="credentials.json")
+    >>> while subject_index.synced_at is None:
+    ...     subject_index.sync(rsc, limit=SubjectIndex.BACKFILL_LIMIT)
+    >>> subject_index.contains("Subject here")
+    False
+    """
+
+    FORMAT_VERSION = 1
+    """The version of the index format."""
+
+    SYNC_OVERLAP = 5 * 60
+    """
+    The seconds to go back from the last sync when syncing,
+    to cover the messages still being sent at the last sync and the clock skew.
+    The messages listed by the last sync are not scanned again.
+    """
+
+    BACKFILL_LIMIT = 500
+    """The number of the messages scanned per sync during the backfill by default."""
+
+    def __init__(self, cache_dir: str | os.PathLike[str], account: str) -> None:
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.account = account
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def filepath(self) -> pathlib.Path:
+        """The path to the index file."""
+        digest = hashlib.sha256(self.account.encode()).hexdigest()[:16]
+        return self.cache_dir / "subjects" / f"{digest}.sqlite3"
+
+    @property
+    def key(self) -> str:
+        """The key to validate the index."""
+        return json.dumps({"format": self.FORMAT_VERSION, "account": self.account})
+
+    @contextlib.contextmanager
+    def _connect(self) -> abc.Iterator[sqlite3.Connection]:
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._open()
+            yield self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.filepath, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS subjects (subject TEXT PRIMARY KEY)"
+                " WITHOUT ROWID"
+            )
+            # the IDs of the messages listed by the last sync
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            row = conn.execute("SELECT value FROM meta WHERE name = 'key'").fetchone()
+            if row is None or row[0] != self.key:
+                if row is not None:
+                    logger.info("The subject index is outdated")
+                conn.execute("DELETE FROM meta")
+                conn.execute("DELETE FROM subjects")
+                conn.execute("DELETE FROM listed")
+                conn.execute("INSERT INTO meta VALUES ('key', ?)", (self.key,))
+        return conn
+
+    def close(self) -> None:
+        """Closes the database connection, which is reopened on the next access."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _get_meta(self, name: str) -> float | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE name = ?", (name,)
+            ).fetchone()
+        return None if row is None else float(row[0])
+
+    @property
+    def synced_at(self) -> float | None:
+        """
+        The time of the last sync, or None if the backfill has not completed.
+        """
+        return self._get_meta("synced_at")
+
+    def contains(self, subject: str) -> bool:
+        """
+        Checks whether the subject is in the index.
+
+        Parameters
+        ----------
+        subject : str
+            The subject to check.
+
+        Returns
+        -------
+        bool
+            True if the subject is in the index.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM subjects WHERE subject = ?",
+                (_normalize_subject(subject),),
+            ).fetchone()
+        return row is not None
+
+    def add(self, subjects: abc.Iterable[str]) -> None:
+        """
+        Adds the subjects to the index.
+
+        Parameters
+        ----------
+        subjects : Iterable[str]
+            The subjects to add.
+        """
+        with self._connect() as conn, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO subjects VALUES (?)",
+                ((_normalize_subject(subject),) for subject in subjects),
+            )
+
+    def sync(
+        self,
+        rsc: resources.GmailResource,
+        user_id: str = "me",
+        *,
+        limit: int | None = None,
+    ) -> int:
+        """
+        Adds the subjects of the messages sent since the last sync to the index.
+
+        The messages listed by the last sync in the overlap of `SYNC_OVERLAP`
+        are skipped. Until the backfill completes, the sent messages older than
+        the ones scanned by the previous syncs are scanned instead.
+        The messages deleted while being scanned are skipped.
+
+        Parameters
+        ----------
+        rsc : GmailResource
+            The Resource object for interacting with Gmail API.
+        user_id : str
+            The user's email address.
+        limit : int | None
+            The maximum number of the messages to scan during the backfill.
+            If None, the backfill completes in this sync.
+            The syncs after the backfill scan all the new messages.
+
+        Returns
+        -------
+        int
+            The number of the scanned messages.
+
+        Raises
+        ------
+        googleapiclient.errors.HttpError
+            If any of the messages cannot be retrieved.
+            The subjects scanned so far are kept,
+            but the progress of the sync is not recorded then.
+        """
+        started_at = time.time()
+        synced_at = self.synced_at
+        if synced_at is None:
+            return self._backfill(rsc, user_id, started_at, limit)
+        query = f"in:sent after:{int(synced_at - self.SYNC_OVERLAP)}"
+        ids = [
+            message["id"]
+            for message in gmail_api.iter_messages(rsc, user_id, query=query)
+        ]
+        with self._connect() as conn:
+            listed = {row[0] for row in conn.execute("SELECT id FROM listed")}
+        new_ids = [id for id in ids if id not in listed]
+        self._scan(rsc, user_id, new_ids)
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM listed")
+            conn.executemany(
+                "INSERT OR IGNORE INTO listed VALUES (?)", ((id,) for id in ids)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('synced_at', ?)", (started_at,)
+            )
+        return len(new_ids)
+
+    def _backfill(
+        self,
+        rsc: resources.GmailResource,
+        user_id: str,
+        started_at: float,
+        limit: int | None,
+    ) -> int:
+        # the messages sent since the backfill started are scanned by the next sync
+        backfill_started_at = self._get_meta("backfill_started_at")
+        if backfill_started_at is None:
+            backfill_started_at = started_at
+            with self._connect() as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('backfill_started_at', ?)",
+                    (started_at,),
+                )
+        query = "in:sent"
+        before = self._get_meta("backfill_before")
+        if before is not None:
+            query += f" before:{int(before)}"
+        ids = [
+            message["id"]
+            for message in gmail_api.iter_messages(
+                rsc, user_id, query=query, limit=limit
+            )
+        ]
+        dates = self._scan(rsc, user_id, ids)
+        with self._connect() as conn, conn:
+            if limit is None or len(ids) < limit:
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('synced_at', ?)",
+                    (backfill_started_at,),
+                )
+                conn.execute(
+                    "DELETE FROM meta"
+                    " WHERE name IN ('backfill_started_at', 'backfill_before')"
+                )
+            elif dates:
+                # the messages sent in the same second as the oldest one
+                # are scanned again, unless the backfill does not progress then
+                oldest = min(dates) // 1000 + 1
+                if before is not None and oldest >= before:
+                    oldest = int(before) - 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('backfill_before', ?)",
+                    (oldest,),
+                )
+        return len(ids)
+
+    def _scan(
+        self, rsc: resources.GmailResource, user_id: str, ids: list[str]
+    ) -> list[int]:
+        """
+        Adds the subjects of the messages to the index.
+
+        Returns the internal dates of the scanned messages in milliseconds.
+        """
+        logger.info(f"Scanning the subjects of {len(ids)} sent messages")
+        subjects: list[str] = list()
+        dates: list[int] = list()
+        for id, result in gmail_api.get_messages(
+            rsc,
+            user_id,
+            ids=ids,
+            format="metadata",
+            metadata_headers=["Subject"],
+            ordered=False,
+        ):
+            if isinstance(result, errors.HttpError) and result.resp.status == 404:
+                logger.info(f"Skipped the message {id} deleted while scanning")
+                continue
+            if isinstance(result, Exception):
+                self.add(subjects)
+                raise result
+            if "internalDate" in result:
+                dates.append(int(result["internalDate"]))
+            for header in result.get("payload", dict()).get("headers", list()):
+                if header.get("name", "").lower() == "subject":
+                    subjects.append(header.get("value", ""))
+        self.add(subjects)
+        return dates
+
+    def clear(self) -> None:
+        """Removes the index file."""
+        self.close()
+        for suffix in ("", "-wal", "-shm"):
+            pathlib.Path(f"{self.filepath}{suffix}").unlink(missing_ok=True)
+
+
+def _normalize_subject(subject: str) -> str:
+    return " ".join(subject.split())
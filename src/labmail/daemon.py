@@ -0,0 +1,354 @@
+"""
+This module provides a daemon which keeps a session open and sends messages
+on requests over a Unix domain socket, and a client of it.
+
+The requests and the responses are JSON objects, one per line.
+The client does not import the Google API client,
+so that short-lived processes can send messages with a low latency.
+This module is available only on the platforms supporting Unix domain sockets,
+and the server and the client raise OSError on Windows.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import logging
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import types
+import typing as t
+from collections import abc
+
+from labmail.text_utils import TextType
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+    from labmail.session import Session
+
+logger = logging.getLogger(__name__)
+
+UNSUPPORTED_MESSAGE = "The daemon is not supported on Windows"
+"""The message of the error raised on the platforms without Unix domain sockets."""
+
+if sys.platform != "win32":
+    _UnixStreamServer = socketserver.UnixStreamServer
+else:  # pragma: no cover
+    _UnixStreamServer = socketserver.BaseServer
+
+
+class DaemonError(Exception):
+    """
+    If the daemon fails to handle a request.
+
+    Attributes
+    ----------
+    type : str
+        The name of the type of the error raised in the daemon,
+        such as "SubjectUsedError".
+    """
+
+    def __init__(self, type: str, message: str) -> None:
+        super().__init__(message)
+        self.type = type
+
+
+def is_running(filepath: str | os.PathLike[str]) -> bool:
+    """
+    Checks whether a daemon is listening on the socket.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the socket.
+
+    Returns
+    -------
+    bool
+        True if a daemon accepts a connection.
+    """
+    if sys.platform == "win32":  # pragma: no cover
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(os.fspath(filepath))
+        except OSError:
+            return False
+    return True
+
+
+class Server(socketserver.ThreadingMixIn, _UnixStreamServer):
+    """
+    A daemon which sends messages with a session on requests.
+
+    The socket is created to be accessible only by the owner,
+    and removed when the server is closed.
+
+    Parameters
+    ----------
+    session : labmail.Session
+        The open session to send messages with. It must be thread-safe.
+    filepath : str | os.PathLike[str]
+        The path to the socket.
+    account : str | None
+        The identifier of the account of the session,
+        such as the resolved path to the credentials.
+
+    Raises
+    ------
+    RuntimeError
+        If another daemon is listening on the socket.
+    OSError
+        If the platform is Windows.
+
+    Examples
+    --------
+    >>> with labmail.Session(thread_safe=True) as session:
+    ...     with Server(session, "labmail.sock") as server:
+    ...         server.serve_forever()
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        session: Session,
+        filepath: str | os.PathLike[str],
+        *,
+        account: str | None = None,
+    ) -> None:
+        self.session = session
+        self.filepath = pathlib.Path(filepath)
+        self.account = account
+        if sys.platform == "win32":  # pragma: no cover
+            raise OSError(UNSUPPORTED_MESSAGE)
+        if is_running(self.filepath):
+            raise RuntimeError(f"Another daemon is running on {self.filepath}")
+        self.filepath.unlink(missing_ok=True)
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        umask = os.umask(0o077)
+        try:
+            super().__init__(os.fspath(self.filepath), _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.filepath.unlink(missing_ok=True)
+
+    def dispatch(self, request: t.Any) -> t.Any:
+        """
+        Handles a request.
+
+        Parameters
+        ----------
+        request : typing.Any
+            The decoded request.
+
+        Returns
+        -------
+        typing.Any
+            The result of the request.
+
+        Raises
+        ------
+        ValueError
+            If the request is invalid.
+        """
+        if not isinstance(request, dict):
+            raise ValueError("The request is not a JSON object")
+        match request.get("method"):
+            case "info":
+                return {"account": self.account, "pid": os.getpid()}
+            case "send":
+                params = dict(request.get("params", dict()))
+                params["text_type"] = TextType(params.get("text_type", "plain"))
+                return self.session.send(**params)
+            case method:
+                raise ValueError(f"Unknown method: {method}")
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: Server
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                response = {"result": self.server.dispatch(json.loads(line))}
+            except Exception as err:
+                logger.warning(f"Failed to handle a request: {err}")
+                response = {"error": {"type": type(err).__name__, "message": str(err)}}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class Client:
+    """
+    A client of the daemon.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the socket of the daemon.
+
+    Examples
+    --------
+    >>> with Client("labmail.sock").connect() as client:
+    ...     client.send("foo@example.com", "Body text here", "Subject here")
+    """
+
+    def __init__(self, filepath: str | os.PathLike[str]) -> None:
+        self.filepath = pathlib.Path(filepath)
+        self._sock: socket.socket | None = None
+        self._file: io.BufferedRWPair | None = None
+
+    def __enter__(self) -> Client:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def connect(self) -> Client:
+        """
+        Connects to the daemon.
+
+        Returns
+        -------
+        labmail.daemon.Client
+            The client itself.
+
+        Raises
+        ------
+        OSError
+            If the daemon is not running, or the platform is Windows.
+        """
+        if sys.platform == "win32":  # pragma: no cover
+            raise OSError(UNSUPPORTED_MESSAGE)
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(os.fspath(self.filepath))
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+            self._file = sock.makefile("rwb")
+        return self
+
+    def close(self) -> None:
+        """Closes the connection."""
+        if self._file is not None:
+            # flushing the unsent data fails if the daemon has gone
+            with contextlib.suppress(OSError):
+                self._file.close()
+            self._file = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def request(self, method: str, params: dict[str, t.Any] | None = None) -> t.Any:
+        """
+        Sends a request to the daemon and waits for the response.
+
+        Parameters
+        ----------
+        method : str
+            The method to call.
+        params : dict[str, typing.Any] | None
+            The parameters of the method.
+
+        Returns
+        -------
+        typing.Any
+            The result of the request.
+
+        Raises
+        ------
+        labmail.daemon.DaemonError
+            If the daemon fails to handle the request.
+        ConnectionError
+            If the connection is closed by the daemon.
+        """
+        file = t.cast(io.BufferedRWPair, self.connect()._file)
+        request = {"method": method, "params": params or dict()}
+        file.write(json.dumps(request).encode() + b"\n")
+        file.flush()
+        line = file.readline()
+        if not line:
+            raise ConnectionError("The connection is closed by the daemon")
+        response = json.loads(line)
+        if "error" in response:
+            raise DaemonError(response["error"]["type"], response["error"]["message"])
+        return response["result"]
+
+    def info(self) -> dict[str, t.Any]:
+        """
+        Gets the information of the daemon.
+
+        Returns
+        -------
+        dict[str, typing.Any]
+            The account of the session and the process ID of the daemon.
+        """
+        return t.cast("dict[str, t.Any]", self.request("info"))
+
+    def send(
+        self,
+        recipient: str | list[str],
+        body: str = "",
+        subject: str = "",
+        *,
+        text_type: TextType = TextType.PLAIN,
+        headers: dict[str, str] | None = None,
+        disallow_same_subjects: bool = False,
+        sendas_address: str | None = None,
+        attachments: abc.Sequence[str | os.PathLike[str]] | None = None,
+        dry_run: bool = False,
+    ) -> schemas.Message | None:
+        """
+        Sends a message via Gmail through the daemon.
+
+        See `labmail.send()` for the parameters.
+        The paths to the attachments are resolved to absolute ones,
+        since the daemon may run in another working directory.
+
+        Returns
+        -------
+        Message | None
+            The sent Message object, or None for dry-run mode.
+
+        Raises
+        ------
+        labmail.daemon.DaemonError
+            If the daemon fails to send the message.
+            Its `type` is "SubjectUsedError" if the subject has been already used.
+        """
+        return t.cast(
+            "schemas.Message | None",
+            self.request(
+                "send",
+                {
+                    "recipient": recipient,
+                    "body": body,
+                    "subject": subject,
+                    "text_type": text_type.value,
+                    "headers": headers,
+                    "disallow_same_subjects": disallow_same_subjects,
+                    "sendas_address": sendas_address,
+                    "attachments": [
+                        os.fspath(pathlib.Path(filepath).resolve())
+                        for filepath in attachments or []
+                    ],
+                    "dry_run": dry_run,
+                },
+            ),
+        )
@@ -3,21 +3,79 @@ from __future__ import annotations
 import base64
 import contextlib
 import email.mime.base as mime_base
+import functools
+import io
+import json
+import logging
 import os
-import pathlib
+import tempfile
+import threading
+import time
 import typing as t
+import weakref
 from collections import abc
+from concurrent import futures
 
+import google_auth_httplib2
 from google.auth.transport import requests
 from google.oauth2 import credentials as _credentials
-from google_auth_oauthlib import flow
-from googleapiclient import discovery
+from googleapiclient import discovery, discovery_cache, errors, http
 
-from labmail import _env
+from labmail import _env, _fileutils, mime, retry, timing
 
 if t.TYPE_CHECKING:  # pragma: no cover
     from googleapiclient._apis.gmail.v1 import resources, schemas
 
+BATCH_SIZE_LIMIT = 100
+"""The maximum number of calls in a batch request of Gmail API."""
+
+MAX_QUERY_LENGTH = 2048
+"""The maximum length of a search query built by `find_subjects()`."""
+
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+"""The bytes of a chunk uploaded at a time by `upload_message()`."""
+
+RETRIABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+"""The HTTP statuses of the responses that can be retried."""
+
+RATE_LIMIT_REASONS = frozenset(["rateLimitExceeded", "userRateLimitExceeded"])
+"""The error reasons of Gmail API for exceeding the rate limits."""
+
+USED_METHODS = (
+    "users.messages.list",
+    "users.messages.get",
+    "users.messages.send",
+    "users.settings.sendAs.list",
+)
+"""The methods of Gmail API used by this library."""
+
+retry_policy: retry.RetryPolicy | None = retry.RetryPolicy()
+"""
+The policy to retry the requests failed with retriable errors
+(see `is_retriable_error()`). If None, the requests are not retried
+except for the messages in batch requests.
+The requests to send messages are retried only when throttled,
+since the messages might have been sent if the server failed.
+"""
+
+concurrency = retry.AIMDController()
+"""
+The controller of the concurrent requests to Gmail API in the process.
+The limit is decreased when a request fails with a retriable error,
+i.e. it is throttled or the server is overloaded.
+"""
+
+logger = logging.getLogger(__name__)
+
+# the Resource objects built with thread_safe=True
+_thread_safe_resources: weakref.WeakSet[t.Any] = weakref.WeakSet()
+
+_R_co = t.TypeVar("_R_co", covariant=True)
+
+
+class _Request(t.Protocol[_R_co]):
+    def execute(self) -> _R_co: ...
+
 
 def get_default_config() -> dict[str, t.Any]:
     """
@@ -74,6 +132,8 @@ def new_credentials(
     google.oauth2.credentials.Credentials
         A new OAuth 2.0 credentials.
     """
+    from google_auth_oauthlib import flow
+
     if client_config is None:
         client_config = get_default_config()
     if scopes is None:
@@ -123,7 +183,7 @@ def save_credentials(
     creds: _credentials.Credentials, filepath: str | os.PathLike[str]
 ) -> None:
     """
-    Saves the Credentials object to the file.
+    Saves the Credentials object to the file atomically.
 
     Parameters
     ----------
@@ -132,10 +192,7 @@ def save_credentials(
     filepath : str | os.PathLike[str]
         The path to save the credentials.
     """
-    filepath = pathlib.Path(filepath)
-    filepath.parent.mkdir(parents=True, exist_ok=True)
-    with filepath.open("w") as f:
-        f.write(creds.to_json())  # type: ignore[no-untyped-call]
+    _fileutils.write_text_atomic(filepath, creds.to_json())  # type: ignore[no-untyped-call]
 
 
 @contextlib.contextmanager
@@ -164,21 +221,140 @@ def credentials(
     >>> with credentials() as creds:
     ...     rsc = build(creds)
 
-    The credentials will be saved to `filepath` when exiting the `with` context.
+    The credentials will be saved to `filepath` when exiting the `with` context
+    if they have been changed.
 
     Notes
     -----
     The credentials won't be saved if any exception happens in the `with` context.
+
+    Loading, refreshing and saving the credentials are done while holding
+    an advisory lock on `filepath` + ".lock", so that parallel processes
+    neither refresh the same token at once nor corrupt the file.
     """
-    try:
-        creds = load_credentials(filepath, scopes)
-    except (ValueError, FileNotFoundError):
+    lock_filepath = f"{os.fspath(filepath)}.lock"
+    creds: _credentials.Credentials | None = None
+    with _fileutils.file_lock(lock_filepath):
+        saved_json = _fileutils.read_text_or_none(filepath)
+        try:
+            creds = load_credentials(filepath, scopes)
+        except (ValueError, FileNotFoundError):
+            pass
+        else:
+            # Save the refreshed token before the other processes load it
+            creds_json = creds.to_json()  # type: ignore[no-untyped-call]
+            if creds_json != saved_json:
+                save_credentials(creds, filepath)
+                saved_json = creds_json
+    if creds is None:
         creds = new_credentials(scopes=scopes)
     yield creds
-    save_credentials(creds, filepath)
+    if creds.to_json() != saved_json:  # type: ignore[no-untyped-call]
+        with _fileutils.file_lock(lock_filepath):
+            save_credentials(creds, filepath)
 
 
-def build(creds: _credentials.Credentials) -> resources.GmailResource:
+@functools.cache
+def get_discovery_document() -> dict[str, t.Any]:
+    """
+    Gets the discovery document of Gmail API bundled with the Google API client.
+
+    The document is parsed only once per process.
+    Do not modify the returned dict, which is shared across callers.
+
+    Returns
+    -------
+    dict[str, typing.Any]
+        The parsed discovery document.
+    """
+    content = discovery_cache.get_static_doc("gmail", "v1")  # type: ignore[no-untyped-call]
+    if content is None:  # pragma: no cover
+        raise FileNotFoundError("The discovery document of Gmail API is not found")
+    return json.loads(content)  # type: ignore[no-any-return]
+
+
+def trim_discovery_document(
+    document: dict[str, t.Any],
+    methods: abc.Iterable[str] = USED_METHODS,
+) -> dict[str, t.Any]:
+    """
+    Trims the discovery document down to the methods and the schemas they refer.
+
+    The descriptions are also removed since they are only used for docstrings.
+
+    Parameters
+    ----------
+    document : dict[str, typing.Any]
+        The parsed discovery document.
+    methods : Iterable[str]
+        The dotted paths of the methods to keep such as "users.messages.send".
+
+    Returns
+    -------
+    dict[str, typing.Any]
+        The trimmed discovery document.
+
+    Raises
+    ------
+    KeyError
+        If any of the methods is not found in the document.
+    """
+    trimmed = {
+        key: value
+        for key, value in document.items()
+        if key not in ("resources", "schemas")
+    }
+    refs: set[str] = set()
+    for method_path in methods:
+        *resource_names, method_name = method_path.split(".")
+        src, dst = document, trimmed
+        for name in resource_names:
+            src = src["resources"][name]
+            dst = dst.setdefault("resources", dict()).setdefault(name, dict())
+        method = src["methods"][method_name]
+        dst.setdefault("methods", dict())[method_name] = method
+        refs.update(_find_refs(method))
+    schemas: dict[str, t.Any] = dict()
+    while refs:
+        ref = refs.pop()
+        if ref not in schemas:
+            schemas[ref] = document["schemas"][ref]
+            refs.update(_find_refs(schemas[ref]))
+    trimmed["schemas"] = schemas
+    return t.cast("dict[str, t.Any]", _strip_descriptions(trimmed))
+
+
+def _find_refs(obj: t.Any) -> abc.Iterator[str]:
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == "$ref" and isinstance(value, str):
+                yield value
+            else:
+                yield from _find_refs(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            yield from _find_refs(value)
+
+
+def _strip_descriptions(obj: t.Any) -> t.Any:
+    if isinstance(obj, dict):
+        return {
+            key: _strip_descriptions(value)
+            for key, value in obj.items()
+            if not (key == "description" and isinstance(value, str))
+        }
+    if isinstance(obj, list):
+        return [_strip_descriptions(value) for value in obj]
+    return obj
+
+
+def build(
+    creds: _credentials.Credentials,
+    *,
+    thread_safe: bool = False,
+    document: dict[str, t.Any] | None = None,
+    root_url: str | None = None,
+) -> resources.GmailResource:
     """
     Constructs a new GmailResource object to request to Gmail API.
 
@@ -186,13 +362,82 @@ def build(creds: _credentials.Credentials) -> resources.GmailResource:
     ----------
     creds : google.oauth2.credentials.Credentials
         The credentials for Gmail API.
+    thread_safe : bool
+        If true, the requests are executed with an HTTP connection per thread,
+        so that the Resource object can be shared across threads.
+    document : dict[str, typing.Any] | None
+        The parsed discovery document to build the Resource object from.
+        If None, the discovery document is loaded by the Google API client.
+    root_url : str | None
+        The root URL to request to instead of Gmail API,
+        such as the one of `labmail.testing.FakeGmailServer`.
+        If None, the environment variable LABMAIL_GMAIL_API_ROOT_URL is used if set.
 
     Returns
     -------
     GmailResource
         The Resource object for interacting with Gmail API.
     """
-    return discovery.build(serviceName="gmail", version="v1", credentials=creds)
+    request_builder: abc.Callable[..., http.HttpRequest] = http.HttpRequest
+    if thread_safe:
+        request_builder = _thread_local_request_builder(creds)
+    if root_url is None:
+        root_url = _env.GMAIL_API_ROOT_URL
+    if root_url is not None:
+        # client_options.api_endpoint is not applied to the batch and upload URLs
+        document = dict(document or get_discovery_document(), rootUrl=root_url)
+    if document is not None:
+        rsc = discovery.build_from_document(  # type: ignore[attr-defined]
+            document, credentials=creds, requestBuilder=request_builder
+        )
+    elif not thread_safe:
+        rsc = discovery.build(serviceName="gmail", version="v1", credentials=creds)
+    else:
+        rsc = discovery.build(
+            serviceName="gmail",
+            version="v1",
+            credentials=creds,
+            requestBuilder=request_builder,
+        )
+    if thread_safe:
+        _thread_safe_resources.add(rsc)
+    return t.cast("resources.GmailResource", rsc)
+
+
+def is_thread_safe(rsc: resources.GmailResource) -> bool:
+    """
+    Determines whether the Resource object can be shared across threads.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+
+    Returns
+    -------
+    bool
+        True if the Resource object is built by `build()` with `thread_safe=True`.
+    """
+    return rsc in _thread_safe_resources
+
+
+def _thread_local_request_builder(
+    creds: _credentials.Credentials,
+) -> abc.Callable[..., http.HttpRequest]:
+    local = threading.local()
+
+    def request_builder(
+        _http: t.Any, *args: t.Any, **kwargs: t.Any
+    ) -> http.HttpRequest:
+        # httplib2.Http is not thread-safe, so each thread has its own one
+        if not hasattr(local, "http"):
+            local.http = google_auth_httplib2.AuthorizedHttp(
+                creds,
+                http=http.build_http(),  # type: ignore[no-untyped-call]
+            )
+        return http.HttpRequest(local.http, *args, **kwargs)
+
+    return request_builder
 
 
 def list_message(
@@ -240,7 +485,7 @@ def list_message(
     --------
     https://developers.google.com/gmail/api/reference/rest/v1/users.messages/list
     """
-    response = (
+    response = _execute(
         rsc.users()
         .messages()
         .list(
@@ -251,7 +496,6 @@ def list_message(
             labelIds=label_ids or [],
             includeSpamTrash=include_spam_trash,
         )
-        .execute()
     )
     return (
         response.get("messages", list()),
@@ -260,6 +504,107 @@ def list_message(
     )
 
 
+def iter_messages(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+    *,
+    query: str = "",
+    limit: int | None = None,
+    page_size: int = 100,
+    label_ids: list[str] | None = None,
+    include_spam_trash: bool = False,
+    prefetch: bool | None = None,
+) -> abc.Generator[schemas.Message, None, None]:
+    """
+    Iterates over the messages in the user's mailbox of Gmail page by page.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+    query : str
+        The same query format as that of the Gmail search box.
+    limit : int | None
+        The maximum number of messages to yield in total.
+        If None, all the messages matching the query are yielded.
+    page_size : int
+        The maximum number of messages to retrieve per request.
+    label_ids : list[str] | None
+        The list of label IDs of messages to retrieve.
+    include_spam_trash : bool
+        If true, messages from SPAM and TRASH are included in the results.
+    prefetch : bool | None
+        If true, the next page is retrieved in a background thread
+        while the current page is being consumed.
+        At most two pages are held in memory.
+        If None, the pages are prefetched only if `rsc` is thread-safe
+        (see `is_thread_safe()`).
+
+    Yields
+    ------
+    Message
+        The Message objects, which only have the IDs and the thread IDs.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/users.messages#Message
+        for Message.
+
+    Notes
+    -----
+    The background thread requests Gmail API with `rsc`, so do not enable
+    `prefetch` for `rsc` built without `thread_safe=True` if you request
+    Gmail API with it while iterating, since httplib2 is not thread-safe.
+
+    Examples
+    --------
+    >>> for message in iter_messages(rsc, query="in:sent", limit=1000):
+    ...     print(message["id"])
+    """
+
+    def fetch(
+        page_token: str, max_results: int
+    ) -> tuple[list[schemas.Message], str, int]:
+        return list_message(
+            rsc,
+            user_id,
+            query=query,
+            max_results=max_results,
+            page_token=page_token,
+            label_ids=label_ids,
+            include_spam_trash=include_spam_trash,
+        )
+
+    def page_size_for(remaining: int | None) -> int:
+        return page_size if remaining is None else min(page_size, remaining)
+
+    if limit is not None and limit <= 0:
+        return
+    if prefetch is None:
+        prefetch = is_thread_safe(rsc)
+    remaining = limit
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if prefetch:
+            executor = stack.enter_context(futures.ThreadPoolExecutor(1))
+        future: futures.Future[tuple[list[schemas.Message], str, int]] | None = None
+        page_token = ""
+        while True:
+            if future is None:
+                messages, page_token, _ = fetch(page_token, page_size_for(remaining))
+            else:
+                messages, page_token, _ = future.result()
+            if remaining is not None:
+                messages = messages[:remaining]
+                remaining -= len(messages)
+            has_next = bool(page_token) and remaining != 0
+            future = None
+            if has_next and executor is not None:
+                future = executor.submit(fetch, page_token, page_size_for(remaining))
+            yield from messages
+            if not has_next:
+                return
+
+
 def get_message(
     rsc: resources.GmailResource,
     user_id: str = "me",
@@ -293,12 +638,196 @@ def get_message(
     --------
     https://developers.google.com/gmail/api/reference/rest/v1/users.messages/get
     """
-    response = (
-        rsc.users().messages().get(userId=user_id, id=id, format=format).execute()
+    response = _execute(
+        rsc.users().messages().get(userId=user_id, id=id, format=format)
     )
     return response
 
 
+def get_messages(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+    *,
+    ids: abc.Sequence[str],
+    format: t.Literal["minimal", "full", "raw", "metadata"] = "full",
+    metadata_headers: abc.Sequence[str] | None = None,
+    batch_size: int = 50,
+    max_retries: int = 3,
+    ordered: bool = True,
+) -> abc.Generator[tuple[str, schemas.Message | errors.HttpError], None, None]:
+    """
+    Gets messages in the mailbox of Gmail with batch requests.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+    ids : Sequence[str]
+        The IDs of the messages to retrieve.
+    format : Literal["minimal", "full", "raw", "metadata"]
+        The format to return the messages in.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/Format.
+    metadata_headers : Sequence[str] | None
+        The headers to include when `format` is "metadata".
+    batch_size : int
+        The number of messages in a batch request.
+        It must be between 1 and `BATCH_SIZE_LIMIT`.
+    max_retries : int
+        The maximum number of times to retry the failed messages.
+        The messages failed with retriable errors (see `is_retriable_error()`)
+        are retried in batch requests of the half size of the previous ones,
+        and returned as the errors only after the retries are exhausted
+        or `retry_policy.max_elapsed` has passed.
+    ordered : bool
+        Whether to yield the messages in the order of `ids`.
+        If False, the messages are yielded as soon as
+        the batch request including them completes.
+
+    Yields
+    ------
+    tuple[str, Message | googleapiclient.errors.HttpError]
+        The ID of the message and the retrieved Message object or the error.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/users.messages#Message
+        for Message.
+
+    Raises
+    ------
+    ValueError
+        If `batch_size` is out of range.
+
+    Examples
+    --------
+    >>> ids = [message["id"] for message in iter_messages(rsc, query="in:sent")]
+    >>> for id, message in get_messages(rsc, ids=ids, format="metadata"):
+    ...     print(id, message)
+
+    See Also
+    --------
+    https://developers.google.com/gmail/api/guides/batch
+    """
+    kwargs: dict[str, t.Any] = dict(userId=user_id, format=format)
+    if metadata_headers is not None:
+        kwargs["metadataHeaders"] = list(metadata_headers)
+    results = _execute_batches(
+        rsc,
+        lambda idx: rsc.users().messages().get(id=ids[idx], **kwargs),
+        len(ids),
+        batch_size=batch_size,
+        max_retries=max_retries,
+    )
+    if not ordered:
+        for idx, result in results:
+            yield ids[idx], result
+        return
+    buffer: dict[int, schemas.Message | errors.HttpError] = dict()
+    next_idx = 0
+    for idx, result in results:
+        buffer[idx] = result
+        while next_idx in buffer:
+            yield ids[next_idx], buffer.pop(next_idx)
+            next_idx += 1
+
+
+def find_subjects(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+    *,
+    subjects: abc.Iterable[str],
+    query: str = "in:sent",
+    max_terms: int = 50,
+    max_query_length: int = MAX_QUERY_LENGTH,
+) -> set[str]:
+    """
+    Finds the subjects used by the messages in the user's mailbox of Gmail.
+
+    The subjects are searched with the queries OR-ing up to `max_terms`
+    subjects each, and the subjects of the matched messages are retrieved
+    with batch requests, so that many subjects cost a few requests.
+    Unlike the search on Gmail, the subjects must match exactly
+    except for the whitespace.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+    subjects : Iterable[str]
+        The subjects to find.
+    query : str
+        The query to narrow the messages to search, such as "in:sent".
+    max_terms : int
+        The maximum number of subjects in a search query.
+    max_query_length : int
+        The maximum length of a search query.
+
+    Returns
+    -------
+    set[str]
+        The subjects in `subjects` used by any of the messages.
+
+    Raises
+    ------
+    googleapiclient.errors.HttpError
+        If any of the messages cannot be retrieved.
+
+    Examples
+    --------
+    >>> find_subjects(rsc, subjects=["Weekly report 1", "Weekly report 2"])
+    {'Weekly report 1'}
+    """
+    candidates: dict[str, set[str]] = dict()
+    for subject in subjects:
+        candidates.setdefault(" ".join(subject.split()), set()).add(subject)
+    if not candidates:
+        return set()
+
+    # Gmail does not support escaping the double quotes in a phrase,
+    # so they are removed from the terms and the subjects are matched locally
+    terms: list[str] = list()
+    for subject in candidates:
+        phrase = subject.replace('"', "")
+        terms.append(f'subject:("{phrase}")')
+    queries: list[str] = list()
+    chunk: list[str] = list()
+    for term in terms:
+        if chunk and (
+            len(chunk) >= max_terms
+            or len(query) + len(" ()") + len(" OR ".join([*chunk, term]))
+            > max_query_length
+        ):
+            queries.append(f"{query} ({' OR '.join(chunk)})")
+            chunk = list()
+        chunk.append(term)
+    queries.append(f"{query} ({' OR '.join(chunk)})")
+    logger.info(f"Searching {len(candidates)} subjects with {len(queries)} queries")
+
+    ids: dict[str, None] = dict()
+    for chunk_query in queries:
+        for message in iter_messages(rsc, user_id, query=chunk_query, prefetch=False):
+            ids[message["id"]] = None
+    found: set[str] = set()
+    for _, result in get_messages(
+        rsc,
+        user_id,
+        ids=list(ids),
+        format="metadata",
+        metadata_headers=["Subject"],
+        ordered=False,
+    ):
+        if isinstance(result, errors.HttpError) and result.resp.status == 404:
+            # deleted after the search
+            continue
+        if isinstance(result, Exception):
+            raise result
+        for header in result["payload"]["headers"]:
+            if header["name"].lower() == "subject":
+                found.update(candidates.get(" ".join(header["value"].split()), ()))
+    return found
+
+
 def send_message(
     rsc: resources.GmailResource,
     user_id: str = "me",
@@ -308,6 +837,10 @@ def send_message(
     """
     Sends a message via Gmail.
 
+    The message with `labmail.mime.FileAttachment` or `labmail.mime.StreamedText`
+    is written to a temporary file and sent by `upload_message()`,
+    so that the attachments and the body are not loaded into memory.
+
     Parameters
     ----------
     rsc : GmailResource
@@ -328,13 +861,382 @@ def send_message(
     --------
     https://developers.google.com/gmail/api/reference/rest/v1/users.messages/send
     """
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    response = (
-        rsc.users().messages().send(userId=user_id, body={"raw": raw_message}).execute()
+    if mime.has_streamed_parts(message):
+        with tempfile.TemporaryFile() as f:
+            with timing.phase(timing.Phase.ENCODE):
+                mime.write_message(message, f)
+                f.seek(0)
+            return upload_message(rsc, user_id, fd=f)
+    with timing.phase(timing.Phase.ENCODE):
+        raw = encode_message(message)
+    return send_raw_message(rsc, user_id, raw=raw)
+
+
+def upload_message(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+    *,
+    fd: t.IO[bytes],
+    chunk_size: int = UPLOAD_CHUNK_SIZE,
+) -> schemas.Message:
+    """
+    Sends a message read from a file via Gmail with a resumable media upload.
+
+    The message is uploaded chunk by chunk, and only one chunk is held in memory.
+    An interrupted upload is resumed from the last uploaded chunk on retries.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+    fd : typing.IO[bytes]
+        The seekable binary file of the message in the RFC 2822 format,
+        such as written by `labmail.mime.write_message()`.
+    chunk_size : int
+        The bytes of a chunk. It must be a multiple of 256 KiB.
+
+    Returns
+    -------
+    Message
+        The sent Message object.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/users.messages#Message
+        for Message.
+
+    See Also
+    --------
+    https://developers.google.com/gmail/api/guides/uploads
+    """
+    media = http.MediaIoBaseUpload(
+        t.cast(io.IOBase, fd),
+        mimetype="message/rfc822",
+        chunksize=chunk_size,
+        resumable=True,
     )
+    with timing.phase(timing.Phase.HTTP):
+        # a retry asks the server for the status of the upload first,
+        # so the message is not sent again even if the last chunk failed
+        response = _execute(
+            rsc.users().messages().send(userId=user_id, media_body=media)
+        )
     return response
 
 
+def send_raw_message(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+    *,
+    raw: str,
+) -> schemas.Message:
+    """
+    Sends a message encoded by `encode_message()` via Gmail.
+
+    The request is retried only when throttled. If the server fails with
+    a server error, the message might have been sent, so the error is raised
+    for the caller to look up the message, e.g. by its Message-ID
+    with `rfc822msgid:`, before sending it again.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+    raw : str
+        The encoded message to send.
+
+    Returns
+    -------
+    Message
+        The sent Message object.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/users.messages#Message
+        for Message.
+
+    See Also
+    --------
+    https://developers.google.com/gmail/api/reference/rest/v1/users.messages/send
+    """
+    with timing.phase(timing.Phase.HTTP):
+        response = _execute(
+            rsc.users().messages().send(userId=user_id, body={"raw": raw}),
+            idempotent=False,
+        )
+    return response
+
+
+def send_messages(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+    *,
+    messages: abc.Sequence[mime_base.MIMEBase],
+    batch_size: int = 50,
+    max_retries: int = 3,
+) -> list[schemas.Message | errors.HttpError]:
+    """
+    Sends messages via Gmail with batch requests.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+    messages : Sequence[email.mime.base.MIMEBase]
+        The messages to send.
+    batch_size : int
+        The number of messages in a batch request.
+        It must be between 1 and `BATCH_SIZE_LIMIT`.
+    max_retries : int
+        The maximum number of times to retry the failed messages.
+        Only the messages throttled by the rate limits (see `is_rate_limit_error()`)
+        are retried, in batch requests of the half size of the previous ones.
+        The messages failed with server errors might have been sent,
+        so they are returned as the errors without retries.
+
+    Returns
+    -------
+    list[Message | googleapiclient.errors.HttpError]
+        The sent Message objects or the errors, in the order of `messages`.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/users.messages#Message
+        for Message.
+
+    Raises
+    ------
+    ValueError
+        If `batch_size` is out of range.
+
+    See Also
+    --------
+    https://developers.google.com/gmail/api/guides/batch
+    """
+    results: dict[int, schemas.Message | errors.HttpError] = dict()
+    for idx, result in _execute_batches(
+        rsc,
+        lambda idx: rsc.users()
+        .messages()
+        .send(userId=user_id, body={"raw": encode_message(messages[idx])}),
+        len(messages),
+        batch_size=batch_size,
+        max_retries=max_retries,
+        idempotent=False,
+    ):
+        results[idx] = result
+    return [results[idx] for idx in range(len(messages))]
+
+
+def _execute_batches(
+    rsc: resources.GmailResource,
+    build_request: abc.Callable[[int], http.HttpRequest],
+    count: int,
+    *,
+    batch_size: int,
+    max_retries: int,
+    idempotent: bool = True,
+) -> abc.Generator[tuple[int, t.Any], None, None]:
+    """
+    Executes requests with batch requests and retries the failed ones.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    build_request : Callable[[int], googleapiclient.http.HttpRequest]
+        The function to build the request from its index.
+    count : int
+        The number of the requests.
+    batch_size : int
+        The number of requests in a batch request.
+        It must be between 1 and `BATCH_SIZE_LIMIT`.
+    max_retries : int
+        The maximum number of times to retry the failed requests.
+        Only the requests failed with retriable errors are retried,
+        in batch requests of the half size of the previous ones,
+        after the delay of `retry_policy` within its `max_elapsed`.
+        A batch request failed as a whole is retried according to `retry_policy`.
+    idempotent : bool
+        Whether the requests are idempotent. If false, the requests and
+        the batch requests are retried only when throttled,
+        since the server might have processed them before failing.
+
+    Yields
+    ------
+    tuple[int, typing.Any]
+        The index of the request and its response or error,
+        as soon as the batch request including it completes.
+
+    Raises
+    ------
+    ValueError
+        If `batch_size` is out of range.
+    """
+    if not 0 < batch_size <= BATCH_SIZE_LIMIT:
+        raise ValueError(f"batch_size must be between 1 and {BATCH_SIZE_LIMIT}")
+    policy = retry_policy or retry.RetryPolicy()
+    started_at = time.monotonic()
+    pending = list(range(count))
+    failed: dict[int, errors.HttpError] = dict()
+    retry_afters: list[float] = list()
+    for retry_num in range(max_retries + 1):
+        if retry_num > 0:
+            delay = policy.delay(retry_num, max(retry_afters, default=None))
+            if time.monotonic() - started_at + delay > policy.max_elapsed:
+                logger.warning(f"Giving up retrying {len(pending)} requests")
+                yield from sorted(failed.items())
+                return
+            logger.warning(f"Retrying {len(pending)} requests in {delay:.1f} seconds")
+            time.sleep(delay)
+            batch_size = max(batch_size // 2, 1)
+        failed = dict()
+        retry_afters = list()
+        for start in range(0, len(pending), batch_size):
+            done: list[tuple[int, t.Any]] = list()
+            throttled: list[int] = list()
+
+            def callback(
+                request_id: str,
+                response: t.Any,
+                exception: errors.HttpError | None,
+            ) -> None:
+                idx = int(request_id)
+                if exception is None:
+                    done.append((idx, response))
+                    return
+                if is_retriable_error(exception):
+                    throttled.append(idx)
+                if _can_retry(exception, idempotent) and retry_num < max_retries:
+                    failed[idx] = exception
+                    retry_after = _get_retry_after(exception)
+                    if retry_after is not None:
+                        retry_afters.append(retry_after)
+                else:
+                    done.append((idx, exception))
+
+            batch = rsc.new_batch_http_request(callback=callback)
+            for idx in pending[start : start + batch_size]:
+                batch.add(build_request(idx), request_id=str(idx))
+            # the batch request itself is retried as a request
+            _execute(batch, idempotent=idempotent)
+            if throttled:
+                concurrency.on_throttle()
+            yield from done
+        if not failed:
+            break
+        pending = sorted(failed)
+
+
+def _execute(request: _Request[_R_co], *, idempotent: bool = True) -> _R_co:
+    """
+    Executes a request holding a slot of `concurrency`,
+    and retries it on retriable errors according to `retry_policy`.
+
+    A request which is not idempotent is retried only when throttled,
+    since the server might have processed it before failing.
+    """
+    start = time.monotonic()
+    retry_num = 0
+    while True:
+        with concurrency:
+            try:
+                response = request.execute()
+            except errors.HttpError as err:
+                if is_retriable_error(err):
+                    concurrency.on_throttle()
+                if (
+                    retry_policy is None
+                    or retry_num >= retry_policy.max_retries
+                    or not _can_retry(err, idempotent)
+                ):
+                    raise
+                delay = retry_policy.delay(retry_num + 1, _get_retry_after(err))
+                if time.monotonic() - start + delay > retry_policy.max_elapsed:
+                    raise
+                error = err
+            else:
+                concurrency.on_success()
+                return response
+        retry_num += 1
+        logger.warning(f"Retrying in {delay:.1f} seconds: {error}")
+        time.sleep(delay)
+
+
+def _can_retry(error: errors.HttpError, idempotent: bool) -> bool:
+    if idempotent:
+        return is_retriable_error(error)
+    return is_rate_limit_error(error)
+
+
+def _get_retry_after(error: errors.HttpError) -> float | None:
+    return retry.parse_retry_after(error.resp.get("retry-after"))
+
+
+def is_retriable_error(error: errors.HttpError) -> bool:
+    """
+    Determines whether the request failed with the error can be retried.
+
+    Parameters
+    ----------
+    error : googleapiclient.errors.HttpError
+        The error of the failed request.
+
+    Returns
+    -------
+    bool
+        True if the error is caused by the rate limits or a server error.
+    """
+    return error.resp.status in RETRIABLE_STATUSES or is_rate_limit_error(error)
+
+
+def is_rate_limit_error(error: errors.HttpError) -> bool:
+    """
+    Determines whether the request is throttled by the rate limits.
+
+    Parameters
+    ----------
+    error : googleapiclient.errors.HttpError
+        The error of the failed request.
+
+    Returns
+    -------
+    bool
+        True if the status is 429, or 403 with a reason of `RATE_LIMIT_REASONS`.
+    """
+    if error.resp.status == 429:
+        return True
+    if error.resp.status == 403 and isinstance(error.error_details, list):
+        return any(
+            detail.get("reason") in RATE_LIMIT_REASONS
+            for detail in error.error_details
+            if isinstance(detail, dict)
+        )
+    return False
+
+
+def encode_message(message: mime_base.MIMEBase) -> str:
+    """
+    Encodes a message into the base64url string for the raw field of Message.
+
+    The parts of `labmail.mime.FileAttachment` and `labmail.mime.StreamedText`
+    are read into memory. Use `send_message()` to send such a message
+    without doing so.
+
+    Parameters
+    ----------
+    message : email.mime.base.MIMEBase
+        The message to encode.
+
+    Returns
+    -------
+    str
+        The base64url encoded message.
+    """
+    if mime.has_streamed_parts(message):
+        buffer = io.BytesIO()
+        mime.write_message(message, buffer)
+        return base64.urlsafe_b64encode(buffer.getbuffer()).decode()
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
 def get_sendas(
     rsc: resources.GmailResource,
     user_id: str = "me",
@@ -369,23 +1271,67 @@ def get_sendas(
     --------
     https://developers.google.com/gmail/api/reference/rest/v1/users.settings.sendAs/list
     """
-    response = (
+    addr_to_sendas = index_sendas(list_sendas(rsc, user_id))
+    if address not in addr_to_sendas:
+        raise ValueError(f"Signatures of {address} not found")
+    return addr_to_sendas[address]
+
+
+def list_sendas(
+    rsc: resources.GmailResource,
+    user_id: str = "me",
+) -> list[schemas.SendAs]:
+    """
+    Gets a list of sendas registered on Gmail.
+
+    Parameters
+    ----------
+    rsc : GmailResource
+        The Resource object for interacting with Gmail API.
+    user_id : str
+        The user's email address.
+
+    Returns
+    -------
+    list[SendAs]
+        The list of SendAs objects.
+        See also https://developers.google.com/gmail/api/reference/rest/v1/users.settings.sendAs#SendAs.
+
+    See Also
+    --------
+    https://developers.google.com/gmail/api/reference/rest/v1/users.settings.sendAs/list
+    """
+    response = _execute(
         rsc.users()
         .settings()
         .sendAs()
         .list(
             userId=user_id,
         )
-        .execute()
     )
-    addr_to_sendas = {sendas["sendAsEmail"]: sendas for sendas in response["sendAs"]}
-    if address is None:
-        # Get the default send-as alias
-        sendas = [
-            sendas for sendas in addr_to_sendas.values() if sendas["isDefault"]
-        ].pop()
-    else:
-        if address not in addr_to_sendas.keys():
-            raise ValueError(f"Signatures of {address} not found")
-        sendas = addr_to_sendas[address]
-    return sendas
+    return response.get("sendAs", list())
+
+
+def index_sendas(
+    sendas_list: abc.Iterable[schemas.SendAs],
+) -> dict[str | None, schemas.SendAs]:
+    """
+    Indexes sendas by the send-as alias addresses.
+
+    Parameters
+    ----------
+    sendas_list : Iterable[SendAs]
+        The SendAs objects to index.
+
+    Returns
+    -------
+    dict[str | None, SendAs]
+        The mapping from the addresses to the SendAs objects.
+        The default send-as alias is also mapped from None.
+    """
+    addr_to_sendas: dict[str | None, schemas.SendAs] = dict()
+    for sendas in sendas_list:
+        addr_to_sendas[sendas["sendAsEmail"]] = sendas
+        if sendas.get("isDefault", False):
+            addr_to_sendas[None] = sendas
+    return addr_to_sendas
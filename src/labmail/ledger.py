@@ -0,0 +1,339 @@
+"""
+This module provides a ledger of sent messages on SQLite keyed by
+idempotency keys, so that a retried or re-run send of the same message
+is answered from the ledger instead of sending the message again.
+
+The key is given by the caller, or the fingerprint of the recipients,
+the subject and the body of the message (see `fingerprint()`).
+A message is recorded as pending before it is sent, and as sent with
+the ID of the message on Gmail after that.
+If a send fails after the request has been posted, Gmail might have sent
+the message, so the entry is kept as unknown and the outcome is looked up
+on Gmail by the Message-ID header derived from the key (see `message_id()`)
+when the same key is sent again.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import enum
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import abc
+
+
+class Status(enum.Enum):
+    PENDING = "pending"
+    """The message is being sent, or the process died while sending it."""
+    UNKNOWN = "unknown"
+    """The send failed after posting the request, so it might have been sent."""
+    SENT = "sent"
+
+
+class SendInProgressError(RuntimeError):
+    """If a message with the same idempotency key is being sent."""
+
+
+@dataclasses.dataclass
+class LedgerEntry:
+    """
+    The record of a message in `SendLedger`.
+
+    Attributes
+    ----------
+    key : str
+        The idempotency key of the message.
+    status : labmail.ledger.Status
+        The status of the message.
+    message_id : str | None
+        The ID of the sent message on Gmail.
+    thread_id : str | None
+        The ID of the thread of the sent message on Gmail.
+    created_at : float
+        The time when the message was recorded first.
+    updated_at : float
+        The time when the status was updated.
+    """
+
+    key: str
+    status: Status
+    message_id: str | None
+    thread_id: str | None
+    created_at: float
+    updated_at: float
+
+
+def fingerprint(recipient: str | list[str], subject: str, body: str) -> str:
+    """
+    Computes the idempotency key of a message from its content.
+
+    The addresses of the recipients are compared case-insensitively
+    regardless of their order.
+
+    Parameters
+    ----------
+    recipient : str | list[str]
+        The email address(es) of recipient, separated with comma if str.
+    subject : str
+        The subject of the message.
+    body : str
+        The body text of the message.
+
+    Returns
+    -------
+    str
+        The SHA-256 hex digest of the recipients, the subject and the body.
+    """
+    recipients = [recipient] if isinstance(recipient, str) else recipient
+    addresses = sorted(
+        address.strip().lower()
+        for value in recipients
+        for address in value.split(",")
+        if address.strip()
+    )
+    content = json.dumps([addresses, subject, body], ensure_ascii=False)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def message_id(key: str) -> str:
+    """
+    Derives the Message-ID header of the message sent with an idempotency key.
+
+    Parameters
+    ----------
+    key : str
+        The idempotency key.
+
+    Returns
+    -------
+    str
+        The Message-ID, which can be searched on Gmail with `rfc822msgid:`.
+    """
+    return f"<{hashlib.sha256(key.encode()).hexdigest()[:32]}@labmail>"
+
+
+class SendLedger:
+    """
+    A ledger of sent messages keyed by idempotency keys, stored in
+    a SQLite database.
+
+    It can be shared across threads and processes.
+    A lookup is a query by the primary key, which is negligible
+    compared to a round trip to Gmail API.
+
+    The database connection is kept open and shared across threads
+    until `close()` is called.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the database file.
+    pending_timeout : float
+        The seconds after which a pending message is regarded as abandoned
+        by a dead process. It must be longer than the time to send a message.
+
+    Examples
+    --------
+    >>> ledger = SendLedger("ledger.sqlite3")
+    >>> with labmail.Session(ledger=ledger) as session:
+    ...     session.send("foo@example.com", "Body", "Subject", idempotency_key="job-1")
+    ...     # answered from the ledger without sending the message again
+    ...     session.send("foo@example.com", "Body", "Subject", idempotency_key="job-1")
+    """
+
+    def __init__(
+        self, filepath: str | os.PathLike[str], *, pending_timeout: float = 600.0
+    ) -> None:
+        self.filepath = pathlib.Path(filepath)
+        self.pending_timeout = pending_timeout
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connect(self) -> abc.Iterator[sqlite3.Connection]:
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._open()
+            yield self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        # every statement is committed by itself
+        conn = sqlite3.connect(
+            self.filepath, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sends ("
+            " key TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " message_id TEXT,"
+            " thread_id TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        return conn
+
+    def close(self) -> None:
+        """Closes the database connection, which is reopened on the next access."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: str) -> LedgerEntry | None:
+        """
+        Gets the record of a message.
+
+        Parameters
+        ----------
+        key : str
+            The idempotency key of the message.
+
+        Returns
+        -------
+        labmail.ledger.LedgerEntry | None
+            The record, or None if the key is not recorded.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT key, status, message_id, thread_id, created_at, updated_at"
+                " FROM sends WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return None if row is None else LedgerEntry(row[0], Status(row[1]), *row[2:])
+
+    def begin(self, key: str) -> LedgerEntry | None:
+        """
+        Records a message as pending unless the key is recorded.
+
+        Parameters
+        ----------
+        key : str
+            The idempotency key of the message.
+
+        Returns
+        -------
+        labmail.ledger.LedgerEntry | None
+            None if the message is recorded and the caller should send it,
+            or the existing record of the key otherwise.
+        """
+        # looked up first without taking the write lock,
+        # since most of the keys consulted again have been sent
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO sends (key, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                (key, Status.PENDING.value, now, now),
+            )
+        if cursor.rowcount == 1:
+            return None
+        # recorded by the other in the meantime
+        return self.begin(key)
+
+    def is_abandoned(self, entry: LedgerEntry) -> bool:
+        """
+        Checks whether the send of a message is no longer in progress.
+
+        Parameters
+        ----------
+        entry : labmail.ledger.LedgerEntry
+            The record of the message.
+
+        Returns
+        -------
+        bool
+            True if the status is unknown, or pending longer than `pending_timeout`.
+        """
+        return entry.status is Status.UNKNOWN or (
+            entry.status is Status.PENDING
+            and time.time() - entry.updated_at >= self.pending_timeout
+        )
+
+    def take_over(self, entry: LedgerEntry) -> bool:
+        """
+        Records an abandoned message as pending again to resend it.
+
+        Parameters
+        ----------
+        entry : labmail.ledger.LedgerEntry
+            The record of the message returned by `begin()` or `get()`.
+
+        Returns
+        -------
+        bool
+            True if the caller should send the message, or False if
+            the record has been updated by the other in the meantime.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE sends SET status = ?, updated_at = ?"
+                " WHERE key = ? AND status = ? AND updated_at = ?",
+                (
+                    Status.PENDING.value,
+                    time.time(),
+                    entry.key,
+                    entry.status.value,
+                    entry.updated_at,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, key: str, message_id: str, thread_id: str | None) -> None:
+        """
+        Records a message as sent.
+
+        Parameters
+        ----------
+        key : str
+            The idempotency key of the message.
+        message_id : str
+            The ID of the sent message on Gmail.
+        thread_id : str | None
+            The ID of the thread of the sent message on Gmail.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sends (key, status, message_id, thread_id, created_at,"
+                " updated_at) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE"
+                " SET status = excluded.status, message_id = excluded.message_id,"
+                " thread_id = excluded.thread_id, updated_at = excluded.updated_at",
+                (key, Status.SENT.value, message_id, thread_id, now, now),
+            )
+
+    def fail(self, key: str, *, ambiguous: bool) -> None:
+        """
+        Records a failure to send a pending message.
+
+        Parameters
+        ----------
+        key : str
+            The idempotency key of the message.
+        ambiguous : bool
+            Whether the message might have been sent, such as for a timeout
+            after posting the request. If false, the key is forgotten so that
+            the message is sent as a new one next time.
+        """
+        with self._connect() as conn:
+            if ambiguous:
+                conn.execute(
+                    "UPDATE sends SET status = ?, updated_at = ?"
+                    " WHERE key = ? AND status = ?",
+                    (Status.UNKNOWN.value, time.time(), key, Status.PENDING.value),
+                )
+            else:
+                conn.execute(
+                    "DELETE FROM sends WHERE key = ? AND status = ?",
+                    (key, Status.PENDING.value),
+                )
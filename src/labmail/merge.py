@@ -0,0 +1,248 @@
+"""
+This module provides a mail merge, which sends a message personalized
+with each row of a recipient list.
+
+The rows are read and rendered chunk by chunk while the previous chunk
+is being built and sent with batch requests in a background thread,
+so that a recipient list of any length is merged in a constant memory.
+"""
+
+from __future__ import annotations
+
+import csv
+import dataclasses
+import itertools
+import json
+import logging
+import os
+import pathlib
+import string
+import typing as t
+from collections import abc
+from concurrent import futures
+
+from labmail.session import Draft, Session
+from labmail.text_utils import TextType
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+logger = logging.getLogger(__name__)
+
+Row = abc.Mapping[str, t.Any]
+"""A row of a recipient list, mapping the column names to the values."""
+
+
+@dataclasses.dataclass
+class Template:
+    """
+    A template of messages to be merged with rows.
+
+    The fields are templates of `string.Template`, in which `$name` and `${name}`
+    are substituted with the value of the column `name` of a row,
+    and `$$` is an escape for `$`. See `labmail.send()` for the fields.
+
+    Examples
+    --------
+    >>> template = Template("$email", "Dear $name,", "Hello, $name")
+    >>> template.render({"email": "foo@example.com", "name": "Foo"})
+    Draft(recipient='foo@example.com', body='Dear Foo,', subject='Hello, Foo', ...)
+    """
+
+    recipient: str
+    body: str = ""
+    subject: str = ""
+    text_type: TextType = TextType.PLAIN
+    headers: dict[str, str] | None = None
+    sendas_address: str | None = None
+
+    def __post_init__(self) -> None:
+        self._recipient = string.Template(self.recipient)
+        self._body = string.Template(self.body)
+        self._subject = string.Template(self.subject)
+        self._headers = {
+            name: string.Template(value)
+            for name, value in (self.headers or dict()).items()
+        }
+
+    def render(self, row: Row) -> Draft:
+        """
+        Renders a message with a row.
+
+        Parameters
+        ----------
+        row : Mapping[str, typing.Any]
+            The row to substitute the placeholders with.
+
+        Returns
+        -------
+        labmail.Draft
+            The rendered message.
+
+        Raises
+        ------
+        KeyError
+            If the row lacks any column in the placeholders.
+        ValueError
+            If any placeholder is invalid.
+        """
+        return Draft(
+            recipient=self._recipient.substitute(row),
+            body=self._body.substitute(row),
+            subject=self._subject.substitute(row),
+            text_type=self.text_type,
+            headers={
+                name: value.substitute(row) for name, value in self._headers.items()
+            }
+            or None,
+            sendas_address=self.sendas_address,
+        )
+
+
+@dataclasses.dataclass
+class MergeResult:
+    """
+    The result of a message merged by `merge()`.
+
+    Attributes
+    ----------
+    index : int
+        The index of the row, starting from 0.
+    draft : labmail.Draft | None
+        The rendered message, or None if the row failed to be rendered.
+    result : Message | Exception | None
+        The sent Message object or the error, or None for dry-run mode.
+    """
+
+    index: int
+    draft: Draft | None
+    result: schemas.Message | Exception | None
+
+    @property
+    def failed(self) -> bool:
+        """Whether the message failed to be rendered or sent."""
+        return isinstance(self.result, Exception)
+
+
+def read_rows(filepath: str | os.PathLike[str]) -> abc.Iterator[dict[str, t.Any]]:
+    """
+    Reads the rows of a recipient list one by one.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the CSV file with a header row (`*.csv`),
+        or the JSON Lines file of objects (`*.jsonl` or `*.ndjson`).
+
+    Yields
+    ------
+    dict[str, typing.Any]
+        The rows.
+
+    Raises
+    ------
+    ValueError
+        If the file type is not supported, or a line of JSON Lines is not an object.
+    """
+    filepath = pathlib.Path(filepath)
+    match filepath.suffix.lower():
+        case ".csv":
+            with filepath.open(newline="") as f:
+                yield from csv.DictReader(f)
+        case ".jsonl" | ".ndjson":
+            with filepath.open() as f:
+                for lineno, line in enumerate(f, 1):
+                    if line.strip() == "":
+                        continue
+                    row = json.loads(line)
+                    if not isinstance(row, dict):
+                        raise ValueError(f"Line {lineno} is not a JSON object")
+                    yield row
+        case _:
+            raise ValueError(f"Unsupported file type: {filepath.name}")
+
+
+def merge(
+    session: Session,
+    template: Template,
+    rows: abc.Iterable[Row],
+    *,
+    chunk_size: int = 500,
+    batch_size: int = 50,
+    disallow_same_subjects: bool = False,
+    dry_run: bool = False,
+) -> abc.Generator[MergeResult, None, None]:
+    """
+    Sends a message rendered with each row via Gmail.
+
+    At most two chunks of rows are held at a time: one being rendered
+    and one being sent with `labmail.Session.send_many()`.
+
+    Parameters
+    ----------
+    session : labmail.Session
+        The open session to send the messages with.
+    template : labmail.merge.Template
+        The template of the messages.
+    rows : Iterable[Mapping[str, typing.Any]]
+        The rows to render the messages with, such as `read_rows()`.
+    chunk_size : int
+        The number of rows in a chunk.
+    batch_size : int
+        The number of messages in a batch request.
+    disallow_same_subjects : bool
+        If true, the messages whose subjects have been already used are not sent.
+    dry_run : bool
+        If true, does not post the send requests to Gmail API.
+
+    Yields
+    ------
+    labmail.merge.MergeResult
+        The results in the order of `rows`.
+
+    Examples
+    --------
+    >>> template = Template("$email", "Dear $name,", "Hello, $name")
+    >>> with labmail.Session() as session:
+    ...     for result in merge(session, template, read_rows("recipients.csv")):
+    ...         if result.failed:
+    ...             print(result.index, result.result)
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+
+    def collect(
+        rendered: list[MergeResult],
+        future: futures.Future[list[schemas.Message | Exception | None]],
+    ) -> abc.Iterator[MergeResult]:
+        responses = iter(future.result())
+        for result in rendered:
+            if result.draft is not None:
+                result.result = next(responses)
+            yield result
+
+    rows = iter(rows)
+    index = 0
+    previous = None
+    with futures.ThreadPoolExecutor(1, thread_name_prefix="labmail-merge") as executor:
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            rendered: list[MergeResult] = list()
+            for row in chunk:
+                try:
+                    rendered.append(MergeResult(index, template.render(row), None))
+                except (KeyError, ValueError) as err:
+                    rendered.append(MergeResult(index, None, err))
+                index += 1
+            logger.info(f"Rendered {index} rows")
+            future = executor.submit(
+                session.send_many,
+                [result.draft for result in rendered if result.draft is not None],
+                disallow_same_subjects=disallow_same_subjects,
+                dry_run=dry_run,
+                batch_size=batch_size,
+            )
+            if previous is not None:
+                yield from collect(*previous)
+            previous = rendered, future
+        if previous is not None:
+            yield from collect(*previous)
@@ -0,0 +1,185 @@
+"""
+This module provides the parts of messages whose contents are read on demand,
+the attachments read from files and the texts given chunk by chunk,
+and the writer of messages which streams them.
+
+`email.generator` renders every part of a multipart message into memory
+before writing it, so a message with a large attachment or body costs several
+times its size. `write_message()` instead encodes such parts chunk by chunk
+into the output file.
+"""
+
+from __future__ import annotations
+
+import base64
+import email.message
+import email.mime.base as mime_base
+import mimetypes
+import os
+import pathlib
+import secrets
+import typing as t
+from collections import abc
+
+CHUNK_SIZE = 57 * 1024
+"""The bytes read from an attachment at a time, which are encoded to 1024 lines."""
+
+
+class FileAttachment(mime_base.MIMEBase):
+    """
+    A MIME part of a file attached to a message.
+
+    The content is not loaded into memory but read from the file
+    when the message is written by `write_message()`.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the file to attach.
+    mimetype : str | None
+        The MIME type of the file. If None, it is guessed from the file name.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the file does not exist.
+
+    Examples
+    --------
+    >>> message = mime_multipart.MIMEMultipart()
+    >>> message.attach(mime_text.MIMEText("Body text here", "html"))
+    >>> message.attach(FileAttachment("report.pdf"))
+    """
+
+    def __init__(
+        self, filepath: str | os.PathLike[str], mimetype: str | None = None
+    ) -> None:
+        self.filepath = pathlib.Path(filepath)
+        self.size = self.filepath.stat().st_size
+        if mimetype is None:
+            guessed, encoding = mimetypes.guess_type(self.filepath.name)
+            mimetype = guessed if guessed and encoding is None else None
+        maintype, subtype = (mimetype or "application/octet-stream").split("/", 1)
+        super().__init__(maintype, subtype)
+        self["Content-Transfer-Encoding"] = "base64"
+        name = self.filepath.name
+        self.add_header(
+            "Content-Disposition",
+            "attachment",
+            filename=name if name.isascii() else ("utf-8", "", name),
+        )
+
+
+class StreamedText(mime_base.MIMEBase):
+    """
+    A MIME part of a text given chunk by chunk, encoded in UTF-8 and base64
+    as `email.mime.text.MIMEText` does.
+
+    The chunks are not joined in memory but encoded one by one
+    when the message is written by `write_message()`,
+    so the message can be written only once if `chunks` is an iterator.
+
+    Parameters
+    ----------
+    chunks : Iterable[str]
+        The chunks of the text.
+    subtype : str
+        The subtype of the text such as "plain" and "html".
+
+    Examples
+    --------
+    >>> with open("digest.log") as f:
+    ...     part = StreamedText(text_utils.iter_text_to_html(f, TextType.PLAIN), "html")
+    ...     with tempfile.TemporaryFile() as fp:
+    ...         write_message(part, fp)
+    """
+
+    def __init__(self, chunks: abc.Iterable[str], subtype: str = "plain") -> None:
+        super().__init__("text", subtype, charset="utf-8")
+        self["Content-Transfer-Encoding"] = "base64"
+        self.chunks = chunks
+
+
+def has_streamed_parts(message: email.message.Message) -> bool:
+    """
+    Checks whether a message has any part written only by `write_message()`,
+    i.e. `FileAttachment` or `StreamedText`.
+
+    Parameters
+    ----------
+    message : email.message.Message
+        The message to check.
+
+    Returns
+    -------
+    bool
+        True if the message or any of its parts is streamed.
+    """
+    return any(
+        isinstance(part, (FileAttachment, StreamedText)) for part in message.walk()
+    )
+
+
+def write_message(message: email.message.Message, fp: t.IO[bytes]) -> None:
+    """
+    Writes a message in the RFC 2822 format, as `message.as_bytes()` does.
+
+    The contents of `FileAttachment` and `StreamedText` are encoded in base64
+    chunk by chunk, and the other parts are rendered one by one,
+    so that the whole message is never held in memory.
+
+    Parameters
+    ----------
+    message : email.message.Message
+        The message to write.
+    fp : typing.IO[bytes]
+        The binary file to write the message to.
+    """
+    if not isinstance(message, (FileAttachment, StreamedText)) and (
+        not message.is_multipart()
+    ):
+        fp.write(message.as_bytes())
+        return
+    linesep = message.policy.linesep.encode()
+    boundary = None
+    if message.is_multipart():
+        boundary = message.get_boundary()
+        if boundary is None:
+            boundary = f"{'=' * 15}{secrets.token_hex(16)}=="
+            message.set_boundary(boundary)
+    for name, value in message.raw_items():
+        fp.write(message.policy.fold_binary(name, value))
+    fp.write(linesep)
+    if isinstance(message, FileAttachment):
+        with message.filepath.open("rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                fp.write(base64.encodebytes(chunk).replace(b"\n", linesep))
+        return
+    if isinstance(message, StreamedText):
+        _write_text(message.chunks, fp, linesep)
+        return
+    delimiter = b"--" + t.cast(str, boundary).encode()
+    if message.preamble is not None:
+        fp.write(message.preamble.encode() + linesep)
+    parts = t.cast("list[email.message.Message]", message.get_payload())
+    fp.write(delimiter + linesep)
+    for i, part in enumerate(parts):
+        if i > 0:
+            fp.write(linesep + delimiter + linesep)
+        write_message(part, fp)
+    fp.write(linesep + delimiter + b"--" + linesep)
+    if message.epilogue is not None:
+        fp.write(message.epilogue.encode())
+
+
+def _write_text(chunks: abc.Iterable[str], fp: t.IO[bytes], linesep: bytes) -> None:
+    # the bytes are encoded by the multiples of 57 bytes, which make full lines
+    # and appended to a bytearray to avoid copying the whole buffer per chunk
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk.encode()
+        size = len(buffer) - len(buffer) % 57
+        if size >= CHUNK_SIZE:
+            fp.write(base64.encodebytes(buffer[:size]).replace(b"\n", linesep))
+            del buffer[:size]
+    fp.write(base64.encodebytes(buffer).replace(b"\n", linesep))
@@ -0,0 +1,526 @@
+"""
+This module provides a durable outbox, a queue of messages on SQLite,
+and the workers which send the queued messages via Gmail in background threads.
+
+A worker claims a message for a visibility timeout while sending it,
+so that the message becomes visible to the workers again and is retried
+if the process dies before the result is recorded.
+The result of an expired claim is ignored if the message has been claimed again.
+Thus, a message is sent at least once.
+If a send fails, only the message throttled by the rate limits is retried
+with a backoff. The message failed with a server error or a timeout might
+have been sent, so it is marked as unknown instead of sent again.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import email.mime.base as mime_base
+import enum
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import types
+import typing as t
+
+from google.oauth2 import credentials as _credentials
+from googleapiclient import errors
+
+from labmail import gmail_api
+
+logger = logging.getLogger(__name__)
+
+
+class Status(enum.Enum):
+    QUEUED = "queued"
+    """The message is waiting to be sent."""
+    SENDING = "sending"
+    """The message is claimed by a worker, or the worker died while sending it."""
+    SENT = "sent"
+    FAILED = "failed"
+    """The message was rejected, so it has not been sent."""
+    UNKNOWN = "unknown"
+    """The send failed after posting the request, so it might have been sent."""
+
+
+@dataclasses.dataclass
+class OutboxEntry:
+    """
+    The status of a message in `Outbox`.
+
+    Attributes
+    ----------
+    id : int
+        The ID of the message in the outbox.
+    status : labmail.outbox.Status
+        The status of the message.
+    attempts : int
+        The number of the attempts to send the message.
+    message_id : str | None
+        The ID of the sent message on Gmail.
+    error : str | None
+        The error of the last attempt.
+    created_at : float
+        The time when the message was enqueued.
+    updated_at : float
+        The time when the status was updated.
+    """
+
+    id: int
+    status: Status
+    attempts: int
+    message_id: str | None
+    error: str | None
+    created_at: float
+    updated_at: float
+
+
+@dataclasses.dataclass
+class Claim:
+    """
+    A message claimed by a worker in `Outbox`.
+
+    Attributes
+    ----------
+    id : int
+        The ID of the message in the outbox.
+    raw : str
+        The message encoded by `labmail.gmail_api.encode_message()`.
+    attempt : int
+        The number of the attempt, which identifies the claim since
+        the message is claimed again with the next number
+        after the visibility timeout expires.
+    """
+
+    id: int
+    raw: str
+    attempt: int
+
+
+class Outbox:
+    """
+    A durable queue of messages to send, stored in a SQLite database.
+
+    It can be shared across threads and processes.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to the database file.
+    visibility_timeout : float
+        The seconds for which a claimed message is invisible to the other workers.
+        It must be longer than the time to send a message, including the retries
+        within `max_elapsed` of `labmail.gmail_api.retry_policy`.
+    max_attempts : int
+        The maximum number of the attempts to send a message.
+    max_retry_delay : float
+        The maximum seconds to wait before retrying a message.
+        The delay doubles from 1 second on every attempt.
+
+    Examples
+    --------
+    >>> outbox = Outbox("outbox.sqlite3")
+    >>> id = outbox.enqueue(message)
+    >>> outbox.get(id).status
+    <Status.QUEUED: 'queued'>
+    """
+
+    def __init__(
+        self,
+        filepath: str | os.PathLike[str],
+        *,
+        visibility_timeout: float = 60.0,
+        max_attempts: int = 5,
+        max_retry_delay: float = 60.0,
+    ) -> None:
+        self.filepath = pathlib.Path(filepath)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.max_retry_delay = max_retry_delay
+        self._condition = threading.Condition()
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " raw TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " available_at REAL NOT NULL,"
+                " message_id TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_available"
+                " ON messages (status, available_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        # transactions are begun explicitly
+        return sqlite3.connect(self.filepath, timeout=30, isolation_level=None)
+
+    def enqueue(self, message: mime_base.MIMEBase) -> int:
+        """
+        Adds a message to the outbox.
+
+        Parameters
+        ----------
+        message : email.mime.base.MIMEBase
+            The message to send.
+
+        Returns
+        -------
+        int
+            The ID of the message in the outbox.
+        """
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "INSERT INTO messages (raw, status, available_at, created_at,"
+                " updated_at) VALUES (?, ?, ?, ?, ?)",
+                (gmail_api.encode_message(message), Status.QUEUED.value, now, now, now),
+            )
+        with self._condition:
+            self._condition.notify_all()
+        return t.cast(int, cursor.lastrowid)
+
+    def claim(self) -> Claim | None:
+        """
+        Claims the oldest message visible to the workers.
+
+        The message is invisible to the others until the visibility timeout expires.
+
+        Returns
+        -------
+        labmail.outbox.Claim | None
+            The claimed message, or None if no message is visible.
+        """
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, raw, attempts FROM messages"
+                    " WHERE status IN (?, ?) AND available_at <= ?"
+                    " ORDER BY id LIMIT 1",
+                    (Status.QUEUED.value, Status.SENDING.value, now),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE messages SET status = ?, attempts = attempts + 1,"
+                        " available_at = ?, updated_at = ? WHERE id = ?",
+                        (
+                            Status.SENDING.value,
+                            now + self.visibility_timeout,
+                            now,
+                            row[0],
+                        ),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return None if row is None else Claim(row[0], row[1], row[2] + 1)
+
+    def complete(self, claim: Claim, message_id: str) -> bool:
+        """
+        Marks a claimed message as sent.
+
+        Parameters
+        ----------
+        claim : labmail.outbox.Claim
+            The claim of the message.
+        message_id : str
+            The ID of the sent message on Gmail.
+
+        Returns
+        -------
+        bool
+            True if recorded, or False if the claim has expired and
+            the message has been claimed again, not to override its result.
+        """
+        with contextlib.closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE messages SET status = ?, message_id = ?, error = NULL,"
+                " updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+                (
+                    Status.SENT.value,
+                    message_id,
+                    time.time(),
+                    claim.id,
+                    Status.SENDING.value,
+                    claim.attempt,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def fail(
+        self, claim: Claim, error: str, *, retriable: bool, ambiguous: bool = False
+    ) -> None:
+        """
+        Records an error to send a claimed message.
+
+        The message is retried later if the error is retriable and
+        the attempts do not reach `max_attempts`. Otherwise, it is marked as
+        unknown if the error is ambiguous, or as failed.
+        Nothing is recorded if the claim has expired and
+        the message has been claimed again.
+
+        Parameters
+        ----------
+        claim : labmail.outbox.Claim
+            The claim of the message.
+        error : str
+            The error message.
+        retriable : bool
+            Whether the message has not been sent and can be sent again,
+            such as when throttled by the rate limits.
+        ambiguous : bool
+            Whether the message might have been sent, such as for a server error
+            or a timeout after posting the request. Such a message is not retried
+            so as not to be sent twice.
+        """
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id FROM messages WHERE id = ? AND status = ?"
+                    " AND attempts = ?",
+                    (claim.id, Status.SENDING.value, claim.attempt),
+                ).fetchone()
+                if row is not None:
+                    if retriable and claim.attempt < self.max_attempts:
+                        status = Status.QUEUED
+                        delay = min(2.0 ** (claim.attempt - 1), self.max_retry_delay)
+                    elif ambiguous:
+                        status, delay = Status.UNKNOWN, 0.0
+                    else:
+                        status, delay = Status.FAILED, 0.0
+                    conn.execute(
+                        "UPDATE messages SET status = ?, error = ?, available_at = ?,"
+                        " updated_at = ? WHERE id = ?",
+                        (status.value, error, now + delay, now, claim.id),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def get(self, id: int) -> OutboxEntry:
+        """
+        Gets the status of a message.
+
+        Parameters
+        ----------
+        id : int
+            The ID of the message in the outbox.
+
+        Returns
+        -------
+        labmail.outbox.OutboxEntry
+            The status of the message.
+
+        Raises
+        ------
+        KeyError
+            If the message is not found.
+        """
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT id, status, attempts, message_id, error, created_at,"
+                " updated_at FROM messages WHERE id = ?",
+                (id,),
+            ).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return OutboxEntry(row[0], Status(row[1]), *row[2:])
+
+    def counts(self) -> dict[Status, int]:
+        """
+        Counts the messages by status.
+
+        Returns
+        -------
+        dict[labmail.outbox.Status, int]
+            The numbers of the messages keyed by all the statuses.
+        """
+        counts = {status: 0 for status in Status}
+        with contextlib.closing(self._connect()) as conn:
+            for status, count in conn.execute(
+                "SELECT status, COUNT(*) FROM messages GROUP BY status"
+            ):
+                counts[Status(status)] = count
+        return counts
+
+    def wait(self, timeout: float) -> None:
+        """
+        Waits until a message is enqueued in this process or the timeout expires.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum seconds to wait.
+        """
+        with self._condition:
+            self._condition.wait(timeout)
+
+    def notify(self) -> None:
+        """Wakes up the threads waiting in `wait()`."""
+        with self._condition:
+            self._condition.notify_all()
+
+
+class OutboxWorkers:
+    """
+    Worker threads which send the messages in an outbox via Gmail.
+
+    The workers share a Resource object built with `thread_safe=True`,
+    as in `labmail.pool`.
+
+    Parameters
+    ----------
+    outbox : labmail.outbox.Outbox
+        The outbox to drain.
+    creds : google.oauth2.credentials.Credentials
+        The credentials for Gmail API.
+    num_workers : int
+        The number of the worker threads.
+    user_id : str
+        The user's email address.
+    poll_interval : float
+        The maximum seconds to wait for a message enqueued by the other processes.
+    document : dict[str, typing.Any] | None
+        The parsed discovery document to build the Resource object from,
+        such as the trimmed one loaded by `labmail.cache.DiscoveryCache`.
+        If None, the discovery document is loaded by the Google API client.
+
+    Examples
+    --------
+    >>> with gmail_api.credentials() as creds:
+    ...     with OutboxWorkers(outbox, creds) as workers:
+    ...         outbox.enqueue(message)
+    ...         workers.drain()
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        creds: _credentials.Credentials,
+        *,
+        num_workers: int = 4,
+        user_id: str = "me",
+        poll_interval: float = 1.0,
+        document: dict[str, t.Any] | None = None,
+    ) -> None:
+        self.outbox = outbox
+        self.creds = creds
+        self.num_workers = num_workers
+        self.user_id = user_id
+        self.poll_interval = poll_interval
+        self.rsc = gmail_api.build(creds, thread_safe=True, document=document)
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = list()
+
+    def __enter__(self) -> OutboxWorkers:
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """Starts the worker threads."""
+        if self._threads:
+            return
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"labmail-outbox-{i}", daemon=True)
+            for i in range(self.num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the worker threads after the messages being sent.
+
+        The queued messages are left in the outbox.
+        """
+        self._stopped.set()
+        self.outbox.notify()
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+
+    def drain(self, timeout: float | None = None) -> bool:
+        """
+        Waits until no message is queued or being sent.
+
+        Parameters
+        ----------
+        timeout : float | None
+            The maximum seconds to wait. If None, waits forever.
+
+        Returns
+        -------
+        bool
+            True if the outbox is drained, or False if the timeout expires.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            counts = self.outbox.counts()
+            if counts[Status.QUEUED] + counts[Status.SENDING] == 0:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            claim = self.outbox.claim()
+            if claim is None:
+                self.outbox.wait(self.poll_interval)
+                continue
+            id = claim.id
+            try:
+                response = gmail_api.send_raw_message(
+                    self.rsc, self.user_id, raw=claim.raw
+                )
+            except errors.HttpError as err:
+                logger.warning(f"Failed to send the message {id}: {err}")
+                # only the throttled messages are sent again, as in send_raw_message
+                self.outbox.fail(
+                    claim,
+                    str(err),
+                    retriable=gmail_api.is_rate_limit_error(err),
+                    ambiguous=err.resp.status >= 500,
+                )
+            except Exception as err:
+                logger.warning(f"Failed to send the message {id}: {err}")
+                self.outbox.fail(
+                    claim,
+                    str(err),
+                    retriable=False,
+                    ambiguous=isinstance(err, OSError),
+                )
+            else:
+                if self.outbox.complete(claim, response["id"]):
+                    logger.info(f"Sent the message {id}")
+                else:
+                    logger.warning(
+                        f"Sent the message {id} after its claim expired,"
+                        " so it might be sent again"
+                    )
@@ -0,0 +1,179 @@
+"""
+This module provides a sender that sends messages concurrently with a thread pool.
+
+The Resource object of the Google API client sits on `httplib2.Http`,
+which is not thread-safe, so the worker threads share a Resource object
+built with `thread_safe=True`, which has an HTTP connection per thread.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import email.mime.base as mime_base
+import logging
+import time
+import types
+import typing as t
+from collections import abc
+from concurrent import futures
+
+from google.oauth2 import credentials as _credentials
+
+from labmail import gmail_api
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class SendReport:
+    """
+    The report of messages sent by `ThreadPoolSender`.
+
+    Attributes
+    ----------
+    results : list[Message | Exception]
+        The sent Message objects or the errors, in the order of the messages.
+    elapsed : float
+        The elapsed time to send all the messages in seconds.
+    """
+
+    results: list[schemas.Message | Exception]
+    elapsed: float
+
+    @property
+    def sent(self) -> int:
+        """The number of the messages sent successfully."""
+        return sum(not isinstance(result, Exception) for result in self.results)
+
+    @property
+    def failed(self) -> int:
+        """The number of the messages failed to send."""
+        return len(self.results) - self.sent
+
+    @property
+    def throughput(self) -> float:
+        """The number of the messages sent successfully per second."""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class ThreadPoolSender:
+    """
+    A sender that sends messages concurrently with a thread pool.
+
+    Parameters
+    ----------
+    creds : google.oauth2.credentials.Credentials
+        The credentials for Gmail API.
+    max_workers : int
+        The number of the worker threads.
+    user_id : str
+        The user's email address.
+    document : dict[str, typing.Any] | None
+        The parsed discovery document to build the Resource object from,
+        such as the trimmed one loaded by `labmail.cache.DiscoveryCache`.
+        If None, the discovery document is loaded by the Google API client.
+
+    Examples
+    --------
+    >>> from labmail import gmail_api, pool
+    >>> with gmail_api.credentials() as creds:
+    ...     with pool.ThreadPoolSender(creds, max_workers=8) as sender:
+    ...         report = sender.send_messages(messages)
+    >>> report.throughput
+    42.0
+    """
+
+    def __init__(
+        self,
+        creds: _credentials.Credentials,
+        *,
+        max_workers: int = 8,
+        user_id: str = "me",
+        document: dict[str, t.Any] | None = None,
+    ) -> None:
+        self.creds = creds
+        self.max_workers = max_workers
+        self.user_id = user_id
+        self.rsc = gmail_api.build(creds, thread_safe=True, document=document)
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="labmail"
+        )
+
+    def __enter__(self) -> ThreadPoolSender:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shuts down the worker threads."""
+        self._executor.shutdown()
+
+    def send_message(self, message: mime_base.MIMEBase) -> schemas.Message:
+        """
+        Sends a message via Gmail in the current thread.
+
+        Parameters
+        ----------
+        message : email.mime.base.MIMEBase
+            The message to send.
+
+        Returns
+        -------
+        Message
+            The sent Message object.
+        """
+        return gmail_api.send_message(self.rsc, self.user_id, message=message)
+
+    def send_messages(self, messages: abc.Iterable[mime_base.MIMEBase]) -> SendReport:
+        """
+        Sends messages via Gmail concurrently.
+
+        At most twice as many messages as the worker threads are taken
+        from `messages` at a time, so that any long iterable can be given.
+
+        Parameters
+        ----------
+        messages : Iterable[email.mime.base.MIMEBase]
+            The messages to send.
+
+        Returns
+        -------
+        labmail.pool.SendReport
+            The report of the sent messages.
+        """
+        results: dict[int, schemas.Message | Exception] = dict()
+        pending: dict[futures.Future[schemas.Message], int] = dict()
+
+        def collect(done: abc.Iterable[futures.Future[schemas.Message]]) -> None:
+            for future in done:
+                idx = pending.pop(future)
+                try:
+                    results[idx] = future.result()
+                except Exception as err:
+                    results[idx] = err
+
+        start = time.perf_counter()
+        for idx, message in enumerate(messages):
+            if len(pending) >= 2 * self.max_workers:
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                collect(done)
+            pending[self._executor.submit(self.send_message, message)] = idx
+        collect(futures.wait(pending).done)
+        report = SendReport(
+            results=[results[idx] for idx in range(len(results))],
+            elapsed=time.perf_counter() - start,
+        )
+        logger.info(
+            f"Sent {report.sent} messages ({report.failed} failed) "
+            f"in {report.elapsed:.2f} seconds: {report.throughput:.1f} messages/s"
+        )
+        return report
@@ -0,0 +1,210 @@
+"""
+This module provides the retry policy and the concurrency controller
+shared by the requests to Gmail API.
+
+A failed request is retried after an exponential backoff with full jitter,
+or after the time given by the Retry-After header of the response if longer.
+`AIMDController` limits the number of the concurrent requests in the process:
+the limit increases additively while the requests succeed and
+decreases multiplicatively when they are throttled,
+so that the throughput stays near the quota without failure storms.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import email.utils
+import random
+import threading
+import time
+import types
+
+
+@dataclasses.dataclass(frozen=True)
+class RetryPolicy:
+    """
+    A policy to retry failed requests with an exponential backoff.
+
+    Attributes
+    ----------
+    max_retries : int
+        The maximum number of times to retry a request.
+    base_delay : float
+        The backoff in seconds before the first retry, doubled on every retry.
+    max_delay : float
+        The maximum backoff in seconds.
+    jitter : bool
+        If true, the backoff is drawn uniformly from zero to the exponential one
+        ("full jitter"), so that the clients throttled at once do not retry at once.
+    max_elapsed : float
+        The maximum seconds from the first attempt of a request to the start of
+        its last retry. A retry which would start later is not made, even with
+        Retry-After, so a request ends within it plus the time of an attempt.
+        The default is shorter than the visibility timeout of
+        `labmail.outbox.Outbox`, so that the other workers do not send a message
+        again while it is being retried.
+    """
+
+    max_retries: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 32.0
+    jitter: bool = True
+    max_elapsed: float = 30.0
+
+    def delay(self, retry_num: int, retry_after: float | None = None) -> float:
+        """
+        Computes the delay before a retry.
+
+        Parameters
+        ----------
+        retry_num : int
+            The number of the retry, starting from 1.
+        retry_after : float | None
+            The delay in seconds requested by the server with Retry-After.
+
+        Returns
+        -------
+        float
+            The delay in seconds, which is not shorter than `retry_after`.
+        """
+        backoff = min(self.base_delay * 2.0 ** (retry_num - 1), self.max_delay)
+        if self.jitter:
+            backoff = random.uniform(0, backoff)
+        if retry_after is not None:
+            return max(backoff, retry_after)
+        return backoff
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parses the value of a Retry-After header.
+
+    Parameters
+    ----------
+    value : str | None
+        The value, either seconds or an HTTP date.
+
+    Returns
+    -------
+    float | None
+        The delay in seconds, or None if the value is missing or invalid.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+class AIMDController:
+    """
+    A limiter of concurrent requests with additive increase and
+    multiplicative decrease (AIMD) of the limit.
+
+    A request holds a slot while it is in flight, by `acquire()` and `release()`
+    or by the controller as a context manager.
+
+    Parameters
+    ----------
+    initial : float
+        The initial limit.
+    minimum : float
+        The minimum limit.
+    maximum : float
+        The maximum limit.
+    increase : float
+        The amount by which the limit increases per limit's worth of
+        successful requests, i.e. roughly per round trip.
+    decrease : float
+        The factor by which the limit is multiplied when throttled.
+    cooldown : float
+        The seconds after a decrease during which the other throttled requests
+        do not decrease the limit again, since they were sent at the old limit.
+
+    Examples
+    --------
+    >>> controller = AIMDController()
+    >>> with controller:
+    ...     try:
+    ...         response = request.execute()
+    ...     except errors.HttpError:
+    ...         controller.on_throttle()
+    ...     else:
+    ...         controller.on_success()
+    """
+
+    def __init__(
+        self,
+        initial: float = 8.0,
+        *,
+        minimum: float = 1.0,
+        maximum: float = 64.0,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+    ) -> None:
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("1 <= minimum <= initial <= maximum must hold")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._limit = initial
+        self._in_flight = 0
+        self._last_decrease = -float("inf")
+        self._condition = threading.Condition()
+
+    def __enter__(self) -> AIMDController:
+        self.acquire()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.release()
+
+    @property
+    def limit(self) -> float:
+        """The current limit of the concurrent requests."""
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        """The number of the requests holding slots."""
+        return self._in_flight
+
+    def acquire(self) -> None:
+        """Waits for a free slot and holds it."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < int(self._limit))
+            self._in_flight += 1
+
+    def release(self) -> None:
+        """Releases a slot."""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self) -> None:
+        """Increases the limit after a successful request."""
+        with self._condition:
+            self._limit = min(self._limit + self.increase / self._limit, self.maximum)
+            self._condition.notify_all()
+
+    def on_throttle(self) -> None:
+        """Decreases the limit after a throttled request."""
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._limit = max(self._limit * self.decrease, self.minimum)
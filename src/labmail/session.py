@@ -0,0 +1,843 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import email.mime.base as mime_base
+import email.mime.multipart as mime_multipart
+import email.mime.text as mime_text
+import itertools
+import logging
+import os
+import pathlib
+import pprint
+import threading
+import time
+import types
+import typing as t
+from collections import abc
+
+from googleapiclient import errors
+
+from labmail import cache, gmail_api, ledger, mime, text_utils, timing
+from labmail.text_utils import TextType
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from google.oauth2 import credentials as _credentials
+    from googleapiclient._apis.gmail.v1 import resources, schemas
+
+logger = logging.getLogger(__name__)
+
+STREAMED_BODY_SIZE = 5 * 1024 * 1024
+"""
+The characters of the HTML body given as lines above which it is streamed
+into the message file and uploaded, as large as a simple upload of Gmail API.
+A smaller body is built in memory and sent in a single request.
+"""
+
+
+@dataclasses.dataclass
+class Draft:
+    """
+    A message to be built with the signature and sent by `labmail.Session`.
+
+    See `labmail.send()` for the fields.
+    """
+
+    recipient: str | list[str]
+    body: str = ""
+    subject: str = ""
+    text_type: TextType = TextType.PLAIN
+    headers: dict[str, str] | None = None
+    sendas_address: str | None = None
+    idempotency_key: str | None = None
+
+
+@dataclasses.dataclass
+class SendResult:
+    """
+    The result of `labmail.send()`.
+
+    Attributes
+    ----------
+    message : Message | None
+        The sent Message object, or None for dry-run mode.
+    timings : labmail.timing.Timings
+        The durations of the phases of sending the message.
+    """
+
+    message: schemas.Message | None
+    timings: timing.Timings
+
+
+class Session:
+    """
+    A long-lived session to send messages via Gmail.
+
+    The credentials, the GmailResource object and the retrieved sendas are
+    kept while the session is open, so that they are not rebuilt on every send.
+
+    Parameters
+    ----------
+    credentials_filepath : str | os.PathLike[str]
+        The path to the authorized user json file.
+    scopes : list[str] | None
+        The list of scopes for the credentials.
+    thread_safe : bool
+        If true, the session can be shared across threads.
+        See also `labmail.gmail_api.build()`.
+    cache_dir : str | os.PathLike[str] | None
+        The directory to cache the discovery document of Gmail API,
+        the sendas and the index of the sent subjects in.
+        If None, they are not cached on disk.
+    sendas_ttl : float
+        The time to live of the sendas cached on disk in seconds.
+    subject_sync_interval : float
+        The seconds after which the index of the sent subjects is synced
+        with Gmail again, to find the subjects sent by the other clients.
+    refresh_signature : bool
+        If true, the sendas are retrieved from Gmail ignoring the cache on disk.
+    ledger : labmail.ledger.SendLedger | None
+        The ledger to deduplicate the sends with.
+        If given, every message is recorded in the ledger by its idempotency
+        key, and a message already sent is not sent again.
+        Its database connection is closed when the session is closed.
+
+    Examples
+    --------
+    >>> import labmail
+    >>> with labmail.Session() as session:
+    ...     session.send("foo@example.com", "Body text here", "Subject here")
+    ...     session.send("bar@example.com", "Body text here", "Subject here")
+
+    The credentials will be saved to `credentials_filepath` when the session is closed.
+    """
+
+    def __init__(
+        self,
+        credentials_filepath: str | os.PathLike[str] = "credentials.json",
+        scopes: list[str] | None = None,
+        *,
+        thread_safe: bool = False,
+        cache_dir: str | os.PathLike[str] | None = None,
+        sendas_ttl: float = cache.SendAsCache.DEFAULT_TTL,
+        subject_sync_interval: float = 300.0,
+        refresh_signature: bool = False,
+        ledger: ledger.SendLedger | None = None,
+    ) -> None:
+        self.credentials_filepath = credentials_filepath
+        self.scopes = scopes
+        self.thread_safe = thread_safe
+        self.cache_dir = cache_dir
+        self.sendas_ttl = sendas_ttl
+        self.subject_sync_interval = subject_sync_interval
+        self.refresh_signature = refresh_signature
+        self.ledger = ledger
+        self._lock = threading.Lock()
+        self._exit_stack: contextlib.ExitStack | None = None
+        self._creds: _credentials.Credentials | None = None
+        self._document: dict[str, t.Any] | None = None
+        self._rsc: resources.GmailResource | None = None
+        self._sendas: dict[str | None, schemas.SendAs] | None = None
+        self._sendas_retrieved = False
+        self._subject_index: cache.SubjectIndex | None = None
+        self._subject_index_lock = threading.Lock()
+        self._subject_index_synced_at: float | None = None
+        self._backfill: tuple[threading.Thread, threading.Event] | None = None
+        self._searched_subjects: dict[str, bool] = dict()
+        self._reserved_subjects: set[str] = set()
+        self._converter = text_utils.HTMLConverter()
+
+    def __enter__(self) -> Session:
+        return self.open()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.close(exc_type, exc_value, traceback)
+
+    @property
+    def is_open(self) -> bool:
+        """Whether the session is open."""
+        return self._exit_stack is not None
+
+    @property
+    def rsc(self) -> resources.GmailResource:
+        """
+        The Resource object for interacting with Gmail API.
+
+        Raises
+        ------
+        RuntimeError
+            If the session is not open.
+        """
+        if self._rsc is None:
+            raise RuntimeError("The session is not open")
+        return self._rsc
+
+    def open(self) -> Session:
+        """
+        Loads the credentials and builds a GmailResource object.
+
+        Returns
+        -------
+        labmail.Session
+            The session itself.
+        """
+        if self.is_open:
+            return self
+        logger.info("Building a Gmail Resource object")
+        with contextlib.ExitStack() as stack:
+            with timing.phase(timing.Phase.AUTH):
+                creds = stack.enter_context(
+                    gmail_api.credentials(self.credentials_filepath, self.scopes)
+                )
+            with timing.phase(timing.Phase.BUILD):
+                document = None
+                if self.cache_dir is not None:
+                    document = cache.DiscoveryCache(self.cache_dir).load()
+                self._rsc = gmail_api.build(
+                    creds, thread_safe=self.thread_safe, document=document
+                )
+            self._creds = creds
+            self._document = document
+            self._exit_stack = stack.pop_all()
+        logger.info("Successfully built the Gmail Resource")
+        return self
+
+    def close(
+        self,
+        exc_type: type[BaseException] | None = None,
+        exc_value: BaseException | None = None,
+        traceback: types.TracebackType | None = None,
+    ) -> None:
+        """
+        Closes the session and saves the credentials.
+
+        Notes
+        -----
+        The credentials won't be saved if the session is closed with an exception.
+        """
+        if self._exit_stack is None:
+            return
+        exit_stack, self._exit_stack = self._exit_stack, None
+        if self._backfill is not None:
+            thread, stopped = self._backfill
+            stopped.set()
+            thread.join()
+            self._backfill = None
+        if self._subject_index is not None:
+            self._subject_index.close()
+        if self.ledger is not None:
+            # reopened if the ledger is used again
+            self.ledger.close()
+            self._subject_index = None
+        self._subject_index_synced_at = None
+        self._creds = None
+        self._document = None
+        self._rsc = None
+        self._sendas = None
+        self._sendas_retrieved = False
+        self._searched_subjects = dict()
+        exit_stack.__exit__(exc_type, exc_value, traceback)
+
+    def get_sendas(self, address: str | None = None) -> schemas.SendAs:
+        """
+        Gets a sendas registered on Gmail, retrieving them only once per session.
+
+        If `cache_dir` is given, the sendas are loaded from the cache on disk
+        unless it is expired or lacks the address.
+
+        Parameters
+        ----------
+        address : str | None
+            The send-as alias address to be retrieved.
+            If None, the default send-as alias is retrieved.
+
+        Returns
+        -------
+        SendAs
+            The retrieved SendAs object.
+
+        Raises
+        ------
+        ValueError
+            If any sendas for the address is not found.
+        """
+        with timing.phase(timing.Phase.SENDAS), self._lock:
+            if self._sendas is None or (
+                address not in self._sendas and not self._sendas_retrieved
+            ):
+                self._sendas = self._load_sendas(
+                    refresh=self.refresh_signature or self._sendas is not None
+                )
+            if address not in self._sendas:
+                raise ValueError(f"Signatures of {address} not found")
+            return self._sendas[address]
+
+    def _load_sendas(self, refresh: bool) -> dict[str | None, schemas.SendAs]:
+        sendas_cache = None
+        if self.cache_dir is not None:
+            account = str(pathlib.Path(self.credentials_filepath).resolve())
+            sendas_cache = cache.SendAsCache(self.cache_dir, account, self.sendas_ttl)
+            if not refresh:
+                sendas_list = sendas_cache.load()
+                if sendas_list is not None:
+                    logger.info("Loaded the sendas from the cache")
+                    return gmail_api.index_sendas(sendas_list)
+        logger.info("Retrieving the sendas from Gmail")
+        sendas_list = gmail_api.list_sendas(self.rsc)
+        logger.info(f"Successfully retrieved {len(sendas_list)} sendas")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("The retrieved sendas are...\n" + pprint.pformat(sendas_list))
+        if sendas_cache is not None:
+            sendas_cache.save(sendas_list)
+        self._sendas_retrieved = True
+        return gmail_api.index_sendas(sendas_list)
+
+    def is_subject_used(self, subject: str) -> bool:
+        """
+        Checks whether the subject has been already used to send a message.
+
+        See `find_used_subjects()` for details.
+
+        Parameters
+        ----------
+        subject : str
+            The subject to check.
+
+        Returns
+        -------
+        bool
+            True if a sent message with the subject is found.
+        """
+        return subject in self.find_used_subjects([subject])
+
+    def find_used_subjects(self, subjects: abc.Iterable[str]) -> set[str]:
+        """
+        Finds the subjects which have been already used to send messages.
+
+        If `cache_dir` is given, the subjects are looked up in the index
+        of the sent subjects on disk (see `labmail.cache.SubjectIndex`),
+        which is synced with Gmail every `subject_sync_interval` seconds.
+        The index is backfilled with the messages sent before in a background
+        thread, `labmail.cache.SubjectIndex.BACKFILL_LIMIT` messages at a time,
+        and resumed by the next session if this session is closed before that.
+        Until the backfill completes, or if `cache_dir` is not given,
+        the sent messages are searched on Gmail with a few combined queries
+        (see `labmail.gmail_api.find_subjects()`),
+        and the results are kept while the session is open.
+        Either way, the subjects must match exactly except for the whitespace.
+
+        Parameters
+        ----------
+        subjects : Iterable[str]
+            The subjects to check.
+
+        Returns
+        -------
+        set[str]
+            The subjects in `subjects` used by any sent message.
+        """
+        subjects = set(subjects)
+        subject_index = self._get_subject_index()
+        if subject_index is not None and subject_index.synced_at is not None:
+            self._sync_subject_index(subject_index)
+            return {subject for subject in subjects if subject_index.contains(subject)}
+        with self._lock:
+            unknown = subjects - self._searched_subjects.keys()
+        if unknown:
+            found = gmail_api.find_subjects(self.rsc, subjects=unknown)
+            with self._lock:
+                for subject in unknown:
+                    self._searched_subjects[subject] = subject in found
+        with self._lock:
+            return {subject for subject in subjects if self._searched_subjects[subject]}
+
+    def _get_subject_index(self) -> cache.SubjectIndex | None:
+        if self.cache_dir is None:
+            return None
+        with self._lock:
+            if self._subject_index is None:
+                account = str(pathlib.Path(self.credentials_filepath).resolve())
+                self._subject_index = cache.SubjectIndex(self.cache_dir, account)
+                if self._subject_index.synced_at is None:
+                    self._start_backfill(self._subject_index)
+            return self._subject_index
+
+    def _start_backfill(self, subject_index: cache.SubjectIndex) -> None:
+        assert self._creds is not None
+        stopped = threading.Event()
+        thread = threading.Thread(
+            target=self._run_backfill,
+            args=(subject_index, self._creds, self._document, stopped),
+            name="labmail-backfill",
+            daemon=True,
+        )
+        self._backfill = (thread, stopped)
+        thread.start()
+
+    @staticmethod
+    def _run_backfill(
+        subject_index: cache.SubjectIndex,
+        creds: _credentials.Credentials,
+        document: dict[str, t.Any] | None,
+        stopped: threading.Event,
+    ) -> None:
+        # the thread has its own Resource object since httplib2 is not thread-safe
+        try:
+            rsc = gmail_api.build(creds, document=document)
+            logger.info("Backfilling the index of the sent subjects")
+            scanned = 0
+            while not stopped.is_set() and subject_index.synced_at is None:
+                scanned += subject_index.sync(rsc, limit=subject_index.BACKFILL_LIMIT)
+            logger.info(f"Backfilled the index with {scanned} sent messages")
+        except Exception as err:
+            logger.warning(f"Failed to backfill the index of the sent subjects: {err}")
+
+    def _sync_subject_index(self, subject_index: cache.SubjectIndex) -> None:
+        with self._subject_index_lock:
+            now = time.monotonic()
+            if (
+                self._subject_index_synced_at is not None
+                and now - self._subject_index_synced_at < self.subject_sync_interval
+            ):
+                return
+            logger.info("Syncing the index of the sent subjects with Gmail")
+            scanned = subject_index.sync(self.rsc)
+            logger.info(f"Successfully synced {scanned} sent messages")
+            self._subject_index_synced_at = now
+
+    @contextlib.contextmanager
+    def _reserve_subjects(self, subjects: abc.Iterable[str]) -> abc.Iterator[set[str]]:
+        """
+        Reserves the subjects to send messages with them until the exit.
+
+        Yields the reserved subjects, excluding the ones reserved by the messages
+        being sent in the other threads, which should be regarded as used.
+        The subjects of the sent messages are recorded before the exit,
+        so that checking a subject and sending a message with it are atomic.
+        """
+        with self._lock:
+            reserved = set(subjects) - self._reserved_subjects
+            self._reserved_subjects |= reserved
+        try:
+            yield reserved
+        finally:
+            with self._lock:
+                self._reserved_subjects -= reserved
+
+    def _record_subjects(self, subjects: abc.Iterable[str]) -> None:
+        subjects = list(subjects)
+        if self._subject_index is not None:
+            self._subject_index.add(subjects)
+        with self._lock:
+            self._searched_subjects.update(dict.fromkeys(subjects, True))
+
+    def build_message(
+        self,
+        recipient: str | list[str],
+        body: str | abc.Iterable[str] = "",
+        subject: str = "",
+        *,
+        text_type: TextType = TextType.PLAIN,
+        headers: dict[str, str] | None = None,
+        sendas_address: str | None = None,
+        attachments: abc.Sequence[str | os.PathLike[str]] | None = None,
+    ) -> mime_base.MIMEBase:
+        """
+        Builds an HTML message with the signature.
+
+        Parameters
+        ----------
+        recipient : str | list[str]
+            The email address(es) of recipient.
+        body : str | Iterable[str]
+            The body text of the message, or its lines such as a file object.
+            If the HTML of the lines is larger than `STREAMED_BODY_SIZE`,
+            the lines are converted to HTML when the message is written
+            by `labmail.mime.write_message()` without holding the whole text
+            (see `labmail.text_utils.iter_text_to_html()`),
+            so the message can be written only once.
+        subject : str
+            The subject of the message.
+        text_type : labmail.TextType
+            The text type of the body.
+        headers : dict[str, str] | None
+            The headers to be appended to the message such as CC or BCC.
+        sendas_address : str | None
+            The address for the signature.
+            If None, the default signature will be used.
+        attachments : Sequence[str | os.PathLike[str]] | None
+            The paths to the files to attach.
+            They are read when the message is sent, not when it is built.
+
+        Returns
+        -------
+        email.mime.base.MIMEBase
+            The built message, which is multipart if any file is attached.
+
+        Raises
+        ------
+        FileNotFoundError
+            If any file to attach does not exist.
+        """
+        sendas = self.get_sendas(sendas_address)
+
+        with timing.phase(timing.Phase.RENDER):
+            logger.info("Building the HTML message")
+            message: mime_base.MIMEBase
+            rest: abc.Iterator[str] | None = None
+            if isinstance(body, str):
+                chunks = [self._converter.convert(body, text_type)]
+            else:
+                chunks, rest = _take_chunks(
+                    text_utils.iter_text_to_html(body, text_type), STREAMED_BODY_SIZE
+                )
+            if rest is None:
+                html_body = "".join([*chunks, "<div>--</div>", sendas["signature"]])
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("The HTML body is...\n" + html_body)
+                message = mime_text.MIMEText(html_body, "html")
+            else:
+                # the rest is converted and encoded line by line
+                # when the message is written
+                message = mime.StreamedText(
+                    itertools.chain(
+                        chunks, rest, ["<div>--</div>", sendas["signature"]]
+                    ),
+                    "html",
+                )
+            if attachments:
+                multipart = mime_multipart.MIMEMultipart()
+                multipart.attach(message)
+                for filepath in attachments:
+                    multipart.attach(mime.FileAttachment(filepath))
+                message = multipart
+            message["subject"] = subject
+            message["to"] = (
+                recipient if isinstance(recipient, str) else ",".join(recipient)
+            )
+            for name, value in (headers or dict()).items():
+                message.add_header(name, value)
+            logger.info("Successfully built the HTML message")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("The message is...\n" + message.as_string())
+        return message
+
+    def send(
+        self,
+        recipient: str | list[str],
+        body: str | abc.Iterable[str] = "",
+        subject: str = "",
+        *,
+        text_type: TextType = TextType.PLAIN,
+        headers: dict[str, str] | None = None,
+        disallow_same_subjects: bool = False,
+        sendas_address: str | None = None,
+        attachments: abc.Sequence[str | os.PathLike[str]] | None = None,
+        dry_run: bool = False,
+        idempotency_key: str | None = None,
+    ) -> schemas.Message | None:
+        """
+        Sends a message via Gmail.
+
+        See `labmail.send()` for the parameters.
+
+        Returns
+        -------
+        Message | None
+            The sent Message object, or None for dry-run mode.
+            If the message has been already sent with the same idempotency key,
+            the Message object with the ID and the thread ID recorded in the ledger.
+
+        Raises
+        ------
+        labmail.SubjectUsedError
+            If the subject has been already used to send the message,
+            or is being used by the message sent in the other thread.
+        labmail.ledger.SendInProgressError
+            If a message with the same idempotency key is being sent.
+        """
+        with self._reserve_subjects(
+            [subject] if disallow_same_subjects else []
+        ) as reserved:
+            key = self._get_idempotency_key(recipient, body, subject, idempotency_key)
+            if key is not None and not dry_run:
+                sent = self._begin_send(key)
+                if sent is not None:
+                    logger.info(f"The message has been already sent as {sent['id']}")
+                    return sent
+            else:
+                key = None
+
+            posted = False
+            try:
+                if disallow_same_subjects:
+                    logger.info("Checking whether the subject has been already used")
+                    with timing.phase(timing.Phase.SUBJECT_CHECK):
+                        used = subject not in reserved or self.is_subject_used(subject)
+                    if used:
+                        raise SubjectUsedError(
+                            f"The subject has been already used: {subject}"
+                        )
+                    logger.info("The subject is not used yet")
+
+                message = self.build_message(
+                    recipient,
+                    body,
+                    subject,
+                    text_type=text_type,
+                    headers=headers,
+                    sendas_address=sendas_address,
+                    attachments=attachments,
+                )
+                if key is not None and "message-id" not in message:
+                    message["Message-ID"] = ledger.message_id(key)
+
+                logger.info("Sending the message")
+                if dry_run:
+                    logger.info("The message is not sent for dry-run mode")
+                    return None
+                posted = True
+                response = gmail_api.send_message(self.rsc, message=message)
+            except BaseException as err:
+                if key is not None:
+                    self._fail_send(key, err if posted else None)
+                raise
+            logger.info("Successfully sent the message")
+            if key is not None:
+                self._complete_send(key, response)
+            self._record_subjects([subject])
+            return response
+
+    def _get_idempotency_key(
+        self,
+        recipient: str | list[str],
+        body: str | abc.Iterable[str],
+        subject: str,
+        idempotency_key: str | None,
+    ) -> str | None:
+        if self.ledger is None:
+            if idempotency_key is not None:
+                raise ValueError("The idempotency key is given without the ledger")
+            return None
+        if idempotency_key is not None:
+            return idempotency_key
+        if not isinstance(body, str):
+            raise ValueError("The idempotency key is required for the body of lines")
+        return ledger.fingerprint(recipient, subject, body)
+
+    def _begin_send(self, key: str) -> schemas.Message | None:
+        """
+        Records the message as pending in the ledger.
+
+        Returns the message already sent with the key instead, looking up
+        the message on Gmail if the previous send has failed ambiguously.
+        """
+        assert self.ledger is not None
+        with timing.phase(timing.Phase.LEDGER):
+            while (entry := self.ledger.begin(key)) is not None:
+                if entry.status is ledger.Status.SENT:
+                    sent: schemas.Message = {"id": t.cast(str, entry.message_id)}
+                    if entry.thread_id is not None:
+                        sent["threadId"] = entry.thread_id
+                    return sent
+                if not self.ledger.is_abandoned(entry):
+                    raise ledger.SendInProgressError(
+                        f"The message is being sent with the key: {key}"
+                    )
+                logger.info("Looking up the message sent before on Gmail")
+                messages, _, _ = gmail_api.list_message(
+                    self.rsc,
+                    query=f"in:sent rfc822msgid:{ledger.message_id(key).strip('<>')}",
+                    max_results=1,
+                )
+                if messages:
+                    self.ledger.complete(
+                        key, messages[0]["id"], messages[0].get("threadId")
+                    )
+                    return messages[0]
+                if self.ledger.take_over(entry):
+                    break
+        return None
+
+    def _complete_send(self, key: str, response: schemas.Message) -> None:
+        assert self.ledger is not None
+        with timing.phase(timing.Phase.LEDGER):
+            self.ledger.complete(key, response["id"], response.get("threadId"))
+
+    def _fail_send(self, key: str, error: BaseException | None) -> None:
+        """
+        Records the failure to send the message in the ledger.
+
+        `error` is the error after posting the request, or None if the request
+        has not been posted. The message might have been sent unless Gmail
+        has rejected the request with a client error.
+        """
+        assert self.ledger is not None
+        ambiguous = error is not None and not (
+            isinstance(error, errors.HttpError) and error.resp.status < 500
+        )
+        self.ledger.fail(key, ambiguous=ambiguous)
+
+    def send_many(
+        self,
+        drafts: abc.Iterable[Draft],
+        *,
+        disallow_same_subjects: bool = False,
+        dry_run: bool = False,
+        batch_size: int = 50,
+    ) -> list[schemas.Message | Exception | None]:
+        """
+        Sends messages via Gmail with batch requests.
+
+        Parameters
+        ----------
+        drafts : Iterable[labmail.Draft]
+            The messages to send.
+        disallow_same_subjects : bool
+            If true, the messages whose subjects have been already used,
+            including by the preceding drafts and by the messages being sent
+            in the other threads, are not sent.
+        dry_run : bool
+            If true, does not post the send requests to Gmail API.
+        batch_size : int
+            The number of messages in a batch request.
+
+        Returns
+        -------
+        list[Message | Exception | None]
+            The sent Message objects or the errors, in the order of `drafts`.
+            labmail.SubjectUsedError is returned for the message whose subject
+            has been already used, and None for dry-run mode.
+            The message already sent with the same idempotency key is not sent
+            again, and the Message object recorded in the ledger is returned.
+        """
+        results: list[schemas.Message | Exception | None] = list()
+        indices: list[int] = list()
+        keys: list[str | None] = list()
+        messages: list[mime_base.MIMEBase] = list()
+        used_subjects: set[str] = set()
+        found_subjects: set[str] = set()
+        if disallow_same_subjects:
+            drafts = list(drafts)
+        with self._reserve_subjects(
+            [draft.subject for draft in drafts] if disallow_same_subjects else []
+        ) as reserved:
+            if disallow_same_subjects:
+                subjects = {draft.subject for draft in drafts}
+                with timing.phase(timing.Phase.SUBJECT_CHECK):
+                    found_subjects = self.find_used_subjects(reserved)
+                # the subjects reserved by the other threads are being used
+                found_subjects |= subjects - reserved
+            try:
+                for draft in drafts:
+                    results.append(None)
+                    try:
+                        key = self._get_idempotency_key(
+                            draft.recipient,
+                            draft.body,
+                            draft.subject,
+                            draft.idempotency_key,
+                        )
+                        if key is not None and not dry_run:
+                            sent = self._begin_send(key)
+                            if sent is not None:
+                                results[-1] = sent
+                                continue
+                        else:
+                            key = None
+                    except (ValueError, ledger.SendInProgressError) as err:
+                        results[-1] = err
+                        continue
+                    try:
+                        if disallow_same_subjects:
+                            if (
+                                draft.subject in used_subjects
+                                or draft.subject in found_subjects
+                            ):
+                                raise SubjectUsedError(
+                                    "The subject has been already used:"
+                                    f" {draft.subject}"
+                                )
+                            used_subjects.add(draft.subject)
+                        message = self.build_message(
+                            draft.recipient,
+                            draft.body,
+                            draft.subject,
+                            text_type=draft.text_type,
+                            headers=draft.headers,
+                            sendas_address=draft.sendas_address,
+                        )
+                    except Exception as err:
+                        if key is not None:
+                            self._fail_send(key, None)
+                        if not isinstance(err, ValueError):
+                            raise
+                        results[-1] = err
+                        continue
+                    if key is not None and "message-id" not in message:
+                        message["Message-ID"] = ledger.message_id(key)
+                    indices.append(len(results) - 1)
+                    keys.append(key)
+                    messages.append(message)
+            except BaseException:
+                # the messages queued are not sent
+                for key in keys:
+                    if key is not None:
+                        self._fail_send(key, None)
+                raise
+
+            logger.info(f"Sending {len(messages)} messages")
+            if dry_run:
+                logger.info("The messages are not sent for dry-run mode")
+                return results
+            try:
+                responses = gmail_api.send_messages(
+                    self.rsc, messages=messages, batch_size=batch_size
+                )
+            except Exception as err:
+                for key in keys:
+                    if key is not None:
+                        self._fail_send(key, err)
+                raise
+            for idx, key, response in zip(indices, keys, responses):
+                results[idx] = response
+                if key is None:
+                    continue
+                if isinstance(response, Exception):
+                    self._fail_send(key, response)
+                else:
+                    self._complete_send(key, response)
+            self._record_subjects(
+                message["subject"]
+                for message, response in zip(messages, responses)
+                if not isinstance(response, Exception)
+            )
+            logger.info("Successfully sent the messages")
+            return results
+
+
+def _take_chunks(
+    chunks: abc.Iterable[str], size: int
+) -> tuple[list[str], abc.Iterator[str] | None]:
+    """
+    Takes the chunks until their characters exceed `size`,
+    and returns them with the rest, or None if all the chunks are taken.
+    """
+    iterator = iter(chunks)
+    taken: list[str] = list()
+    length = 0
+    for chunk in iterator:
+        taken.append(chunk)
+        length += len(chunk)
+        if length > size:
+            return taken, iterator
+    return taken, None
+
+
+class SubjectUsedError(ValueError):
+    """If the subject has already been used."""
@@ -0,0 +1,584 @@
+"""
+This module provides a fake Gmail API server on localhost,
+so that the code using this library can be tested and load-tested
+without requesting to Gmail.
+
+The server implements the methods used by this library
+(see `labmail.gmail_api.USED_METHODS`), the batch requests and
+the resumable uploads, and keeps the messages in memory.
+The latency, the server errors and the throttling by a rate limit
+can be injected.
+"""
+
+from __future__ import annotations
+
+import base64
+import email.message
+import email.parser
+import email.policy
+import http
+import http.server
+import itertools
+import json
+import os
+import pathlib
+import random
+import re
+import secrets
+import threading
+import time
+import types
+import typing as t
+import urllib.parse
+from collections import abc
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+DEFAULT_SENDAS: list[schemas.SendAs] = [
+    {
+        "sendAsEmail": "me@example.com",
+        "displayName": "Me",
+        "isDefault": True,
+        "isPrimary": True,
+        "signature": "<div>Me<br>Example Lab.</div>",
+    }
+]
+"""The sendas returned by the server by default."""
+
+_LIST_PATH = re.compile(r"/gmail/v1/users/([^/]+)/messages")
+_SEND_PATH = re.compile(r"/gmail/v1/users/([^/]+)/messages/send")
+_GET_PATH = re.compile(r"/gmail/v1/users/([^/]+)/messages/([^/]+)")
+_SENDAS_PATH = re.compile(r"/gmail/v1/users/([^/]+)/settings/sendAs")
+_UPLOAD_PATH = re.compile(r"/upload/gmail/v1/users/([^/]+)/messages/send")
+_BATCH_PATH = "/batch"
+_QUERY_TOKEN = re.compile(r'(\w+):(\("[^"]*"\)|"[^"]*"|[^\s()]+)|\b(OR)\b|(\()|(\))')
+_WORD = re.compile(r"\w+")
+_CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+_Response = tuple[int, dict[str, str], bytes]
+
+
+class FakeGmailServer(http.server.ThreadingHTTPServer):
+    """
+    A fake Gmail API server running in a background thread on localhost.
+
+    Build a Resource object with `labmail.gmail_api.build()` with `root_url`
+    to request to the server, or set the environment variable
+    LABMAIL_GMAIL_API_ROOT_URL to `root_url` for the other processes.
+
+    The server does not check the credentials.
+    Only `in:sent`, `after:`, `before:`, `subject:` and `rfc822msgid:` combined with
+    `OR` and parentheses are supported in the queries of users.messages.list,
+    and the other terms are ignored.
+
+    Parameters
+    ----------
+    latency : float
+        The seconds to wait before answering each HTTP request.
+        A batch request waits once for all of its requests.
+    error_rate : float
+        The probability that a request fails with 500 Internal Server Error.
+    batch_error_rate : float
+        The probability that a batch request fails as a whole
+        with 503 Service Unavailable before any of its requests is handled.
+    rate_limit : float | None
+        The number of the requests per second allowed on average.
+        The requests beyond it fail with 429 Too Many Requests,
+        while bursts of up to `rate_limit` requests are allowed.
+        If None, the requests are not throttled.
+    retry_after : float | None
+        The seconds in the Retry-After header of the throttled responses.
+        If None, the header is not sent.
+    sendas : list[SendAs] | None
+        The sendas returned by users.settings.sendAs.list.
+        If None, `DEFAULT_SENDAS` is used.
+    seed : int | None
+        The seed of the random errors.
+    port : int
+        The port to listen on. If 0, a free port is chosen.
+
+    Attributes
+    ----------
+    messages : dict[str, Message]
+        The sent or added messages keyed by the IDs,
+        which have both `raw` and the headers in `payload`.
+    num_requests : int
+        The number of the requests to the methods, counting each request
+        in the batch requests and each chunk of the uploads.
+    num_errors : int
+        The number of the requests and the batch requests failed
+        with the injected errors.
+    num_throttled : int
+        The number of the requests throttled by the rate limit.
+
+    Examples
+    --------
+    >>> with FakeGmailServer(latency=0.05, rate_limit=100) as server:
+    ...     rsc = gmail_api.build(creds, root_url=server.root_url)
+    ...     gmail_api.send_message(rsc, message=message)
+    >>> len(server.messages)
+    1
+
+    As a pytest fixture:
+
+    >>> @pytest.fixture()
+    ... def fake_gmail() -> Iterator[FakeGmailServer]:
+    ...     with FakeGmailServer() as server:
+    ...         yield server
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        batch_error_rate: float = 0.0,
+        rate_limit: float | None = None,
+        retry_after: float | None = None,
+        sendas: list[schemas.SendAs] | None = None,
+        seed: int | None = None,
+        port: int = 0,
+    ) -> None:
+        super().__init__(("127.0.0.1", port), _RequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.batch_error_rate = batch_error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.sendas = list(DEFAULT_SENDAS) if sendas is None else sendas
+        self.messages: dict[str, schemas.Message] = dict()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_throttled = 0
+        self._random = random.Random(seed)
+        self._tokens = max(rate_limit or 0.0, 1.0)
+        self._refilled_at = time.monotonic()
+        self._ids = itertools.count(1)
+        self._uploads: dict[str, bytearray] = dict()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def __enter__(self) -> FakeGmailServer:
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        self.stop()
+
+    @property
+    def root_url(self) -> str:
+        """The root URL of the server to request to instead of Gmail API."""
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}/"
+
+    def start(self) -> None:
+        """Starts serving in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stops serving and closes the socket."""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def add_message(
+        self,
+        message: email.message.Message | bytes,
+        *,
+        label_ids: abc.Sequence[str] = ("SENT",),
+        timestamp: float | None = None,
+    ) -> schemas.Message:
+        """
+        Adds a message to the mailbox.
+
+        Parameters
+        ----------
+        message : email.message.Message | bytes
+            The message or the message in the RFC 2822 format.
+        label_ids : Sequence[str]
+            The labels of the message.
+        timestamp : float | None
+            The time when the message was received in seconds since the epoch.
+            If None, the current time is used.
+
+        Returns
+        -------
+        Message
+            The added Message object.
+        """
+        raw = message if isinstance(message, bytes) else message.as_bytes()
+        parsed = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+            raw, headersonly=True
+        )
+        with self._lock:
+            id = f"{next(self._ids):016x}"
+            added: schemas.Message = {
+                "id": id,
+                "threadId": id,
+                "labelIds": list(label_ids),
+                "snippet": "",
+                "sizeEstimate": len(raw),
+                "internalDate": str(int((timestamp or time.time()) * 1000)),
+                "payload": {
+                    "mimeType": parsed.get_content_type(),
+                    "headers": [
+                        {"name": name, "value": str(value)}
+                        for name, value in parsed.items()
+                    ],
+                },
+                "raw": base64.urlsafe_b64encode(raw).decode(),
+            }
+            self.messages[id] = added
+        return added
+
+    def dispatch(
+        self, method: str, target: str, headers: email.message.Message, body: bytes
+    ) -> _Response:
+        """
+        Handles a request.
+
+        Parameters
+        ----------
+        method : str
+            The HTTP method.
+        target : str
+            The path and the query of the URL.
+        headers : email.message.Message
+            The headers of the request.
+        body : bytes
+            The body of the request.
+
+        Returns
+        -------
+        tuple[int, dict[str, str], bytes]
+            The status, the headers and the body of the response.
+        """
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if method == "POST" and url.path == _BATCH_PATH:
+            return self._dispatch_batch(headers.get("Content-Type", ""), body)
+        fault = self._inject_fault()
+        if fault is not None:
+            return fault
+        if method == "GET" and _SENDAS_PATH.fullmatch(url.path):
+            return _json_response(200, {"sendAs": self.sendas})
+        if method == "GET" and _LIST_PATH.fullmatch(url.path):
+            return _json_response(200, self._list_messages(query))
+        if method == "POST" and _SEND_PATH.fullmatch(url.path):
+            try:
+                raw = json.loads(body)["raw"]
+                content = base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4))
+            except (ValueError, KeyError, TypeError):
+                return _error_response(400, "invalidArgument", "Invalid raw message")
+            return _json_response(200, _view(self.add_message(content), "minimal"))
+        if method == "GET" and (match := _GET_PATH.fullmatch(url.path)):
+            message = self.messages.get(match[2])
+            if message is None:
+                return _error_response(
+                    404, "notFound", "Requested entity was not found."
+                )
+            fmt = query.get("format", ["full"])[0]
+            return _json_response(
+                200, _view(message, fmt, query.get("metadataHeaders", []))
+            )
+        if _UPLOAD_PATH.fullmatch(url.path):
+            return self._upload(method, query, headers, body)
+        return _error_response(404, "notFound", f"Not found: {method} {url.path}")
+
+    def _inject_fault(self) -> _Response | None:
+        with self._lock:
+            self.num_requests += 1
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._tokens + (now - self._refilled_at) * self.rate_limit,
+                    max(self.rate_limit, 1.0),
+                )
+                self._refilled_at = now
+                if self._tokens < 1.0:
+                    self.num_throttled += 1
+                    status, headers, content = _error_response(
+                        429, "rateLimitExceeded", "User-rate limit exceeded."
+                    )
+                    if self.retry_after is not None:
+                        headers["Retry-After"] = f"{self.retry_after:g}"
+                    return status, headers, content
+                self._tokens -= 1.0
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.num_errors += 1
+                return _error_response(500, "backendError", "Backend Error")
+        return None
+
+    def _list_messages(self, query: dict[str, list[str]]) -> dict[str, t.Any]:
+        with self._lock:
+            messages = list(self.messages.values())
+        messages = [
+            message
+            for message in messages
+            if _matches(message, query.get("q", [""])[0])
+        ]
+        messages.sort(key=lambda message: -int(message["internalDate"]))
+        offset = int(query.get("pageToken", ["0"])[0])
+        max_results = int(query.get("maxResults", ["100"])[0])
+        page = messages[offset : offset + max_results]
+        response: dict[str, t.Any] = {"resultSizeEstimate": len(messages)}
+        if page:
+            response["messages"] = [
+                {"id": message["id"], "threadId": message["threadId"]}
+                for message in page
+            ]
+        if offset + max_results < len(messages):
+            response["nextPageToken"] = str(offset + max_results)
+        return response
+
+    def _upload(
+        self,
+        method: str,
+        query: dict[str, list[str]],
+        headers: email.message.Message,
+        body: bytes,
+    ) -> _Response:
+        if method == "POST":
+            if query.get("uploadType") != ["resumable"]:
+                return _error_response(
+                    400, "invalidArgument", "Only resumable uploads are supported"
+                )
+            upload_id = secrets.token_hex(8)
+            with self._lock:
+                self._uploads[upload_id] = bytearray()
+            location = (
+                f"{self.root_url}upload/gmail/v1/users/me/messages/send"
+                f"?uploadType=resumable&upload_id={upload_id}"
+            )
+            return 200, {"Location": location}, b""
+        upload_id = query.get("upload_id", [""])[0]
+        with self._lock:
+            data = self._uploads.get(upload_id)
+        match = _CONTENT_RANGE.fullmatch(headers.get("Content-Range", ""))
+        if method != "PUT" or data is None or match is None:
+            return _error_response(404, "notFound", "Upload session not found")
+        if match[1] is not None:
+            if int(match[1]) != len(data):
+                return _error_response(400, "invalidArgument", "Invalid range")
+            data += body
+        if match[3] != "*" and len(data) >= int(match[3]):
+            with self._lock:
+                del self._uploads[upload_id]
+            return _json_response(200, _view(self.add_message(bytes(data)), "minimal"))
+        response_headers = {"Range": f"bytes=0-{len(data) - 1}"} if data else dict()
+        return 308, response_headers, b""
+
+    def _dispatch_batch(self, content_type: str, body: bytes) -> _Response:
+        batch = email.parser.Parser().parsestr(
+            f"Content-Type: {content_type}\r\n\r\n{body.decode()}"
+        )
+        if not batch.is_multipart():
+            return _error_response(400, "invalidArgument", "Invalid batch request")
+        with self._lock:
+            if self.batch_error_rate and self._random.random() < self.batch_error_rate:
+                self.num_errors += 1
+                return _error_response(503, "backendError", "Service Unavailable")
+        boundary = f"batch_{secrets.token_hex(16)}"
+        lines = list()
+        parts = t.cast("list[email.message.Message]", batch.get_payload())
+        for part in parts:
+            request_line, request = str(part.get_payload()).split("\n", 1)
+            method, target, _ = request_line.split(" ", 2)
+            message = email.parser.Parser().parsestr(request)
+            status, headers, content = self.dispatch(
+                method, target, message, str(message.get_payload()).encode()
+            )
+            headers.setdefault("Content-Type", "application/json; charset=UTF-8")
+            lines.extend(
+                [
+                    f"--{boundary}",
+                    "Content-Type: application/http",
+                    f"Content-ID: <response-{str(part['Content-ID'])[1:]}",
+                    "",
+                    f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+                    *(f"{key}: {value}" for key, value in headers.items()),
+                    "",
+                    content.decode(),
+                ]
+            )
+        lines.extend([f"--{boundary}--", ""])
+        return (
+            200,
+            {"Content-Type": f"multipart/mixed; boundary={boundary}"},
+            "\r\n".join(lines).encode(),
+        )
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    server: FakeGmailServer
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately, which a delayed ACK
+    # of the client would stall for tens of milliseconds on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def do_PUT(self) -> None:
+        self._handle()
+
+    def _handle(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        status, headers, content = self.server.dispatch(
+            self.command, self.path, self.headers, body
+        )
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "Content-Type" not in headers:
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args: t.Any) -> None:
+        pass
+
+
+def _json_response(status: int, body: t.Any) -> _Response:
+    return status, dict(), json.dumps(body).encode()
+
+
+def _error_response(status: int, reason: str, message: str) -> _Response:
+    return _json_response(
+        status,
+        {
+            "error": {
+                "code": status,
+                "message": message,
+                "errors": [{"message": message, "domain": "global", "reason": reason}],
+            }
+        },
+    )
+
+
+def _view(
+    message: schemas.Message, fmt: str, metadata_headers: list[str] | None = None
+) -> schemas.Message:
+    view = t.cast("dict[str, t.Any]", dict(message))
+    if fmt != "raw":
+        del view["raw"]
+    if fmt in ("raw", "minimal"):
+        del view["payload"]
+    elif fmt == "metadata" and metadata_headers:
+        names = {name.lower() for name in metadata_headers}
+        view["payload"] = {
+            "mimeType": message["payload"]["mimeType"],
+            "headers": [
+                header
+                for header in message["payload"]["headers"]
+                if header["name"].lower() in names
+            ],
+        }
+    return t.cast("schemas.Message", view)
+
+
+def _matches(message: schemas.Message, query: str) -> bool:
+    tokens = [match.groups() for match in _QUERY_TOKEN.finditer(query)]
+    matched, _ = _match_all(message, tokens, 0)
+    return matched
+
+
+def _match_all(
+    message: schemas.Message, tokens: list[tuple[str | None, ...]], pos: int
+) -> tuple[bool, int]:
+    # the terms are AND-ed until the closing parenthesis
+    matched = True
+    while pos < len(tokens) and tokens[pos][4] is None:
+        alternative, pos = _match_any(message, tokens, pos)
+        matched = matched and alternative
+    return matched, pos
+
+
+def _match_any(
+    message: schemas.Message, tokens: list[tuple[str | None, ...]], pos: int
+) -> tuple[bool, int]:
+    matched, pos = _match_term(message, tokens, pos)
+    while pos < len(tokens) and tokens[pos][2] is not None:
+        alternative, pos = _match_term(message, tokens, pos + 1)
+        matched = matched or alternative
+    return matched, pos
+
+
+def _match_term(
+    message: schemas.Message, tokens: list[tuple[str | None, ...]], pos: int
+) -> tuple[bool, int]:
+    if pos >= len(tokens) or tokens[pos][4] is not None:
+        return True, pos
+    operator, value, _, opening, _ = tokens[pos]
+    if opening is not None:
+        matched, pos = _match_all(message, tokens, pos + 1)
+        return matched, pos + 1
+    if operator is None or value is None:
+        return True, pos + 1
+    return _match_operator(message, operator, value.strip("()").strip('"')), pos + 1
+
+
+def _match_operator(message: schemas.Message, operator: str, value: str) -> bool:
+    match operator:
+        case "in":
+            return value.upper() in message["labelIds"]
+        case "after":
+            return int(message["internalDate"]) > int(value) * 1000
+        case "before":
+            return int(message["internalDate"]) < int(value) * 1000
+        case "subject":
+            # matches the words of the phrase in sequence as Gmail does
+            phrase = f" {' '.join(_WORD.findall(value.lower()))} "
+            return any(
+                header["name"].lower() == "subject"
+                and phrase in f" {' '.join(_WORD.findall(header['value'].lower()))} "
+                for header in message["payload"]["headers"]
+            )
+        case "rfc822msgid":
+            return any(
+                header["name"].lower() == "message-id"
+                and header["value"].strip("<>") == value.strip("<>")
+                for header in message["payload"]["headers"]
+            )
+    return True
+
+
+def write_credentials(filepath: str | os.PathLike[str]) -> None:
+    """
+    Writes an authorized user file whose token never expires,
+    for `labmail.Session` and the command line interface to request to the server.
+
+    Parameters
+    ----------
+    filepath : str | os.PathLike[str]
+        The path to write the file to.
+    """
+    pathlib.Path(filepath).write_text(
+        json.dumps(
+            {
+                "token": "token",
+                "refresh_token": "refresh_token",
+                "client_id": "client_id",
+                "client_secret": "client_secret",
+                "expiry": "2999-01-01T00:00:00Z",
+            }
+        )
+    )
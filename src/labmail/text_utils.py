@@ -1,6 +1,14 @@
+from __future__ import annotations
+
+import collections
 import enum
+import hashlib
+import threading
+import typing as t
+from collections import abc
 
-import markdown
+if t.TYPE_CHECKING:  # pragma: no cover
+    import markdown
 
 
 class TextType(enum.Enum):
@@ -49,21 +57,134 @@ def convert_text_to_html(text: str, text_type: TextType) -> str:
     """
     match text_type:
         case TextType.PLAIN:
-            return (
-                "<p>"
-                + "".join(
-                    [
-                        f"{line}<br>" if line.strip() != "" else "</p><p>"
-                        for line in text.splitlines()
-                    ]
-                )
-                + "</p>"
-            )
+            return "".join(iter_text_to_html(text.splitlines(), text_type))
         case TextType.HTML:
             return text
         case TextType.MARKDOWN:
+            import markdown
+
             return markdown.markdown(text)
         case _:  # pragma: no cover
             raise NotImplementedError(
                 f"The code for {text_type} is not implemented yet."
             )
+
+
+def iter_text_to_html(
+    lines: abc.Iterable[str], text_type: TextType
+) -> abc.Iterator[str]:
+    """
+    Converts any text given line by line to HTML chunk by chunk.
+
+    The plain and HTML texts are converted without holding the whole text,
+    so that a large file can be converted with a constant memory.
+    The Markdown text is read whole before being converted.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        The lines of the text to convert with their newlines, such as a file object.
+        The newlines are not needed for the plain text.
+    text_type : TextType
+        The text type of the text.
+
+    Yields
+    ------
+    str
+        The chunks of the converted HTML text.
+
+    Examples
+    --------
+    >>> with open("body.txt") as f:
+    ...     html_text = "".join(iter_text_to_html(f, TextType.PLAIN))
+    """
+    match text_type:
+        case TextType.PLAIN:
+            yield "<p>"
+            for line in lines:
+                line = line.rstrip("\r\n")
+                yield f"{line}<br>" if line.strip() != "" else "</p><p>"
+            yield "</p>"
+        case TextType.HTML:
+            yield from lines
+        case _:
+            yield convert_text_to_html("".join(lines), text_type)
+
+
+class HTMLConverter:
+    """
+    A converter of texts to HTML for converting many texts.
+
+    Unlike `convert_text_to_html()`, the converter builds a Markdown instance
+    only once and resets it between texts, and keeps the recently converted
+    HTML texts keyed by the hash of the text and the text type,
+    so that the same body is not converted again.
+    It can be shared across threads.
+
+    Parameters
+    ----------
+    cache_size : int
+        The maximum number of the HTML texts to keep. If 0, nothing is kept.
+
+    Examples
+    --------
+    >>> converter = HTMLConverter()
+    >>> converter.convert("# Hello", TextType.MARKDOWN)
+    '<h1>Hello</h1>'
+    """
+
+    def __init__(self, cache_size: int = 128) -> None:
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._markdown: markdown.Markdown | None = None
+        self._cache: collections.OrderedDict[tuple[TextType, bytes], str] = (
+            collections.OrderedDict()
+        )
+
+    def convert(self, text: str, text_type: TextType) -> str:
+        """
+        Converts any text to HTML.
+
+        Parameters
+        ----------
+        text : str
+            The text to convert.
+        text_type : TextType
+            The text type of the text.
+
+        Returns
+        -------
+        str
+            The converted HTML text.
+        """
+        if text_type is TextType.HTML:
+            return text
+        key = (text_type, hashlib.sha256(text.encode()).digest())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if text_type is TextType.MARKDOWN:
+                html_text = self._convert_markdown(text)
+            else:
+                html_text = convert_text_to_html(text, text_type)
+            if self.cache_size > 0:
+                self._cache[key] = html_text
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return html_text
+
+    def _convert_markdown(self, text: str) -> str:
+        if self._markdown is None:
+            import markdown
+
+            self._markdown = markdown.Markdown()
+        try:
+            return self._markdown.convert(text)
+        finally:
+            self._markdown.reset()
+
+    def clear_cache(self) -> None:
+        """Removes the kept HTML texts."""
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,177 @@
+"""
+This module provides the timings of the phases of sending a message.
+
+The phases are measured only while a `Timer` is active in the current context,
+so that the instrumentation costs nothing otherwise.
+The phases run in the other threads are not measured,
+since they do not share the context.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import enum
+import time
+import types
+import typing as t
+from collections import abc
+
+
+class Phase(enum.Enum):
+    AUTH = "auth"
+    """Loading and refreshing the credentials."""
+    BUILD = "build"
+    """Building the Gmail Resource object."""
+    SUBJECT_CHECK = "subject_check"
+    """Checking whether the subject has been already used."""
+    SENDAS = "sendas"
+    """Getting the sendas for the signature."""
+    RENDER = "render"
+    """Converting the body to HTML and building the MIME message."""
+    ENCODE = "encode"
+    """Encoding the MIME message for Gmail API."""
+    HTTP = "http"
+    """Posting the send request to Gmail API."""
+    LEDGER = "ledger"
+    """Looking up and recording the message in the idempotency ledger."""
+
+
+PhaseHook = abc.Callable[[Phase, float], None]
+"""A callback called with a phase and its duration in seconds when it ends."""
+
+_timers: contextvars.ContextVar[tuple[Timer, ...]] = contextvars.ContextVar(
+    "labmail_timers", default=()
+)
+
+
+@dataclasses.dataclass
+class Timings:
+    """
+    The durations of the phases.
+
+    Attributes
+    ----------
+    phases : dict[labmail.timing.Phase, float]
+        The durations in seconds, in the order the phases ended.
+        The durations of a phase run several times are summed up.
+    """
+
+    phases: dict[Phase, float] = dataclasses.field(default_factory=dict)
+
+    @property
+    def total(self) -> float:
+        """The total duration of the phases in seconds."""
+        return sum(self.phases.values())
+
+    def add(self, phase: Phase, seconds: float) -> None:
+        """
+        Adds a duration to a phase.
+
+        Parameters
+        ----------
+        phase : labmail.timing.Phase
+            The phase.
+        seconds : float
+            The duration in seconds.
+        """
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def format(self) -> str:
+        """
+        Formats the durations as a table in milliseconds.
+
+        Returns
+        -------
+        str
+            The lines of the phases and the total.
+        """
+        lines = [
+            f"{phase.value:<16}{seconds * 1000:>10.1f} ms"
+            for phase, seconds in self.phases.items()
+        ]
+        lines.append(f"{'total':<16}{self.total * 1000:>10.1f} ms")
+        return "\n".join(lines)
+
+
+class Timer:
+    """
+    A timer which records the phases run in its context.
+
+    Timers can be nested, and every active timer records the phases.
+
+    Parameters
+    ----------
+    hook : Callable[[labmail.timing.Phase, float], None] | None
+        The callback called when each phase ends.
+
+    Examples
+    --------
+    >>> with Timer() as timer:
+    ...     session.send("foo@example.com", "Body text here", "Subject here")
+    >>> timer.timings.phases
+    {<Phase.SENDAS: 'sendas'>: 0.23, <Phase.RENDER: 'render'>: 0.002, ...}
+    """
+
+    def __init__(self, hook: PhaseHook | None = None) -> None:
+        self.hook = hook
+        self.timings = Timings()
+        self._tokens: list[contextvars.Token[tuple[Timer, ...]]] = list()
+
+    def __enter__(self) -> Timer:
+        self._tokens.append(_timers.set((*_timers.get(), self)))
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        _timers.reset(self._tokens.pop())
+
+    def record(self, phase: Phase, seconds: float) -> None:
+        """
+        Records the duration of a phase and calls the hook.
+
+        Parameters
+        ----------
+        phase : labmail.timing.Phase
+            The phase.
+        seconds : float
+            The duration in seconds.
+        """
+        self.timings.add(phase, seconds)
+        if self.hook is not None:
+            self.hook(phase, seconds)
+
+
+@contextlib.contextmanager
+def phase(phase: Phase) -> t.Iterator[None]:
+    """
+    Measures a phase for the active timers.
+
+    The phase is recorded even if it fails.
+
+    Parameters
+    ----------
+    phase : labmail.timing.Phase
+        The phase to measure.
+
+    Examples
+    --------
+    >>> with phase(Phase.RENDER):
+    ...     html = text_utils.convert_text_to_html(body, text_type)
+    """
+    timers = _timers.get()
+    if not timers:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for timer in timers:
+            timer.record(phase, elapsed)
@@ -1,9 +1,11 @@
 import os
 import pathlib
+import typing as t
 
 import pytest
 import pytest_mock
 
+from labmail import retry, testing
 from tests import FixtureRequest
 
 
@@ -26,3 +28,19 @@ def mock_google_resource(mocker: pytest_mock.MockerFixture) -> None:
     This fixture is aimed to prevent developers from requesting Google API by mistake.
     """
     mocker.patch("googleapiclient.discovery.build")
+
+
+@pytest.fixture(autouse=True)
+def isolate_gmail_api_retry(mocker: pytest_mock.MockerFixture) -> None:
+    """
+    This fixture is aimed to retry the failed requests without waiting,
+    and not to share the concurrency limit across tests.
+    """
+    mocker.patch("labmail.gmail_api.retry_policy", retry.RetryPolicy(base_delay=0))
+    mocker.patch("labmail.gmail_api.concurrency", retry.AIMDController())
+
+
+@pytest.fixture()
+def fake_gmail() -> t.Iterator[testing.FakeGmailServer]:
+    with testing.FakeGmailServer() as server:
+        yield server
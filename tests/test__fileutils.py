@@ -0,0 +1,54 @@
+import pathlib
+import threading
+import time
+
+import pytest
+import pytest_mock
+
+from labmail import _fileutils
+
+
+def test_write_text_atomic(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "dir" / "file.txt"
+    _fileutils.write_text_atomic(filepath, "foo")
+    _fileutils.write_text_atomic(filepath, "bar")
+    assert filepath.read_text() == "bar"
+    assert list(filepath.parent.iterdir()) == [filepath]
+
+
+def test_write_text_atomic_fail(
+    tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture
+) -> None:
+    filepath = tmp_path / "file.txt"
+    filepath.write_text("foo")
+    mocker.patch("os.replace", side_effect=OSError)
+    with pytest.raises(OSError):
+        _fileutils.write_text_atomic(filepath, "bar")
+    assert filepath.read_text() == "foo"
+    assert list(tmp_path.iterdir()) == [filepath]
+
+
+def test_read_text_or_none(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "file.txt"
+    assert _fileutils.read_text_or_none(filepath) is None
+    filepath.write_text("foo")
+    assert _fileutils.read_text_or_none(filepath) == "foo"
+
+
+def test_file_lock(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "dir" / "file.lock"
+    events: list[str] = list()
+
+    def hold() -> None:
+        with _fileutils.file_lock(filepath):
+            events.append("acquired")
+            time.sleep(0.1)
+            events.append("released")
+
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert events == ["acquired", "released"] * 2
+    assert filepath.exists()
@@ -1,11 +1,20 @@
 import itertools
 import os
+import pathlib
+import subprocess
+import sys
+import threading
+import typing as t
 
 import pytest
 import pytest_mock
 from click import exceptions, testing
 
-from labmail import SubjectUsedError, __main__, text_utils
+from labmail import SubjectUsedError, __main__, text_utils, timing
+
+skip_on_windows = pytest.mark.skipif(
+    sys.platform == "win32", reason="The daemon is not supported on Windows"
+)
 
 
 def test_main_success(mocker: pytest_mock.MockerFixture) -> None:
@@ -89,18 +98,433 @@ def test_main_options(
         args.extend(["--sendas", sendas_address])
     if dry_run:
         args.append("--dry-run")
-    send_mock = mocker.patch("labmail.send")
+    bodies: list[str] = list()
+    send_mock = mocker.patch(
+        "labmail.send", side_effect=lambda body, **kwargs: bodies.append("".join(body))
+    )
     runner = testing.CliRunner()
     result = runner.invoke(__main__.main, args, input=body if filename == "-" else None)
     assert result.exit_code == 0
+    assert bodies == [body]
     send_mock.assert_called_once_with(
         recipient=address,
-        body=body,
+        body=mocker.ANY,
         text_type=text_type,
         subject=subject,
         headers=dict(header.split(": ") for header in headers),
         disallow_same_subjects=disallow_same_subjects,
         sendas_address=sendas_address,
+        attachments=tuple(),
         dry_run=dry_run,
         credentials_filepath=credentials_filepath,
+        cache_dir=__main__.CACHE_DIR,
+        refresh_signature=False,
+        ledger_filepath=None,
+        idempotency_key=None,
+    )
+
+
+@pytest.mark.parametrize("refresh_signature", [True, False])
+def test_main_refresh_signature(
+    refresh_signature: bool, mocker: pytest_mock.MockerFixture
+) -> None:
+    send_mock = mocker.patch("labmail.send")
+    args = ["foo@example.com"]
+    if refresh_signature:
+        args.append("--refresh-signature")
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, args, input="")
+    assert result.exit_code == 0
+    assert send_mock.call_args.kwargs["refresh_signature"] is refresh_signature
+
+
+def test_main_attach(tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture) -> None:
+    send_mock = mocker.patch("labmail.send")
+    filepaths = [tmp_path / "foo.pdf", tmp_path / "bar.csv"]
+    for filepath in filepaths:
+        filepath.write_bytes(b"")
+    args = ["foo@example.com"]
+    for filepath in filepaths:
+        args.extend(["--attach", str(filepath)])
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, args, input="")
+    assert result.exit_code == 0
+    assert send_mock.call_args.kwargs["attachments"] == tuple(map(str, filepaths))
+
+
+def test_main_attach_not_found(mocker: pytest_mock.MockerFixture) -> None:
+    send_mock = mocker.patch("labmail.send")
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "--attach", "not_found.pdf"]
+    result = runner.invoke(__main__.main, args, input="")
+    assert result.exit_code == exceptions.BadParameter.exit_code
+    send_mock.assert_not_called()
+
+
+@skip_on_windows
+def test_main_profile(
+    daemon_session_mock: t.Any,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    def send(**kwargs: t.Any) -> None:
+        with timing.phase(timing.Phase.RENDER):
+            pass
+
+    send_mock = mocker.patch("labmail.send", side_effect=send)
+    filepath = tmp_path / "profile.txt"
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "-c", "creds.json", "--profile", str(filepath)]
+    args.extend(["--socket", str(tmp_path / "labmail.sock")])
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    # the message is not forwarded to the daemon
+    send_mock.assert_called_once()
+    daemon_session_mock.send.assert_not_called()
+    report = filepath.read_text()
+    assert "render" in report
+    assert "Peak traced memory" in report
+    assert "cumulative" in report
+
+
+def test_main_ledger(tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture) -> None:
+    send_mock = mocker.patch("labmail.send")
+    ledger_filepath = str(tmp_path / "ledger.sqlite3")
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "--ledger", ledger_filepath]
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    # the whole body is read for the fingerprint
+    assert send_mock.call_args.kwargs["body"] == "body"
+    assert send_mock.call_args.kwargs["ledger_filepath"] == ledger_filepath
+    assert send_mock.call_args.kwargs["idempotency_key"] is None
+
+    args.extend(["--idempotency-key", "key"])
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    assert not isinstance(send_mock.call_args.kwargs["body"], str)
+    assert send_mock.call_args.kwargs["idempotency_key"] == "key"
+
+    send_mock.reset_mock()
+    args = ["foo@example.com", "--idempotency-key", "key"]
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == exceptions.BadOptionUsage.exit_code
+    send_mock.assert_not_called()
+
+
+def test_main_imports_no_heavy_dependencies() -> None:
+    code = "import sys, labmail.__main__; print(*sys.modules)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    modules = result.stdout.split()
+    for module in [
+        "googleapiclient",
+        "google_auth_oauthlib",
+        "markdown",
+        "labmail.gmail_api",
+    ]:
+        assert module not in modules
+
+
+@pytest.mark.parametrize("args", [["send", "foo@example.com"], ["foo@example.com"]])
+def test_main_default_command(
+    args: list[str], mocker: pytest_mock.MockerFixture
+) -> None:
+    send_mock = mocker.patch("labmail.send")
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, args, input="")
+    assert result.exit_code == 0
+    assert send_mock.call_args.kwargs["recipient"] == "foo@example.com"
+
+
+@pytest.mark.parametrize(
+    "args, expected",
+    [(["--help"], "merge"), (["--help"], "send"), (["--version"], "version")],
+)
+def test_main_group_options(args: list[str], expected: str) -> None:
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, args)
+    assert result.exit_code == 0
+    assert expected in result.output
+
+
+def test_main_merge(tmpdir: str, mocker: pytest_mock.MockerFixture) -> None:
+    rows = os.path.join(tmpdir, "rows.csv")
+    with open(rows, "w") as f:
+        f.write("email,name\nfoo@example.com,Foo\nbar@example.com,Bar\n")
+    session_mock = mocker.patch("labmail.Session")
+    send_many_mock = session_mock.return_value.__enter__.return_value.send_many
+    send_many_mock.side_effect = lambda drafts, **kwargs: [None for _ in drafts]
+    runner = testing.CliRunner()
+    result = runner.invoke(
+        __main__.main,
+        ["merge", rows, "-s", "Hello, $name", "-t", "markdown", "--dry-run"],
+        input="Dear $name,",
+    )
+    assert result.exit_code == 0
+    assert "Merged 2 rows (0 failed)" in result.output
+    session_mock.assert_called_once_with(
+        str(__main__.CREDENTIALS_FILEPATH),
+        cache_dir=__main__.CACHE_DIR,
+        refresh_signature=False,
+    )
+    drafts = send_many_mock.call_args.args[0]
+    assert [draft.subject for draft in drafts] == ["Hello, Foo", "Hello, Bar"]
+    assert drafts[0].body == "Dear Foo,"
+    assert drafts[0].text_type is text_utils.TextType.MARKDOWN
+    assert send_many_mock.call_args.kwargs["dry_run"] is True
+
+
+def test_main_merge_failed(tmpdir: str, mocker: pytest_mock.MockerFixture) -> None:
+    rows = os.path.join(tmpdir, "rows.jsonl")
+    with open(rows, "w") as f:
+        f.write('{"email": "foo@example.com"}\n{"name": "bar"}\n')
+    session_mock = mocker.patch("labmail.Session")
+    send_many_mock = session_mock.return_value.__enter__.return_value.send_many
+    send_many_mock.side_effect = lambda drafts, **kwargs: [None for _ in drafts]
+    runner = testing.CliRunner(mix_stderr=False)
+    result = runner.invoke(__main__.main, ["merge", rows], input="")
+    assert result.exit_code == 1
+    assert "Row 2: KeyError" in result.stderr
+    assert "Merged 2 rows (1 failed)" in result.stdout
+
+
+def test_main_merge_error(tmpdir: str, mocker: pytest_mock.MockerFixture) -> None:
+    rows = os.path.join(tmpdir, "rows.txt")
+    with open(rows, "w") as f:
+        f.write("")
+    mocker.patch("labmail.Session")
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, ["merge", rows], input="")
+    assert result.exit_code == exceptions.ClickException.exit_code
+    assert "Unsupported file type" in result.output
+
+
+def test_main_batch(tmpdir: str, mocker: pytest_mock.MockerFixture) -> None:
+    jobs = os.path.join(tmpdir, "jobs.jsonl")
+    with open(jobs, "w") as f:
+        f.write('{"recipient": "foo@example.com"}\n{"recipient": "error"}\n{}\n')
+    session_mock = mocker.patch("labmail.Session")
+    send_mock = session_mock.return_value.__enter__.return_value.send
+
+    def send(recipient: str, *args: t.Any, **kwargs: t.Any) -> t.Any:
+        if recipient == "error":
+            raise ValueError("error")
+        return {"id": "id"}
+
+    send_mock.side_effect = send
+    runner = testing.CliRunner(mix_stderr=False)
+    result = runner.invoke(__main__.main, ["batch", jobs, "-p", "2"])
+    assert result.exit_code == 1
+    assert "Ran 3 jobs (2 failed)" in result.stdout
+    assert "Job 2: error" in result.stderr
+    assert session_mock.call_args.kwargs["thread_safe"] is True
+    with open(f"{jobs}.journal") as f:
+        assert len(f.readlines()) == 3
+
+    send_mock.reset_mock()
+    result = runner.invoke(__main__.main, ["batch", jobs])
+    assert "Ran 2 jobs (2 failed)" in result.stdout
+    send_mock.assert_called_once()
+
+
+@pytest.mark.parametrize("journal", [False, True])
+def test_main_batch_stdin(
+    journal: bool, tmpdir: str, mocker: pytest_mock.MockerFixture
+) -> None:
+    mocker.patch("labmail.Session")
+    journal_mock = mocker.patch("labmail.batch.Journal")
+    args = ["batch"]
+    if journal:
+        args.extend(["--journal", os.path.join(tmpdir, "journal")])
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, args, input='{"recipient": "foo"}\n')
+    assert result.exit_code == 0
+    assert "Ran 1 jobs (0 failed)" in result.output
+    assert journal_mock.called is journal
+
+
+def test_main_batch_ledger(
+    tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture
+) -> None:
+    from labmail import ledger
+
+    session_mock = mocker.patch("labmail.Session")
+    runner = testing.CliRunner()
+    args = ["batch", "--ledger", str(tmp_path / "ledger.sqlite3")]
+    result = runner.invoke(__main__.main, args, input='{"recipient": "foo"}\n')
+    assert result.exit_code == 0
+    assert isinstance(session_mock.call_args.kwargs["ledger"], ledger.SendLedger)
+
+
+def test_main_batch_error(mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch("labmail.Session", side_effect=OSError)
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, ["batch"], input="")
+    assert result.exit_code == exceptions.ClickException.exit_code
+
+
+@pytest.fixture()
+def daemon_session_mock(
+    tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture
+) -> t.Iterator[t.Any]:
+    from labmail import daemon
+
+    session_mock = mocker.Mock()
+    account = str(pathlib.Path("creds.json").resolve())
+    with daemon.Server(
+        session_mock, tmp_path / "labmail.sock", account=account
+    ) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield session_mock
+        server.shutdown()
+        thread.join()
+
+
+@skip_on_windows
+def test_main_send_via_daemon(
+    daemon_session_mock: t.Any,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    send_mock = mocker.patch("labmail.send")
+    daemon_session_mock.send.return_value = {"id": "id"}
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "-s", "subject", "-c", "creds.json"]
+    args.extend(["--socket", str(tmp_path / "labmail.sock")])
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    send_mock.assert_not_called()
+    daemon_session_mock.send.assert_called_once_with(
+        recipient="foo@example.com",
+        body="body",
+        subject="subject",
+        headers=dict(),
+        text_type=text_utils.TextType.PLAIN,
+        disallow_same_subjects=False,
+        sendas_address=None,
+        attachments=[],
+        dry_run=False,
     )
+
+
+@skip_on_windows
+def test_main_send_via_daemon_attach(
+    daemon_session_mock: t.Any,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch("labmail.send")
+    daemon_session_mock.send.return_value = {"id": "id"}
+    (tmp_path / "report.pdf").write_bytes(b"")
+    runner = testing.CliRunner()
+    creds = str(pathlib.Path("creds.json").resolve())
+    args = ["foo@example.com", "-c", creds, "--attach", "report.pdf"]
+    args.extend(["--socket", str(tmp_path / "labmail.sock")])
+    monkeypatch.chdir(tmp_path)
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    # the daemon resolves the paths in its own working directory
+    assert daemon_session_mock.send.call_args.kwargs["attachments"] == [
+        str((tmp_path / "report.pdf").resolve())
+    ]
+
+
+@skip_on_windows
+@pytest.mark.parametrize(
+    "args",
+    [["--no-daemon"], ["--refresh-signature"], ["-c", "other.json"]],
+)
+def test_main_send_without_daemon(
+    args: list[str],
+    daemon_session_mock: t.Any,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    send_mock = mocker.patch("labmail.send")
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "-c", "creds.json", *args]
+    args.extend(["--socket", str(tmp_path / "labmail.sock")])
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    send_mock.assert_called_once()
+    daemon_session_mock.send.assert_not_called()
+
+
+def test_main_send_daemon_not_running(
+    tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture
+) -> None:
+    send_mock = mocker.patch("labmail.send")
+    socket_filepath = tmp_path / "labmail.sock"
+    socket_filepath.touch()
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "--socket", str(socket_filepath)]
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == 0
+    send_mock.assert_called_once()
+
+
+@skip_on_windows
+@pytest.mark.parametrize(
+    "exception, message",
+    [
+        (SubjectUsedError("used"), "Error: used"),
+        (ValueError("error"), "Error: Internal Error: error"),
+    ],
+)
+def test_main_send_via_daemon_fail(
+    exception: Exception,
+    message: str,
+    daemon_session_mock: t.Any,
+    tmp_path: pathlib.Path,
+) -> None:
+    daemon_session_mock.send.side_effect = exception
+    runner = testing.CliRunner()
+    args = ["foo@example.com", "-c", "creds.json"]
+    args.extend(["--socket", str(tmp_path / "labmail.sock")])
+    result = runner.invoke(__main__.main, args, input="body")
+    assert result.exit_code == exceptions.ClickException.exit_code
+    assert message in result.output
+
+
+@skip_on_windows
+def test_main_serve(tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture) -> None:
+    session_mock = mocker.patch("labmail.Session")
+    server_mock = mocker.patch("labmail.daemon.Server")
+    serve_forever_mock = server_mock.return_value.__enter__.return_value.serve_forever
+    serve_forever_mock.side_effect = KeyboardInterrupt
+    mocker.patch("signal.signal")
+    socket_filepath = str(tmp_path / "labmail.sock")
+    runner = testing.CliRunner()
+    result = runner.invoke(
+        __main__.main, ["serve", "--socket", socket_filepath, "-c", "creds.json"]
+    )
+    assert result.exit_code == 0
+    assert f"Serving on {socket_filepath}" in result.output
+    session = session_mock.return_value.__enter__.return_value
+    session.get_sendas.assert_called_once_with()
+    server_mock.assert_called_once_with(
+        session, socket_filepath, account=str(pathlib.Path("creds.json").resolve())
+    )
+    assert session_mock.call_args.kwargs["thread_safe"] is True
+
+
+def test_main_serve_error(mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch("labmail.Session", side_effect=OSError)
+    mocker.patch("signal.signal")
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, ["serve"])
+    assert result.exit_code == exceptions.ClickException.exit_code
+
+
+def test_main_serve_unsupported(mocker: pytest_mock.MockerFixture) -> None:
+    session_mock = mocker.patch("labmail.Session")
+    mocker.patch.object(sys, "platform", "win32")
+    runner = testing.CliRunner()
+    result = runner.invoke(__main__.main, ["serve"])
+    assert result.exit_code == exceptions.ClickException.exit_code
+    assert "not supported on Windows" in result.output
+    session_mock.assert_not_called()
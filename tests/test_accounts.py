@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import base64
+import email.message
+import pathlib
+import typing as t
+from concurrent import futures
+
+import pytest
+import pytest_mock
+
+import labmail
+from labmail import accounts, testing
+
+
+@pytest.fixture()
+def credentials_filepaths(
+    fake_gmail: testing.FakeGmailServer,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> list[str]:
+    mocker.patch("labmail._env.GMAIL_API_ROOT_URL", fake_gmail.root_url)
+    filepaths = [str(tmp_path / f"{name}.json") for name in ["alice", "bob", "carol"]]
+    for filepath in filepaths:
+        testing.write_credentials(filepath)
+    return filepaths
+
+
+def test_account_pool_no_credentials() -> None:
+    with pytest.raises(ValueError):
+        accounts.AccountPool([])
+
+
+def test_round_robin(
+    credentials_filepaths: list[str], fake_gmail: testing.FakeGmailServer
+) -> None:
+    with accounts.AccountPool(credentials_filepaths) as pool:
+        for i in range(7):
+            pool.send("foo@example.com", "body", f"subject {i}")
+        assert [account.sent for account in pool.accounts] == [3, 2, 2]
+    assert len(fake_gmail.messages) == 7
+
+
+def test_least_loaded(credentials_filepaths: list[str]) -> None:
+    with accounts.AccountPool(
+        credentials_filepaths, policy=accounts.Policy.LEAST_LOADED
+    ) as pool:
+        first = pool.acquire()
+        second = pool.acquire()
+        assert second is not first
+        pool.release(first, sent=True)
+        third = pool.acquire()
+        assert third is not first and third is not second
+        pool.release(second, sent=False)
+        assert pool.acquire() is second
+        assert [account.in_flight for account in pool.accounts] == [0, 1, 1]
+
+
+def test_quota(credentials_filepaths: list[str]) -> None:
+    alice, bob, carol = credentials_filepaths
+    with accounts.AccountPool(
+        credentials_filepaths,
+        policy=accounts.Policy.QUOTA,
+        daily_quota={alice: 1, bob: 3, carol: 2},
+    ) as pool:
+        picked = [pool.acquire().name for _ in range(6)]
+        assert picked == [bob, bob, carol, alice, bob, carol]
+        with pytest.raises(accounts.QuotaExceededError):
+            pool.acquire()
+
+
+def test_quota_exceeded(credentials_filepaths: list[str]) -> None:
+    with accounts.AccountPool(credentials_filepaths, daily_quota=1) as pool:
+        for i in range(3):
+            pool.send("foo@example.com", "body", f"subject {i}")
+        with pytest.raises(accounts.QuotaExceededError):
+            pool.send("foo@example.com", "body", "subject")
+
+
+def test_quota_window(
+    credentials_filepaths: list[str], mocker: pytest_mock.MockerFixture
+) -> None:
+    time_mock = mocker.patch("time.time", return_value=1000.0)
+    with accounts.AccountPool(credentials_filepaths[:1], daily_quota=1) as pool:
+        pool.send("foo@example.com", "body", "subject")
+        assert pool.accounts[0].remaining == 0
+        time_mock.return_value += accounts.QUOTA_WINDOW
+        assert pool.accounts[0].remaining == 1
+
+
+def test_dry_run_gives_back_quota(credentials_filepaths: list[str]) -> None:
+    with accounts.AccountPool(credentials_filepaths, daily_quota=1) as pool:
+        for _ in range(5):
+            assert pool.send("foo@example.com", "body", dry_run=True) is None
+        assert all(account.remaining == 1 for account in pool.accounts)
+
+
+def test_failure_gives_back_quota(
+    credentials_filepaths: list[str], mocker: pytest_mock.MockerFixture
+) -> None:
+    with accounts.AccountPool(credentials_filepaths[:1], daily_quota=1) as pool:
+        mocker.patch.object(
+            pool.accounts[0].session, "send", side_effect=ValueError("failed")
+        )
+        with pytest.raises(ValueError):
+            pool.send("foo@example.com", "body")
+        assert pool.accounts[0].remaining == 1
+        assert pool.accounts[0].in_flight == 0
+
+
+def test_signature_per_account(
+    credentials_filepaths: list[str],
+    fake_gmail: testing.FakeGmailServer,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    with accounts.AccountPool(credentials_filepaths[:2]) as pool:
+        sendas: t.Any = {"sendAsEmail": "bob@example.com", "signature": "Bob"}
+        mocker.patch.object(pool.accounts[1].session, "get_sendas", return_value=sendas)
+        pool.send("foo@example.com", "body", "subject 1")
+        pool.send("foo@example.com", "body", "subject 2")
+    first, second = (
+        base64.urlsafe_b64decode(message["raw"]).decode()
+        for message in fake_gmail.messages.values()
+    )
+    assert "Example Lab." in first
+    assert "Bob" in second and "Example Lab." not in second
+
+
+def test_disallow_same_subjects(
+    credentials_filepaths: list[str], fake_gmail: testing.FakeGmailServer
+) -> None:
+    with accounts.AccountPool(credentials_filepaths) as pool:
+        pool.send("foo@example.com", "body", "subject", disallow_same_subjects=True)
+        with pytest.raises(labmail.SubjectUsedError):
+            pool.send("foo@example.com", "body", "subject", disallow_same_subjects=True)
+    assert len(fake_gmail.messages) == 1
+
+
+def test_disallow_same_subjects_parallel(
+    credentials_filepaths: list[str], fake_gmail: testing.FakeGmailServer
+) -> None:
+    # the threads check the subject while the others are sending
+    fake_gmail.latency = 0.05
+
+    def send(_: int) -> bool:
+        try:
+            pool.send("foo@example.com", "body", "subject", disallow_same_subjects=True)
+        except labmail.SubjectUsedError:
+            return False
+        return True
+
+    with accounts.AccountPool(credentials_filepaths) as pool:
+        with futures.ThreadPoolExecutor(8) as executor:
+            assert sum(executor.map(send, range(8))) == 1
+        (result,) = pool.send_many(
+            [labmail.Draft("foo@example.com", "body", "subject")],
+            disallow_same_subjects=True,
+        )
+        assert isinstance(result, labmail.SubjectUsedError)
+    assert len(fake_gmail.messages) == 1
+
+
+def test_find_used_subjects(
+    credentials_filepaths: list[str],
+    fake_gmail: testing.FakeGmailServer,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    message = email.message.EmailMessage()
+    message["Subject"] = "used"
+    fake_gmail.add_message(message)
+    with accounts.AccountPool(credentials_filepaths) as pool:
+        spies = [
+            mocker.spy(account.session, "find_used_subjects")
+            for account in pool.accounts
+        ]
+        assert pool.find_used_subjects(["used", "new", "new"]) == {"used"}
+        # the subjects found are not searched with the other accounts
+        assert [spy.call_args.args[0] for spy in spies] == [
+            {"used", "new"},
+            {"new"},
+            {"new"},
+        ]
+        assert pool.is_subject_used("used")
+
+
+def test_send_many(
+    credentials_filepaths: list[str], fake_gmail: testing.FakeGmailServer
+) -> None:
+    drafts = [
+        labmail.Draft("foo@example.com", "body", f"subject {i % 6}") for i in range(8)
+    ]
+    with accounts.AccountPool(credentials_filepaths, daily_quota=2) as pool:
+        results = pool.send_many(drafts, disallow_same_subjects=True)
+        assert [account.remaining for account in pool.accounts] == [0, 0, 0]
+    assert [type(result).__name__ for result in results] == [
+        *["dict"] * 6,
+        *["SubjectUsedError"] * 2,
+    ]
+    assert len(fake_gmail.messages) == 6
+
+
+def test_send_many_quota_exceeded(credentials_filepaths: list[str]) -> None:
+    drafts = [labmail.Draft("foo@example.com", "body") for _ in range(4)]
+    with accounts.AccountPool(credentials_filepaths, daily_quota=1) as pool:
+        results = pool.send_many(drafts)
+    assert isinstance(results[3], accounts.QuotaExceededError)
+    assert all(isinstance(result, dict) for result in results[:3])
+
+
+def test_send_many_failure(
+    credentials_filepaths: list[str], mocker: pytest_mock.MockerFixture
+) -> None:
+    drafts = [labmail.Draft("foo@example.com", "body") for _ in range(3)]
+    with accounts.AccountPool(credentials_filepaths, daily_quota=1) as pool:
+        mocker.patch.object(
+            pool.accounts[1].session, "send_many", side_effect=ValueError("failed")
+        )
+        results = pool.send_many(drafts)
+        assert [account.remaining for account in pool.accounts] == [0, 1, 0]
+    assert isinstance(results[1], ValueError)
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import typing as t
+
+import pytest
+import pytest_mock
+
+import labmail
+from labmail import aio, session
+
+
+def test_list_message(mocker: pytest_mock.MockerFixture) -> None:
+    rsc_mock = mocker.Mock()
+    list_mock = rsc_mock.users().messages().list
+    list_mock.return_value.execute.return_value = {"resultSizeEstimate": 1}
+    result = asyncio.run(aio.list_message(rsc_mock, query="query"))
+    assert result == ([], "", 1)
+    assert list_mock.call_args.kwargs["q"] == "query"
+
+
+def test_get_sendas_runs_in_thread(mocker: pytest_mock.MockerFixture) -> None:
+    thread_ids: list[int] = list()
+
+    def execute() -> dict[str, t.Any]:
+        thread_ids.append(threading.get_ident())
+        return {"sendAs": [{"sendAsEmail": "foo@example.com", "isDefault": True}]}
+
+    rsc_mock = mocker.Mock()
+    rsc_mock.users().settings().sendAs().list.return_value.execute = execute
+    sendas = asyncio.run(aio.get_sendas(rsc_mock))
+    assert sendas["sendAsEmail"] == "foo@example.com"
+    assert thread_ids != [threading.get_ident()]
+
+
+@pytest.fixture()
+def mock_session(mocker: pytest_mock.MockerFixture) -> t.Any:
+    return mocker.patch("labmail.aio.Session").return_value
+
+
+def test_async_session(mock_session: t.Any) -> None:
+    async def main() -> None:
+        async with aio.AsyncSession() as sess:
+            mock_session.open.assert_called_once_with()
+            await sess.send("foo@example.com", "body", "subject")
+        mock_session.close.assert_called_once_with(None, None, None)
+
+    asyncio.run(main())
+    mock_session.send.assert_called_once()
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_async_session_send_many_concurrency(
+    concurrency: int, mock_session: t.Any
+) -> None:
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def send(recipient: str, *args: t.Any, **kwargs: t.Any) -> dict[str, str]:
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        if recipient == "error":
+            raise ValueError
+        return {"id": recipient}
+
+    mock_session.send.side_effect = send
+    drafts = [session.Draft(str(i)) for i in range(8)] + [session.Draft("error")]
+
+    async def main() -> list[t.Any]:
+        async with aio.AsyncSession() as sess:
+            return await sess.send_many(drafts, concurrency=concurrency)
+
+    results = asyncio.run(main())
+    assert results[:-1] == [{"id": str(i)} for i in range(8)]
+    assert isinstance(results[-1], ValueError)
+    assert max_running[0] <= concurrency
+
+
+def test_async_session_send_many_beyond_default_executor(mock_session: t.Any) -> None:
+    # the sends wait for each other, so they must run at once
+    concurrency = 40
+    barrier = threading.Barrier(concurrency, timeout=10)
+    mock_session.send.side_effect = lambda *args, **kwargs: barrier.wait()
+    drafts = [session.Draft(str(i)) for i in range(concurrency)]
+
+    async def main() -> list[t.Any]:
+        async with aio.AsyncSession(concurrency=concurrency) as sess:
+            return await sess.send_many(drafts)
+
+    results = asyncio.run(main())
+    assert sorted(results) == list(range(concurrency))
+
+
+def test_async_session_send_many_invalid_concurrency(mock_session: t.Any) -> None:
+    async def main() -> None:
+        async with aio.AsyncSession(concurrency=2) as sess:
+            await sess.send_many([], concurrency=3)
+
+    with pytest.raises(ValueError):
+        asyncio.run(main())
+    with pytest.raises(ValueError):
+        aio.AsyncSession(concurrency=0)
+
+
+def test_async_session_closed(mock_session: t.Any) -> None:
+    async def main() -> None:
+        sess = aio.AsyncSession()
+        await sess.open()
+        await sess.close()
+        await sess.close()
+        mock_session.close.assert_called_once_with(None, None, None)
+        with pytest.raises(RuntimeError):
+            await sess.send("foo@example.com")
+
+    asyncio.run(main())
+
+
+def test_async_session_send_many_disallow_same_subjects(mock_session: t.Any) -> None:
+    drafts = [session.Draft("foo@example.com", subject="same") for _ in range(2)]
+
+    async def main() -> list[t.Any]:
+        async with aio.AsyncSession() as sess:
+            return await sess.send_many(drafts, disallow_same_subjects=True)
+
+    results = asyncio.run(main())
+    assert results[0] == mock_session.send.return_value
+    assert isinstance(results[1], labmail.SubjectUsedError)
+    assert mock_session.send.call_args.kwargs["disallow_same_subjects"] is True
+    mock_session.find_used_subjects.assert_called_once_with(["same", "same"])
+
+
+def test_send_async(mock_session: t.Any) -> None:
+    result = asyncio.run(labmail.send_async("foo@example.com", "body", "subject"))
+    assert result.message == mock_session.send.return_value
+    assert isinstance(result.timings, labmail.timing.Timings)
+    mock_session.open.assert_called_once_with()
+    mock_session.send.assert_called_once()
+    mock_session.close.assert_called_once()
+
+
+def test_send_many_async(mock_session: t.Any) -> None:
+    drafts = [labmail.Draft("foo@example.com"), labmail.Draft("bar@example.com")]
+    results = asyncio.run(labmail.send_many_async(drafts, concurrency=2))
+    assert results == [mock_session.send.return_value] * 2
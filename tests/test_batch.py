@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import json
+import pathlib
+import threading
+import typing as t
+
+import pytest
+import pytest_mock
+
+from labmail import batch, session, testing, text_utils
+
+
+def test_read_jobs() -> None:
+    lines = [
+        '{"id": "a", "recipient": "foo@example.com", "body": "Hello", "subject": "Hi",'
+        ' "text_type": "markdown", "headers": {"CC": "bar@example.com"},'
+        ' "sendas": "baz@example.com", "idempotency_key": "key"}\n',
+        "\n",
+        '{"recipient": ["foo@example.com", "bar@example.com"]}\n',
+    ]
+    assert list(batch.read_jobs(lines)) == [
+        batch.Job(
+            "a",
+            session.Draft(
+                "foo@example.com",
+                "Hello",
+                "Hi",
+                text_type=text_utils.TextType.MARKDOWN,
+                headers={"CC": "bar@example.com"},
+                sendas_address="baz@example.com",
+                idempotency_key="key",
+            ),
+        ),
+        batch.Job("3", session.Draft(["foo@example.com", "bar@example.com"])),
+    ]
+
+
+@pytest.mark.parametrize(
+    "line, key",
+    [
+        ("{", "1"),
+        ("[]", "1"),
+        ('{"id": 1}', "1"),
+        ('{"id": "a", "recipient": "", "text_type": "unknown"}', "a"),
+    ],
+)
+def test_read_jobs_invalid(line: str, key: str) -> None:
+    (job,) = batch.read_jobs([line])
+    assert job.key == key
+    assert job.draft is None
+    assert isinstance(job.error, (KeyError, ValueError))
+
+
+def test_journal(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "journal" / "jobs.journal"
+    with batch.Journal(filepath) as journal:
+        assert journal.load() == dict()
+        journal.append(batch.JobResult("a", None, 0.1, "error"))
+        journal.append(batch.JobResult("b", "id-b", 0.2))
+        journal.append(batch.JobResult("a", "id-a", 0.3))
+    with filepath.open("a") as f:
+        f.write('{"key": "c", "message_')
+    assert batch.Journal(filepath).load() == {
+        "a": batch.JobResult("a", "id-a", 0.3),
+        "b": batch.JobResult("b", "id-b", 0.2),
+    }
+
+
+@pytest.fixture()
+def session_mock(mocker: pytest_mock.MockerFixture) -> t.Any:
+    def send(recipient: str, *args: t.Any, **kwargs: t.Any) -> t.Any:
+        if recipient == "error":
+            raise ValueError("error")
+        return None if kwargs["dry_run"] else {"id": f"id-{recipient}"}
+
+    mock = mocker.Mock()
+    mock.send.side_effect = send
+    return mock
+
+
+def _jobs(*recipients: str) -> list[batch.Job]:
+    return [
+        batch.Job(str(i), session.Draft(recipient))
+        for i, recipient in enumerate(recipients)
+    ]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_run(max_workers: int, session_mock: t.Any) -> None:
+    jobs = _jobs(*(f"r{i}" for i in range(20)))
+    results = list(batch.run(session_mock, jobs, max_workers=max_workers))
+    assert sorted((result.key, result.message_id) for result in results) == sorted(
+        (str(i), f"id-r{i}") for i in range(20)
+    )
+    assert not any(result.failed for result in results)
+    assert session_mock.send.call_args.kwargs["disallow_same_subjects"] is False
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_run_same_subjects(
+    cache: bool,
+    fake_gmail: testing.FakeGmailServer,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch("labmail._env.GMAIL_API_ROOT_URL", fake_gmail.root_url)
+    credentials_filepath = str(tmp_path / "credentials.json")
+    testing.write_credentials(credentials_filepath)
+    # the jobs check the subject while the others are sending
+    fake_gmail.latency = 0.05
+    jobs = [
+        batch.Job(str(i), session.Draft(f"r{i}@example.com", "body", "subject"))
+        for i in range(8)
+    ]
+    with session.Session(
+        credentials_filepath,
+        thread_safe=True,
+        cache_dir=tmp_path / "cache" if cache else None,
+    ) as sess:
+        results = list(
+            batch.run(sess, jobs, max_workers=8, disallow_same_subjects=True)
+        )
+    assert sum(not result.failed for result in results) == 1
+    assert len(fake_gmail.messages) == 1
+
+
+def test_run_resume(tmp_path: pathlib.Path, session_mock: t.Any) -> None:
+    filepath = tmp_path / "jobs.journal"
+    jobs = _jobs("foo", "error", "bar") + [batch.Job("3", None, ValueError("bad"))]
+    with batch.Journal(filepath) as journal:
+        results = list(batch.run(session_mock, jobs, journal=journal))
+    assert {result.key: result.failed for result in results} == {
+        "0": False,
+        "1": True,
+        "2": False,
+        "3": True,
+    }
+    lines = [json.loads(line) for line in filepath.read_text().splitlines()]
+    assert {line["key"]: line["error"] for line in lines} == {
+        "0": None,
+        "1": "error",
+        "2": None,
+        "3": "bad",
+    }
+
+    session_mock.send.reset_mock()
+    jobs[1] = batch.Job("1", session.Draft("baz"))
+    with batch.Journal(filepath) as journal:
+        results = list(batch.run(session_mock, jobs[:3], journal=journal))
+    assert [result.key for result in results] == ["1"]
+    session_mock.send.assert_called_once()
+    assert batch.Journal(filepath).load()["1"].message_id == "id-baz"
+
+
+def test_run_duplicate_keys(session_mock: t.Any) -> None:
+    jobs = _jobs("foo") + [batch.Job("0", session.Draft("bar"))]
+    assert len(list(batch.run(session_mock, jobs))) == 1
+
+
+def test_run_dry_run(tmp_path: pathlib.Path, session_mock: t.Any) -> None:
+    filepath = tmp_path / "jobs.journal"
+    with batch.Journal(filepath) as journal:
+        results = list(
+            batch.run(session_mock, _jobs("foo"), journal=journal, dry_run=True)
+        )
+    assert results[0].message_id is None
+    assert not filepath.exists()
+
+
+def test_run_bounded(session_mock: t.Any) -> None:
+    event = threading.Event()
+    consumed: list[int] = list()
+
+    def send(*args: t.Any, **kwargs: t.Any) -> t.Any:
+        event.wait(1)
+        return {"id": "id"}
+
+    def jobs() -> t.Iterator[batch.Job]:
+        for i in range(100):
+            consumed.append(i)
+            yield batch.Job(str(i), session.Draft("foo"))
+
+    session_mock.send.side_effect = send
+    results = batch.run(session_mock, jobs(), max_workers=2)
+    threading.Timer(0.1, event.set).start()
+    next(results)
+    assert len(consumed) <= 5
+    results.close()
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import email.mime.text as mime_text
+import json
+import pathlib
+import sqlite3
+import time
+import typing as t
+
+import httplib2
+import pytest
+import pytest_mock
+from google.oauth2 import credentials
+from googleapiclient import errors
+
+from labmail import cache, gmail_api, testing
+
+
+@pytest.fixture()
+def discovery_cache(tmp_path: pathlib.Path) -> cache.DiscoveryCache:
+    return cache.DiscoveryCache(tmp_path)
+
+
+def test_discovery_cache_load(
+    discovery_cache: cache.DiscoveryCache, mocker: pytest_mock.MockerFixture
+) -> None:
+    trim_spy = mocker.spy(gmail_api, "trim_discovery_document")
+    document = discovery_cache.load()
+    assert discovery_cache.filepath.exists()
+    assert discovery_cache.load() == document
+    trim_spy.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "content",
+    ["", "{", "[]", '{"key": {}, "document": {}}', '{"document": {}}'],
+    ids=["empty", "corrupt", "list", "outdated", "no-key"],
+)
+def test_discovery_cache_load_invalid(
+    content: str,
+    discovery_cache: cache.DiscoveryCache,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    discovery_cache.filepath.parent.mkdir(parents=True)
+    discovery_cache.filepath.write_text(content)
+    trim_spy = mocker.spy(gmail_api, "trim_discovery_document")
+    document = discovery_cache.load()
+    trim_spy.assert_called_once()
+    with discovery_cache.filepath.open() as f:
+        assert json.load(f) == {"key": discovery_cache.key, "document": document}
+
+
+def test_discovery_cache_load_unwritable(
+    discovery_cache: cache.DiscoveryCache, mocker: pytest_mock.MockerFixture
+) -> None:
+    mocker.patch("labmail._fileutils.write_text_atomic", side_effect=OSError)
+    assert discovery_cache.load()["name"] == "gmail"
+
+
+def test_discovery_cache_clear(discovery_cache: cache.DiscoveryCache) -> None:
+    discovery_cache.clear()
+    discovery_cache.load()
+    discovery_cache.clear()
+    assert not discovery_cache.filepath.exists()
+
+
+@pytest.fixture()
+def sendas_cache(tmp_path: pathlib.Path) -> cache.SendAsCache:
+    return cache.SendAsCache(tmp_path, "credentials.json", ttl=60)
+
+
+def test_sendas_cache_save_load(sendas_cache: cache.SendAsCache) -> None:
+    assert sendas_cache.load() is None
+    sendas_list: list[t.Any] = [{"sendAsEmail": "foo@example.com"}]
+    sendas_cache.save(sendas_list)
+    assert sendas_cache.load() == sendas_list
+    sendas_cache.clear()
+    assert sendas_cache.load() is None
+
+
+def test_sendas_cache_expired(
+    sendas_cache: cache.SendAsCache, mocker: pytest_mock.MockerFixture
+) -> None:
+    sendas_cache.save([])
+    mocker.patch("time.time", return_value=time.time() + sendas_cache.ttl + 1)
+    assert sendas_cache.load() is None
+
+
+def test_sendas_cache_per_account(
+    sendas_cache: cache.SendAsCache, tmp_path: pathlib.Path
+) -> None:
+    sendas_cache.save([])
+    other_cache = cache.SendAsCache(tmp_path, "other.json")
+    assert other_cache.filepath != sendas_cache.filepath
+    assert other_cache.load() is None
+
+
+@pytest.mark.parametrize("content", ["", "{", '{"key": {}}'])
+def test_sendas_cache_invalid(content: str, sendas_cache: cache.SendAsCache) -> None:
+    sendas_cache.filepath.parent.mkdir(parents=True)
+    sendas_cache.filepath.write_text(content)
+    assert sendas_cache.load() is None
+
+
+def test_sendas_cache_unwritable(
+    sendas_cache: cache.SendAsCache, mocker: pytest_mock.MockerFixture
+) -> None:
+    mocker.patch("labmail._fileutils.write_text_atomic", side_effect=OSError)
+    sendas_cache.save([])
+    assert sendas_cache.load() is None
+
+
+@pytest.fixture()
+def subject_index(tmp_path: pathlib.Path) -> cache.SubjectIndex:
+    return cache.SubjectIndex(tmp_path, "credentials.json")
+
+
+@pytest.fixture()
+def sent_messages(mocker: pytest_mock.MockerFixture) -> dict[str, t.Any]:
+    messages: dict[str, t.Any] = dict()
+
+    def get_messages(
+        rsc: t.Any, user_id: str, *, ids: list[str], **kwargs: t.Any
+    ) -> t.Any:
+        for id in ids:
+            yield id, messages[id]
+
+    mocker.patch(
+        "labmail.gmail_api.iter_messages",
+        side_effect=lambda *args, **kwargs: ({"id": id} for id in messages),
+    )
+    mocker.patch("labmail.gmail_api.get_messages", side_effect=get_messages)
+    return messages
+
+
+def _sent_message(subject: str) -> dict[str, t.Any]:
+    return {"payload": {"headers": [{"name": "Subject", "value": subject}]}}
+
+
+def test_subject_index_sync(
+    subject_index: cache.SubjectIndex,
+    sent_messages: dict[str, t.Any],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    sent_messages["0"] = _sent_message("foo")
+    sent_messages["1"] = _sent_message("bar  baz")
+    sent_messages["2"] = {"payload": {}}
+    rsc_mock = mocker.Mock()
+    assert subject_index.sync(rsc_mock) == 3
+    gmail_api.iter_messages.assert_called_once_with(  # type: ignore[attr-defined]
+        rsc_mock, "me", query="in:sent", limit=None
+    )
+    assert gmail_api.get_messages.call_args.kwargs == {  # type: ignore[attr-defined]
+        "ids": ["0", "1", "2"],
+        "format": "metadata",
+        "metadata_headers": ["Subject"],
+        "ordered": False,
+    }
+    assert subject_index.contains("foo")
+    assert subject_index.contains("bar baz")
+    assert not subject_index.contains("qux")
+
+    synced_at = t.cast(float, subject_index.synced_at)
+    sent_messages.clear()
+    subject_index.sync(rsc_mock)
+    after = int(synced_at - subject_index.SYNC_OVERLAP)
+    gmail_api.iter_messages.assert_called_with(  # type: ignore[attr-defined]
+        rsc_mock, "me", query=f"in:sent after:{after}"
+    )
+    assert subject_index.contains("foo")
+
+
+def test_subject_index_sync_overlap(
+    subject_index: cache.SubjectIndex,
+    sent_messages: dict[str, t.Any],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    rsc_mock = mocker.Mock()
+    subject_index.sync(rsc_mock)
+    sent_messages["0"] = _sent_message("foo")
+    sent_messages["1"] = _sent_message("bar")
+    assert subject_index.sync(rsc_mock) == 2
+    # the messages listed by the last sync in the overlap are not scanned again
+    sent_messages["2"] = _sent_message("baz")
+    assert subject_index.sync(rsc_mock) == 1
+    assert gmail_api.get_messages.call_args.kwargs["ids"] == ["2"]  # type: ignore[attr-defined]
+    del sent_messages["0"]
+    assert subject_index.sync(rsc_mock) == 0
+    assert subject_index.contains("foo")
+    assert subject_index.contains("baz")
+
+
+def test_subject_index_sync_error(
+    subject_index: cache.SubjectIndex,
+    sent_messages: dict[str, t.Any],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    sent_messages["0"] = _sent_message("foo")
+    sent_messages["1"] = ValueError("error")
+    with pytest.raises(ValueError):
+        subject_index.sync(mocker.Mock())
+    assert subject_index.contains("foo")
+    assert subject_index.synced_at is None
+
+
+def test_subject_index_sync_deleted(
+    subject_index: cache.SubjectIndex,
+    sent_messages: dict[str, t.Any],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    sent_messages["0"] = errors.HttpError(httplib2.Response({"status": "404"}), b"")
+    sent_messages["1"] = _sent_message("foo")
+    assert subject_index.sync(mocker.Mock()) == 2
+    assert subject_index.contains("foo")
+    assert subject_index.synced_at is not None
+
+
+def test_subject_index_backfill(
+    subject_index: cache.SubjectIndex, fake_gmail: testing.FakeGmailServer
+) -> None:
+    now = time.time()
+    for i in range(7):
+        message = mime_text.MIMEText("body")
+        message["Subject"] = f"subject {i}"
+        # two messages are sent in the same second
+        fake_gmail.add_message(message, timestamp=now - 100 * (i // 2 * 2 + 1))
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    rsc = gmail_api.build(creds, root_url=fake_gmail.root_url)
+
+    assert subject_index.sync(rsc, limit=3) == 3
+    assert subject_index.synced_at is None
+    assert [subject_index.contains(f"subject {i}") for i in range(7)] == [
+        True,
+        True,
+        True,
+        False,
+        False,
+        False,
+        False,
+    ]
+    # resumed by the other instance
+    other_index = cache.SubjectIndex(subject_index.cache_dir, subject_index.account)
+    while other_index.synced_at is None:
+        other_index.sync(rsc, limit=3)
+    assert all(subject_index.contains(f"subject {i}") for i in range(7))
+    synced_at = t.cast(float, subject_index.synced_at)
+    assert synced_at < time.time()
+
+    # the messages sent during the backfill are found by the next sync
+    message = mime_text.MIMEText("body")
+    message["Subject"] = "new"
+    fake_gmail.add_message(message)
+    subject_index.sync(rsc, limit=3)
+    assert subject_index.contains("new")
+
+
+def test_subject_index_connection(
+    subject_index: cache.SubjectIndex, mocker: pytest_mock.MockerFixture
+) -> None:
+    connect_spy = mocker.spy(sqlite3, "connect")
+    subject_index.add(["foo"])
+    for _ in range(3):
+        assert subject_index.contains("foo")
+    connect_spy.assert_called_once()
+    subject_index.close()
+    assert subject_index.contains("foo")
+    assert connect_spy.call_count == 2
+
+
+def test_subject_index_add_clear(subject_index: cache.SubjectIndex) -> None:
+    subject_index.add(["foo", " foo ", "bar"])
+    assert subject_index.contains("foo")
+    assert subject_index.contains("bar")
+    subject_index.clear()
+    assert not subject_index.filepath.exists()
+    assert not subject_index.contains("foo")
+
+
+def test_subject_index_per_account(
+    subject_index: cache.SubjectIndex, tmp_path: pathlib.Path
+) -> None:
+    subject_index.add(["foo"])
+    other_index = cache.SubjectIndex(tmp_path, "other.json")
+    assert other_index.filepath != subject_index.filepath
+    assert not other_index.contains("foo")
+
+
+def test_subject_index_outdated(
+    subject_index: cache.SubjectIndex, mocker: pytest_mock.MockerFixture
+) -> None:
+    subject_index.add(["foo"])
+    mocker.patch.object(cache.SubjectIndex, "FORMAT_VERSION", 0)
+    # validated when the database is opened
+    assert subject_index.contains("foo")
+    subject_index.close()
+    assert not subject_index.contains("foo")
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import pathlib
+import stat
+import sys
+import threading
+import typing as t
+
+import pytest
+import pytest_mock
+
+from labmail import daemon, text_utils
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="Unix domain sockets are not supported"
+)
+
+
+class SubjectUsedError(ValueError):
+    pass
+
+
+@pytest.fixture()
+def session_mock(mocker: pytest_mock.MockerFixture) -> t.Any:
+    def send(recipient: str, *args: t.Any, **kwargs: t.Any) -> t.Any:
+        if recipient == "used":
+            raise SubjectUsedError("used")
+        return {"id": recipient}
+
+    mock = mocker.Mock()
+    mock.send.side_effect = send
+    return mock
+
+
+@pytest.fixture()
+def server(session_mock: t.Any, tmp_path: pathlib.Path) -> t.Iterator[daemon.Server]:
+    with daemon.Server(
+        session_mock, tmp_path / "labmail.sock", account="foo"
+    ) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join()
+
+
+def test_server_socket(server: daemon.Server) -> None:
+    assert daemon.is_running(server.filepath)
+    assert stat.S_IMODE(server.filepath.stat().st_mode) & 0o077 == 0
+    with pytest.raises(RuntimeError):
+        daemon.Server(server.session, server.filepath)
+
+
+def test_server_close(session_mock: t.Any, tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "labmail.sock"
+    filepath.touch()
+    assert not daemon.is_running(filepath)
+    with daemon.Server(session_mock, filepath):
+        assert filepath.exists()
+    assert not filepath.exists()
+
+
+def test_client_send(server: daemon.Server, session_mock: t.Any) -> None:
+    with daemon.Client(server.filepath) as client:
+        assert client.info()["account"] == "foo"
+        for recipient in ["bar@example.com", "baz@example.com"]:
+            assert client.send(
+                recipient,
+                "body",
+                "subject",
+                text_type=text_utils.TextType.MARKDOWN,
+                headers={"CC": "qux@example.com"},
+                dry_run=True,
+            ) == {"id": recipient}
+    session_mock.send.assert_called_with(
+        recipient="baz@example.com",
+        body="body",
+        subject="subject",
+        text_type=text_utils.TextType.MARKDOWN,
+        headers={"CC": "qux@example.com"},
+        disallow_same_subjects=False,
+        sendas_address=None,
+        attachments=[],
+        dry_run=True,
+    )
+
+
+@pytest.mark.parametrize(
+    "method, params, error_type",
+    [
+        ("send", {"recipient": "used"}, "SubjectUsedError"),
+        ("send", {"recipient": "foo", "text_type": "unknown"}, "ValueError"),
+        ("unknown", None, "ValueError"),
+    ],
+)
+def test_client_request_error(
+    method: str,
+    params: dict[str, t.Any] | None,
+    error_type: str,
+    server: daemon.Server,
+) -> None:
+    with daemon.Client(server.filepath) as client:
+        with pytest.raises(daemon.DaemonError) as exc_info:
+            client.request(method, params)
+        assert exc_info.value.type == error_type
+        assert client.info()["account"] == "foo"
+
+
+@pytest.mark.parametrize("line", [b"{\n", b"[]\n"])
+def test_server_invalid_request(line: bytes, server: daemon.Server) -> None:
+    with daemon.Client(server.filepath).connect() as client:
+        file = t.cast(t.Any, client._file)
+        file.write(line)
+        file.flush()
+        assert b"error" in file.readline()
+
+
+def test_client_not_running(tmp_path: pathlib.Path) -> None:
+    with pytest.raises(OSError):
+        daemon.Client(tmp_path / "labmail.sock").connect()
+
+
+def test_client_connection_closed(tmp_path: pathlib.Path, session_mock: t.Any) -> None:
+    filepath = tmp_path / "labmail.sock"
+    with daemon.Server(session_mock, filepath):
+        client = daemon.Client(filepath).connect()
+    with pytest.raises(ConnectionError):
+        client.info()
+    client.close()
+
+
+def test_unsupported_platform(
+    session_mock: t.Any, tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture
+) -> None:
+    mocker.patch.object(sys, "platform", "win32")
+    filepath = tmp_path / "labmail.sock"
+    assert not daemon.is_running(filepath)
+    with pytest.raises(OSError, match=daemon.UNSUPPORTED_MESSAGE):
+        daemon.Server(session_mock, filepath)
+    with pytest.raises(OSError, match=daemon.UNSUPPORTED_MESSAGE):
+        daemon.Client(filepath).connect()
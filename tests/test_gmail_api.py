@@ -1,14 +1,24 @@
 from __future__ import annotations
 
 import base64
+import email
+import email.mime.multipart as mime_multipart
 import email.mime.text as mime_text
+import io
+import json
 import os
+import pathlib
+import threading
+import time
 import typing as t
 
+import httplib2
 import pytest
 import pytest_mock
+from google.oauth2 import credentials
+from googleapiclient import errors, http
 
-from labmail import gmail_api
+from labmail import gmail_api, mime, retry, testing, timing
 from tests import FixtureRequest
 
 if t.TYPE_CHECKING:  # pragma: no cover
@@ -132,6 +142,51 @@ def test_credentials(
     save_mock.assert_called_once_with(creds_mock, filepath)
 
 
+@pytest.mark.parametrize("filename", ["test_credentials.json"])
+def test_credentials_unchanged(
+    filepath: str | os.PathLike[str],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    with open(filepath, "w") as f:
+        f.write("{}")
+    creds_mock = mocker.Mock(to_json=mocker.Mock(return_value="{}"))
+    mocker.patch("labmail.gmail_api.load_credentials", return_value=creds_mock)
+    save_mock = mocker.patch("labmail.gmail_api.save_credentials")
+    with gmail_api.credentials(filepath):
+        pass
+    save_mock.assert_not_called()
+
+
+@pytest.mark.parametrize("filename", ["test_credentials.json"])
+def test_credentials_refreshed(
+    filepath: str | os.PathLike[str],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    with open(filepath, "w") as f:
+        f.write('{"token": "old"}')
+    creds_mock = mocker.Mock(to_json=mocker.Mock(return_value='{"token": "new"}'))
+    mocker.patch("labmail.gmail_api.load_credentials", return_value=creds_mock)
+    save_mock = mocker.patch("labmail.gmail_api.save_credentials")
+    with gmail_api.credentials(filepath):
+        save_mock.assert_called_once_with(creds_mock, filepath)
+    save_mock.assert_called_once()
+
+
+@pytest.mark.parametrize("filename", ["test_credentials.json"])
+def test_credentials_changed_in_context(
+    filepath: str | os.PathLike[str],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    with open(filepath, "w") as f:
+        f.write('{"token": "old"}')
+    creds_mock = mocker.Mock(to_json=mocker.Mock(return_value='{"token": "old"}'))
+    mocker.patch("labmail.gmail_api.load_credentials", return_value=creds_mock)
+    with gmail_api.credentials(filepath):
+        creds_mock.to_json.return_value = '{"token": "new"}'
+    with open(filepath) as f:
+        assert f.read() == '{"token": "new"}'
+
+
 def test_build(mocker: pytest_mock.MockerFixture) -> None:
     build_mock = mocker.patch("googleapiclient.discovery.build")
     creds_mock = mocker.Mock()
@@ -262,6 +317,86 @@ def test_send_message_api_call(
     send_mock.return_value.execute.assert_called_once_with()
 
 
+def test_send_message_attachments(
+    tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture
+) -> None:
+    filepath = tmp_path / "report.bin"
+    filepath.write_bytes(os.urandom(1000))
+    message = mime_multipart.MIMEMultipart()
+    message.attach(mime_text.MIMEText("body"))
+    message.attach(mime.FileAttachment(filepath))
+    uploaded: list[bytes] = list()
+
+    def send(userId: str, media_body: http.MediaIoBaseUpload) -> t.Any:
+        uploaded.append(media_body.getbytes(0, t.cast(int, media_body.size())))
+        return mocker.Mock(execute=mocker.Mock(return_value={"id": "id"}))
+
+    rsc_mock = mocker.Mock()
+    rsc_mock.users().messages().send.side_effect = send
+    assert gmail_api.send_message(rsc_mock, message=message) == {"id": "id"}
+    assert uploaded == [message_bytes(message)]
+    parts = email.message_from_bytes(uploaded[0]).get_payload()
+    attachment = t.cast("list[email.message.Message]", parts)[1]
+    assert attachment.get_payload(decode=True) == filepath.read_bytes()
+
+
+def test_upload_message(mocker: pytest_mock.MockerFixture) -> None:
+    rsc_mock = mocker.Mock()
+    send_mock = rsc_mock.users().messages().send
+    response = gmail_api.upload_message(
+        rsc_mock, fd=io.BytesIO(b"message"), chunk_size=256 * 1024
+    )
+    assert response == send_mock.return_value.execute.return_value
+    media = send_mock.call_args.kwargs["media_body"]
+    assert send_mock.call_args.kwargs["userId"] == "me"
+    assert media.mimetype() == "message/rfc822"
+    assert media.resumable()
+    assert media.chunksize() == 256 * 1024
+
+
+def test_upload_message_request() -> None:
+    document = gmail_api.trim_discovery_document(gmail_api.get_discovery_document())
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    rsc = gmail_api.build(creds, document=document)
+    media = http.MediaIoBaseUpload(
+        io.BytesIO(b"message"), mimetype="message/rfc822", resumable=True
+    )
+    request = rsc.users().messages().send(userId="me", media_body=media)
+    assert request.uri.startswith(
+        "https://gmail.googleapis.com/upload/gmail/v1/users/me/messages/send"
+    )
+    assert "uploadType=resumable" in request.uri
+
+
+def test_encode_message_attachments(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "report.txt"
+    filepath.write_bytes(b"report")
+    message = mime_multipart.MIMEMultipart()
+    message.attach(mime.FileAttachment(filepath))
+    raw = base64.urlsafe_b64decode(gmail_api.encode_message(message))
+    assert raw == message_bytes(message)
+
+
+def message_bytes(message: mime_multipart.MIMEMultipart) -> bytes:
+    buffer = io.BytesIO()
+    mime.write_message(message, buffer)
+    return buffer.getvalue()
+
+
+def test_send_message_timings(mocker: pytest_mock.MockerFixture) -> None:
+    with timing.Timer() as timer:
+        gmail_api.send_message(mocker.Mock(), message=mime_text.MIMEText("body"))
+    assert list(timer.timings.phases) == [timing.Phase.ENCODE, timing.Phase.HTTP]
+
+
+def test_send_raw_message(mocker: pytest_mock.MockerFixture) -> None:
+    rsc_mock = mocker.Mock()
+    send_mock = rsc_mock.users().messages().send
+    response = gmail_api.send_raw_message(rsc_mock, raw="raw")
+    send_mock.assert_called_once_with(userId="me", body={"raw": "raw"})
+    assert response == send_mock.return_value.execute.return_value
+
+
 @pytest.fixture()
 def sendas_list() -> list[schemas.SendAs]:
     default_sendas: schemas.SendAs = {
@@ -335,3 +470,626 @@ def test_get_sendas_api_call(
     gmail_api.get_sendas(rsc_mock, user_id, address=address)
     list_mock.assert_called_once_with(userId=user_id)
     list_mock.return_value.execute.assert_called_once_with()
+
+
+def _http_error(status: int, reason: str = "") -> errors.HttpError:
+    content = {"error": {"code": status, "message": "", "errors": [{"reason": reason}]}}
+    return errors.HttpError(
+        httplib2.Response({"status": str(status)}), json.dumps(content).encode()
+    )
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (_http_error(400), False),
+        (_http_error(403, "forbidden"), False),
+        (_http_error(403, "rateLimitExceeded"), True),
+        (_http_error(403, "userRateLimitExceeded"), True),
+        (_http_error(429), True),
+        (_http_error(500), True),
+        (_http_error(503), True),
+    ],
+)
+def test_is_retriable_error(error: errors.HttpError, expected: bool) -> None:
+    assert gmail_api.is_retriable_error(error) is expected
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (_http_error(403, "forbidden"), False),
+        (_http_error(403, "rateLimitExceeded"), True),
+        (_http_error(429), True),
+        (_http_error(503), False),
+    ],
+)
+def test_is_rate_limit_error(error: errors.HttpError, expected: bool) -> None:
+    assert gmail_api.is_rate_limit_error(error) is expected
+
+
+def test_get_message_retries(mocker: pytest_mock.MockerFixture) -> None:
+    sleep_mock = mocker.patch("time.sleep")
+    rsc_mock = mocker.Mock()
+    execute_mock = rsc_mock.users().messages().get.return_value.execute
+    execute_mock.side_effect = [_http_error(503), _http_error(429), {"id": "id"}]
+    assert gmail_api.get_message(rsc_mock, id="id") == {"id": "id"}
+    assert execute_mock.call_count == 3
+    assert sleep_mock.call_count == 2
+
+
+def test_send_message_retry_after(mocker: pytest_mock.MockerFixture) -> None:
+    sleep_mock = mocker.patch("time.sleep")
+    error = _http_error(429)
+    error.resp["retry-after"] = "7"
+    rsc_mock = mocker.Mock()
+    execute_mock = rsc_mock.users().messages().send.return_value.execute
+    execute_mock.side_effect = [error, {"id": "id"}]
+    gmail_api.send_message(rsc_mock, message=mime_text.MIMEText("body"))
+    sleep_mock.assert_called_once_with(7.0)
+    # halved by the throttled request, then increased by the successful one
+    assert gmail_api.concurrency.limit == 4.25
+
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504])
+def test_send_message_does_not_retry_server_error(
+    status: int, mocker: pytest_mock.MockerFixture
+) -> None:
+    rsc_mock = mocker.Mock()
+    execute_mock = rsc_mock.users().messages().send.return_value.execute
+    execute_mock.side_effect = [_http_error(status), {"id": "id"}]
+    with pytest.raises(errors.HttpError):
+        gmail_api.send_message(rsc_mock, message=mime_text.MIMEText("body"))
+    assert execute_mock.call_count == 1
+    assert gmail_api.concurrency.in_flight == 0
+
+
+def test_retry_max_elapsed(mocker: pytest_mock.MockerFixture) -> None:
+    sleep_mock = mocker.patch("time.sleep")
+    mocker.patch(
+        "labmail.gmail_api.retry_policy",
+        retry.RetryPolicy(base_delay=0, max_elapsed=10.0),
+    )
+    error = _http_error(429)
+    error.resp["retry-after"] = "20"
+    rsc_mock = mocker.Mock()
+    execute_mock = rsc_mock.users().messages().get.return_value.execute
+    execute_mock.side_effect = [error, {"id": "id"}]
+    with pytest.raises(errors.HttpError):
+        gmail_api.get_message(rsc_mock, id="id")
+    sleep_mock.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "retry_policy, expected_calls",
+    [(None, 1), (retry.RetryPolicy(max_retries=2, base_delay=0), 3)],
+)
+def test_list_sendas_gives_up(
+    retry_policy: retry.RetryPolicy | None,
+    expected_calls: int,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch("labmail.gmail_api.retry_policy", retry_policy)
+    rsc_mock = mocker.Mock()
+    execute_mock = rsc_mock.users().settings().sendAs().list.return_value.execute
+    execute_mock.side_effect = _http_error(500)
+    with pytest.raises(errors.HttpError):
+        gmail_api.list_sendas(rsc_mock)
+    assert execute_mock.call_count == expected_calls
+
+
+def test_list_message_does_not_retry_client_error(
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    rsc_mock = mocker.Mock()
+    execute_mock = rsc_mock.users().messages().list.return_value.execute
+    execute_mock.side_effect = _http_error(400)
+    with pytest.raises(errors.HttpError):
+        gmail_api.list_message(rsc_mock)
+    assert execute_mock.call_count == 1
+    assert gmail_api.concurrency.in_flight == 0
+
+
+class FakeBatch:
+    def __init__(
+        self,
+        callback: t.Callable[[str, t.Any, errors.HttpError | None], None],
+        failures: dict[int, list[errors.HttpError]],
+        batches: list[list[int]],
+        batch_failures: list[errors.HttpError],
+    ) -> None:
+        self.callback = callback
+        self.failures = failures
+        self.batches = batches
+        self.batch_failures = batch_failures
+        self.request_ids: list[str] = list()
+
+    def add(self, request: t.Any, request_id: str) -> None:
+        self.request_ids.append(request_id)
+
+    def execute(self) -> None:
+        if self.batch_failures:
+            raise self.batch_failures.pop(0)
+        self.batches.append([int(request_id) for request_id in self.request_ids])
+        for request_id in self.request_ids:
+            failures = self.failures.get(int(request_id), [])
+            if failures:
+                self.callback(request_id, None, failures.pop(0))
+            else:
+                self.callback(request_id, {"id": request_id}, None)
+
+
+@pytest.fixture()
+def batches() -> list[list[int]]:
+    return list()
+
+
+@pytest.fixture()
+def failures() -> dict[int, list[errors.HttpError]]:
+    return dict()
+
+
+@pytest.fixture()
+def batch_failures() -> list[errors.HttpError]:
+    return list()
+
+
+@pytest.fixture()
+def batch_rsc_mock(
+    failures: dict[int, list[errors.HttpError]],
+    batches: list[list[int]],
+    batch_failures: list[errors.HttpError],
+    mocker: pytest_mock.MockerFixture,
+) -> t.Any:
+    mocker.patch("time.sleep")
+    rsc_mock = mocker.Mock()
+    rsc_mock.new_batch_http_request.side_effect = lambda callback: FakeBatch(
+        callback, failures, batches, batch_failures
+    )
+    return rsc_mock
+
+
+@pytest.mark.parametrize("num_messages", [0, 1, 50, 120])
+@pytest.mark.parametrize("batch_size", [1, 50, 100])
+def test_send_messages_batches(
+    num_messages: int,
+    batch_size: int,
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+) -> None:
+    messages = [mime_text.MIMEText(f"body {i}") for i in range(num_messages)]
+    results = gmail_api.send_messages(
+        batch_rsc_mock, messages=messages, batch_size=batch_size
+    )
+    assert results == [{"id": str(i)} for i in range(num_messages)]
+    assert len(batches) == -(-num_messages // batch_size)
+    assert all(len(batch) <= batch_size for batch in batches)
+    send_mock = batch_rsc_mock.users().messages().send
+    assert send_mock.call_count == num_messages
+    if num_messages > 0:
+        send_mock.assert_called_with(
+            userId="me", body={"raw": gmail_api.encode_message(messages[-1])}
+        )
+
+
+def test_send_messages_retries_failed(
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+    failures: dict[int, list[errors.HttpError]],
+) -> None:
+    failures[1] = [_http_error(429)]
+    # the messages might have been sent
+    failures[2] = [_http_error(500)]
+    failures[3] = [_http_error(429), _http_error(429)]
+    failures[4] = [_http_error(400)]
+    messages = [mime_text.MIMEText(f"body {i}") for i in range(6)]
+    results = gmail_api.send_messages(batch_rsc_mock, messages=messages, batch_size=4)
+    assert batches == [[0, 1, 2, 3], [4, 5], [1, 3], [3]]
+    assert [result == {"id": str(i)} for i, result in enumerate(results)] == [
+        True,
+        True,
+        False,
+        True,
+        False,
+        True,
+    ]
+    assert isinstance(results[2], errors.HttpError)
+    assert isinstance(results[4], errors.HttpError)
+    assert gmail_api.concurrency.limit < 8.0
+
+
+def test_send_messages_retry_after(
+    batch_rsc_mock: t.Any, failures: dict[int, list[errors.HttpError]]
+) -> None:
+    error = _http_error(429)
+    error.resp["retry-after"] = "7"
+    failures[0] = [error]
+    gmail_api.send_messages(batch_rsc_mock, messages=[mime_text.MIMEText("body")])
+    time.sleep.assert_called_once_with(7.0)  # type: ignore[attr-defined]
+
+
+def test_send_messages_max_retries(
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+    failures: dict[int, list[errors.HttpError]],
+) -> None:
+    failures[0] = [_http_error(429) for _ in range(10)]
+    messages = [mime_text.MIMEText("body")]
+    results = gmail_api.send_messages(batch_rsc_mock, messages=messages, max_retries=2)
+    assert len(batches) == 3
+    assert isinstance(results[0], errors.HttpError)
+
+
+def test_send_messages_max_elapsed(
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+    failures: dict[int, list[errors.HttpError]],
+) -> None:
+    error = _http_error(429)
+    error.resp["retry-after"] = "60"
+    failures[0] = [error]
+    messages = [mime_text.MIMEText(f"body {i}") for i in range(2)]
+    results = gmail_api.send_messages(batch_rsc_mock, messages=messages)
+    assert results[0] is error
+    assert results[1] == {"id": "1"}
+    assert len(batches) == 1
+    time.sleep.assert_not_called()  # type: ignore[attr-defined]
+
+
+def test_send_messages_batch_server_error(
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+    batch_failures: list[errors.HttpError],
+) -> None:
+    batch_failures.extend([_http_error(429), _http_error(503)])
+    with pytest.raises(errors.HttpError) as exc_info:
+        gmail_api.send_messages(batch_rsc_mock, messages=[mime_text.MIMEText("body")])
+    # retried only when throttled
+    assert exc_info.value.resp.status == 503
+    assert batches == []
+
+
+@pytest.mark.parametrize("batch_size", [0, gmail_api.BATCH_SIZE_LIMIT + 1])
+def test_send_messages_invalid_batch_size(
+    batch_size: int, mocker: pytest_mock.MockerFixture
+) -> None:
+    with pytest.raises(ValueError):
+        gmail_api.send_messages(mocker.Mock(), messages=[], batch_size=batch_size)
+
+
+@pytest.mark.parametrize("num_ids", [0, 1, 120])
+@pytest.mark.parametrize("batch_size", [1, 50, 100])
+def test_get_messages_batches(
+    num_ids: int,
+    batch_size: int,
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+) -> None:
+    ids = [f"id{i}" for i in range(num_ids)]
+    results = list(
+        gmail_api.get_messages(batch_rsc_mock, ids=ids, batch_size=batch_size)
+    )
+    assert results == [(f"id{i}", {"id": str(i)}) for i in range(num_ids)]
+    assert len(batches) == -(-num_ids // batch_size)
+    get_mock = batch_rsc_mock.users().messages().get
+    assert get_mock.call_count == num_ids
+    if num_ids > 0:
+        get_mock.assert_called_with(userId="me", format="full", id=ids[-1])
+
+
+def test_get_messages_metadata_headers(batch_rsc_mock: t.Any) -> None:
+    list(
+        gmail_api.get_messages(
+            batch_rsc_mock,
+            ids=["id"],
+            format="metadata",
+            metadata_headers=("Subject", "To"),
+        )
+    )
+    batch_rsc_mock.users().messages().get.assert_called_once_with(
+        userId="me", format="metadata", metadataHeaders=["Subject", "To"], id="id"
+    )
+
+
+@pytest.mark.parametrize(
+    "ordered, expected",
+    [(True, ["0", "1", "2", "3", "4"]), (False, ["0", "2", "3", "4", "1"])],
+)
+def test_get_messages_retries_failed(
+    ordered: bool,
+    expected: list[str],
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+    failures: dict[int, list[errors.HttpError]],
+) -> None:
+    failures[1] = [_http_error(429)]
+    failures[3] = [_http_error(404)]
+    ids = [str(i) for i in range(5)]
+    results = list(
+        gmail_api.get_messages(batch_rsc_mock, ids=ids, batch_size=2, ordered=ordered)
+    )
+    assert batches == [[0, 1], [2, 3], [4], [1]]
+    assert [id for id, _ in results] == expected
+    assert dict(results)["1"] == {"id": "1"}
+    assert isinstance(dict(results)["3"], errors.HttpError)
+
+
+def test_get_messages_retries_batch(
+    batch_rsc_mock: t.Any,
+    batches: list[list[int]],
+    batch_failures: list[errors.HttpError],
+) -> None:
+    batch_failures.extend([_http_error(503), _http_error(429)])
+    ids = [str(i) for i in range(3)]
+    results = list(gmail_api.get_messages(batch_rsc_mock, ids=ids, batch_size=2))
+    assert results == [(str(i), {"id": str(i)}) for i in range(3)]
+    assert batches == [[0, 1], [2]]
+    assert time.sleep.call_count == 2  # type: ignore[attr-defined]
+    assert gmail_api.concurrency.limit < 8.0
+    assert gmail_api.concurrency.in_flight == 0
+
+
+@pytest.mark.parametrize(
+    "retry_policy", [None, retry.RetryPolicy(max_retries=2, base_delay=0)]
+)
+def test_get_messages_batch_gives_up(
+    retry_policy: retry.RetryPolicy | None,
+    batch_rsc_mock: t.Any,
+    batch_failures: list[errors.HttpError],
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch("labmail.gmail_api.retry_policy", retry_policy)
+    batch_failures.extend(_http_error(500) for _ in range(4))
+    with pytest.raises(errors.HttpError):
+        list(gmail_api.get_messages(batch_rsc_mock, ids=["id"]))
+    assert len(batch_failures) == (3 if retry_policy is None else 1)
+
+
+def test_get_messages_streams(batch_rsc_mock: t.Any, batches: list[list[int]]) -> None:
+    ids = [str(i) for i in range(4)]
+    results = gmail_api.get_messages(batch_rsc_mock, ids=ids, batch_size=2)
+    assert next(results) == ("0", {"id": "0"})
+    assert batches == [[0, 1]]
+
+
+@pytest.mark.parametrize("batch_size", [0, gmail_api.BATCH_SIZE_LIMIT + 1])
+def test_get_messages_invalid_batch_size(
+    batch_size: int, mocker: pytest_mock.MockerFixture
+) -> None:
+    with pytest.raises(ValueError):
+        list(gmail_api.get_messages(mocker.Mock(), ids=[], batch_size=batch_size))
+
+
+def test_build_thread_safe(mocker: pytest_mock.MockerFixture) -> None:
+    build_mock = mocker.patch("googleapiclient.discovery.build")
+    authorized_http_mock = mocker.patch("google_auth_httplib2.AuthorizedHttp")
+    creds_mock = mocker.Mock()
+    rsc = gmail_api.build(creds_mock, thread_safe=True)
+    assert rsc == build_mock.return_value
+    request_builder = build_mock.call_args.kwargs["requestBuilder"]
+
+    https: list[t.Any] = list()
+
+    def build_request() -> None:
+        for _ in range(2):
+            https.append(request_builder(None, None, "https://example.com").http)
+
+    threads = [threading.Thread(target=build_request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert https[0] is https[1]
+    assert https[2] is https[3]
+    assert authorized_http_mock.call_count == 2
+
+
+def test_get_discovery_document() -> None:
+    document = gmail_api.get_discovery_document()
+    assert document["name"] == "gmail"
+    assert gmail_api.get_discovery_document() is document
+
+
+@pytest.mark.parametrize("thread_safe", [True, False])
+def test_build_from_document(
+    thread_safe: bool, mocker: pytest_mock.MockerFixture
+) -> None:
+    build_mock = mocker.patch("googleapiclient.discovery.build_from_document")
+    creds_mock = mocker.Mock()
+    document = {"name": "gmail"}
+    rsc = gmail_api.build(creds_mock, thread_safe=thread_safe, document=document)
+    assert rsc == build_mock.return_value
+    build_mock.assert_called_once()
+    assert build_mock.call_args.args == (document,)
+    assert build_mock.call_args.kwargs["credentials"] == creds_mock
+
+
+@pytest.mark.parametrize("env", [True, False])
+def test_build_root_url(env: bool, mocker: pytest_mock.MockerFixture) -> None:
+    build_mock = mocker.patch("googleapiclient.discovery.build_from_document")
+    root_url = "http://127.0.0.1:8080/"
+    if env:
+        mocker.patch("labmail._env.GMAIL_API_ROOT_URL", root_url)
+        gmail_api.build(mocker.Mock())
+    else:
+        gmail_api.build(mocker.Mock(), root_url=root_url)
+    document = build_mock.call_args.args[0]
+    assert document["rootUrl"] == root_url
+    assert document["name"] == "gmail"
+    assert gmail_api.get_discovery_document()["rootUrl"] != root_url
+
+
+@pytest.mark.parametrize(
+    "max_terms, max_query_length, num_queries",
+    [(50, gmail_api.MAX_QUERY_LENGTH, 3), (100, 200, 15)],
+)
+def test_find_subjects(
+    max_terms: int,
+    max_query_length: int,
+    num_queries: int,
+    fake_gmail: testing.FakeGmailServer,
+) -> None:
+    for subject, label_ids in [
+        ("Weekly report 1", ["SENT"]),
+        ("Weekly  report 2", ["SENT"]),
+        ('Say "hi"', ["SENT"]),
+        ("Weekly report", ["INBOX"]),
+    ]:
+        message = mime_text.MIMEText("body")
+        message["Subject"] = subject
+        fake_gmail.add_message(message, label_ids=label_ids)
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    rsc = gmail_api.build(creds, root_url=fake_gmail.root_url)
+    subjects = ["Weekly report", "Weekly report 1", "Weekly report 2", 'Say "hi"']
+    subjects.extend(f"Unused {i}" for i in range(100))
+    assert gmail_api.find_subjects(
+        rsc,
+        subjects=subjects,
+        max_terms=max_terms,
+        max_query_length=max_query_length,
+    ) == {"Weekly report 1", "Weekly report 2", 'Say "hi"'}
+    # the searches and the gets of the matched messages in a batch request
+    assert fake_gmail.num_requests == num_queries + 3
+
+    assert gmail_api.find_subjects(rsc, subjects=[]) == set()
+    assert fake_gmail.num_requests == num_queries + 3
+
+
+def test_find_subjects_deleted(
+    fake_gmail: testing.FakeGmailServer, mocker: pytest_mock.MockerFixture
+) -> None:
+    for subject in ["foo", "bar"]:
+        message = mime_text.MIMEText("body")
+        message["Subject"] = subject
+        fake_gmail.add_message(message)
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    rsc = gmail_api.build(creds, root_url=fake_gmail.root_url)
+    iter_messages = gmail_api.iter_messages
+
+    def delete_after_search(*args: t.Any, **kwargs: t.Any) -> t.Any:
+        messages = list(iter_messages(*args, **kwargs))
+        del fake_gmail.messages[messages[0]["id"]]
+        return iter(messages)
+
+    mocker.patch("labmail.gmail_api.iter_messages", side_effect=delete_after_search)
+    assert gmail_api.find_subjects(rsc, subjects=["foo", "bar"]) == {"foo"}
+
+
+def test_trim_discovery_document() -> None:
+    document = gmail_api.get_discovery_document()
+    trimmed = gmail_api.trim_discovery_document(document)
+    assert len(json.dumps(trimmed)) < len(json.dumps(document)) / 5
+    messages = trimmed["resources"]["users"]["resources"]["messages"]
+    assert set(messages["methods"]) == {"list", "get", "send"}
+    assert "Message" in trimmed["schemas"]
+    assert "MessagePart" in trimmed["schemas"]
+    assert "description" not in messages["methods"]["send"]
+    assert trimmed["rootUrl"] == document["rootUrl"]
+
+
+def test_trim_discovery_document_unknown_method() -> None:
+    with pytest.raises(KeyError):
+        gmail_api.trim_discovery_document(
+            gmail_api.get_discovery_document(), ["users.messages.unknown"]
+        )
+
+
+def test_build_from_trimmed_document() -> None:
+    document = gmail_api.trim_discovery_document(gmail_api.get_discovery_document())
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    rsc = gmail_api.build(creds, document=document)
+    request = rsc.users().messages().send(userId="me", body={"raw": "raw"})
+    assert request.uri.startswith(
+        "https://gmail.googleapis.com/gmail/v1/users/me/messages/send"
+    )
+    assert request.method == "POST"
+
+
+def test_index_sendas(sendas_list: list[schemas.SendAs]) -> None:
+    addr_to_sendas = gmail_api.index_sendas(sendas_list)
+    assert addr_to_sendas[None] == sendas_list[0]
+    for sendas in sendas_list:
+        assert addr_to_sendas[sendas["sendAsEmail"]] == sendas
+
+
+def test_list_sendas_empty(mocker: pytest_mock.MockerFixture) -> None:
+    rsc_mock = mocker.Mock()
+    rsc_mock.users().settings().sendAs().list.return_value.execute.return_value = {}
+    assert gmail_api.list_sendas(rsc_mock) == []
+
+
+@pytest.fixture()
+def paged_rsc_mock(mocker: pytest_mock.MockerFixture) -> t.Any:
+    num_messages = 25
+    rsc_mock = mocker.Mock()
+
+    def list_(
+        userId: str,
+        q: str,
+        maxResults: int,
+        pageToken: str,
+        labelIds: list[str],
+        includeSpamTrash: bool,
+    ) -> t.Any:
+        start = int(pageToken or 0)
+        end = min(start + maxResults, num_messages)
+        response: dict[str, t.Any] = {
+            "messages": [{"id": str(i)} for i in range(start, end)],
+            "resultSizeEstimate": num_messages,
+        }
+        if end < num_messages:
+            response["nextPageToken"] = str(end)
+        return mocker.Mock(execute=mocker.Mock(return_value=response))
+
+    rsc_mock.users().messages().list.side_effect = list_
+    return rsc_mock
+
+
+@pytest.mark.parametrize("prefetch", [True, False])
+@pytest.mark.parametrize("page_size", [1, 10, 100])
+@pytest.mark.parametrize("limit", [None, 0, 5, 25, 100])
+def test_iter_messages(
+    prefetch: bool, page_size: int, limit: int | None, paged_rsc_mock: t.Any
+) -> None:
+    messages = list(
+        gmail_api.iter_messages(
+            paged_rsc_mock, limit=limit, page_size=page_size, prefetch=prefetch
+        )
+    )
+    expected = 25 if limit is None else min(limit, 25)
+    assert [message["id"] for message in messages] == [str(i) for i in range(expected)]
+    list_mock = paged_rsc_mock.users().messages().list
+    assert list_mock.call_count == -(-expected // page_size)
+    for call in list_mock.call_args_list:
+        assert call.kwargs["maxResults"] <= page_size
+
+
+@pytest.mark.parametrize("thread_safe", [True, False])
+@pytest.mark.parametrize("prefetch", [True, None])
+def test_iter_messages_prefetch(
+    prefetch: bool | None,
+    thread_safe: bool,
+    paged_rsc_mock: t.Any,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch("labmail.gmail_api.is_thread_safe", return_value=thread_safe)
+    iterator = gmail_api.iter_messages(paged_rsc_mock, page_size=10, prefetch=prefetch)
+    assert next(iterator)["id"] == "0"
+    list_mock = paged_rsc_mock.users().messages().list
+    expected = 2 if prefetch or thread_safe else 1
+    for _ in range(100):
+        if list_mock.call_count == expected:
+            break
+        time.sleep(0.01)
+    time.sleep(0.01)
+    assert list_mock.call_count == expected
+    iterator.close()
+    assert list_mock.call_count == expected
+
+
+def test_is_thread_safe(mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch(
+        "googleapiclient.discovery.build", side_effect=lambda **kwargs: mocker.Mock()
+    )
+    assert gmail_api.is_thread_safe(gmail_api.build(mocker.Mock(), thread_safe=True))
+    assert not gmail_api.is_thread_safe(gmail_api.build(mocker.Mock()))
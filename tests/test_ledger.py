@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import email.mime.text as mime_text
+import io
+import pathlib
+import sqlite3
+
+import httplib2
+import pytest
+import pytest_mock
+from googleapiclient import errors
+
+import labmail
+from labmail import gmail_api, ledger, session, testing
+
+
+@pytest.fixture()
+def ledger_(tmp_path: pathlib.Path) -> ledger.SendLedger:
+    return ledger.SendLedger(tmp_path / "ledger.sqlite3")
+
+
+@pytest.fixture()
+def credentials_filepath(
+    fake_gmail: testing.FakeGmailServer,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> str:
+    mocker.patch("labmail._env.GMAIL_API_ROOT_URL", fake_gmail.root_url)
+    filepath = str(tmp_path / "credentials.json")
+    testing.write_credentials(filepath)
+    return filepath
+
+
+def test_fingerprint() -> None:
+    key = ledger.fingerprint("foo@example.com,Bar@example.com", "subject", "body")
+    assert key == ledger.fingerprint(
+        ["bar@example.com", " foo@example.com"], "subject", "body"
+    )
+    assert key != ledger.fingerprint("foo@example.com", "subject", "body")
+    assert key != ledger.fingerprint(
+        "foo@example.com,bar@example.com", "subject", "other"
+    )
+    assert key != ledger.fingerprint("foo@example.com,bar@example.com", "other", "body")
+
+
+def test_message_id() -> None:
+    assert ledger.message_id("key") == ledger.message_id("key")
+    assert ledger.message_id("key") != ledger.message_id("other")
+    assert ledger.message_id("key").endswith("@labmail>")
+
+
+def test_ledger_begin_complete(ledger_: ledger.SendLedger) -> None:
+    assert ledger_.get("key") is None
+    assert ledger_.begin("key") is None
+    entry = ledger_.begin("key")
+    assert entry is not None
+    assert entry.status is ledger.Status.PENDING
+    assert not ledger_.is_abandoned(entry)
+
+    ledger_.complete("key", "id", "thread")
+    entry = ledger_.get("key")
+    assert entry is not None
+    assert entry.status is ledger.Status.SENT
+    assert (entry.message_id, entry.thread_id) == ("id", "thread")
+    assert ledger_.begin("key") == entry
+
+    # shared across instances
+    assert ledger.SendLedger(ledger_.filepath).get("key") == entry
+
+
+@pytest.mark.parametrize("ambiguous", [True, False])
+def test_ledger_fail(ambiguous: bool, ledger_: ledger.SendLedger) -> None:
+    ledger_.begin("key")
+    ledger_.fail("key", ambiguous=ambiguous)
+    entry = ledger_.get("key")
+    if ambiguous:
+        assert entry is not None
+        assert entry.status is ledger.Status.UNKNOWN
+        assert ledger_.is_abandoned(entry)
+    else:
+        assert entry is None
+
+    # the sent messages are never forgotten
+    ledger_.complete("key", "id", None)
+    ledger_.fail("key", ambiguous=False)
+    assert ledger_.get("key") is not None
+
+
+def test_ledger_connection(
+    ledger_: ledger.SendLedger, mocker: pytest_mock.MockerFixture
+) -> None:
+    connect_spy = mocker.spy(sqlite3, "connect")
+    assert ledger_.begin("key") is None
+    ledger_.complete("key", "id", None)
+    for _ in range(3):
+        assert ledger_.get("key") is not None
+    connect_spy.assert_called_once()
+    ledger_.close()
+    assert ledger_.get("key") is not None
+    assert connect_spy.call_count == 2
+
+
+def test_session_close_ledger(
+    credentials_filepath: str,
+    ledger_: ledger.SendLedger,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    close_spy = mocker.spy(ledger_, "close")
+    with session.Session(credentials_filepath, ledger=ledger_):
+        pass
+    close_spy.assert_called_once()
+
+
+def test_ledger_take_over(tmp_path: pathlib.Path) -> None:
+    ledger_ = ledger.SendLedger(tmp_path / "ledger.sqlite3", pending_timeout=0)
+    ledger_.begin("key")
+    entry = ledger_.begin("key")
+    assert entry is not None
+    assert ledger_.is_abandoned(entry)
+    assert ledger_.take_over(entry)
+    # taken over by the other
+    assert not ledger_.take_over(entry)
+
+
+def test_session_send(
+    credentials_filepath: str,
+    ledger_: ledger.SendLedger,
+    fake_gmail: testing.FakeGmailServer,
+) -> None:
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        first = sess.send("foo@example.com", "body", "subject")
+        assert first is not None
+        num_requests = fake_gmail.num_requests
+        # answered from the ledger
+        assert sess.send("foo@example.com", "body", "subject") == {
+            "id": first["id"],
+            "threadId": first["threadId"],
+        }
+        assert fake_gmail.num_requests == num_requests
+        sess.send("foo@example.com", "other body", "subject")
+        sess.send("foo@example.com", io.StringIO("body"), idempotency_key="key")
+        sess.send("foo@example.com", "other body", idempotency_key="key")
+    assert len(fake_gmail.messages) == 3
+    headers = fake_gmail.messages[first["id"]]["payload"]["headers"]
+    key = ledger.fingerprint("foo@example.com", "subject", "body")
+    assert {"name": "Message-ID", "value": ledger.message_id(key)} in headers
+
+
+def test_session_send_invalid_key(
+    credentials_filepath: str, ledger_: ledger.SendLedger
+) -> None:
+    with session.Session(credentials_filepath) as sess:
+        with pytest.raises(ValueError):
+            sess.send("foo@example.com", idempotency_key="key")
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        with pytest.raises(ValueError):
+            sess.send("foo@example.com", io.StringIO("body"))
+
+
+def test_session_send_dry_run(
+    credentials_filepath: str, ledger_: ledger.SendLedger
+) -> None:
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        assert sess.send("foo@example.com", idempotency_key="key", dry_run=True) is None
+    assert ledger_.get("key") is None
+
+
+def test_session_send_in_progress(
+    credentials_filepath: str, ledger_: ledger.SendLedger
+) -> None:
+    ledger_.begin("key")
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        with pytest.raises(ledger.SendInProgressError):
+            sess.send("foo@example.com", idempotency_key="key")
+
+
+@pytest.mark.parametrize("sent", [True, False])
+def test_session_send_unknown(
+    sent: bool,
+    credentials_filepath: str,
+    ledger_: ledger.SendLedger,
+    fake_gmail: testing.FakeGmailServer,
+) -> None:
+    ledger_.begin("key")
+    ledger_.fail("key", ambiguous=True)
+    if sent:
+        message = mime_text.MIMEText("body")
+        message["Message-ID"] = ledger.message_id("key")
+        added = fake_gmail.add_message(message)
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        response = sess.send("foo@example.com", idempotency_key="key")
+    assert response is not None
+    assert len(fake_gmail.messages) == 1
+    if sent:
+        assert response["id"] == added["id"]
+    entry = ledger_.get("key")
+    assert entry is not None
+    assert entry.status is ledger.Status.SENT
+    assert entry.message_id == response["id"]
+
+
+@pytest.mark.parametrize(
+    "error, status",
+    [
+        (errors.HttpError(httplib2.Response({"status": "400"}), b""), None),
+        (
+            errors.HttpError(httplib2.Response({"status": "503"}), b""),
+            ledger.Status.UNKNOWN,
+        ),
+        (TimeoutError(), ledger.Status.UNKNOWN),
+    ],
+)
+def test_session_send_error(
+    error: Exception,
+    status: ledger.Status | None,
+    credentials_filepath: str,
+    ledger_: ledger.SendLedger,
+    fake_gmail: testing.FakeGmailServer,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    message = mime_text.MIMEText("body")
+    message["Subject"] = "subject"
+    fake_gmail.add_message(message)
+    mocker.patch.object(gmail_api, "send_message", side_effect=error)
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        with pytest.raises(type(error)):
+            sess.send("foo@example.com", idempotency_key="key")
+        with pytest.raises(labmail.SubjectUsedError):
+            sess.send(
+                "foo@example.com",
+                subject="subject",
+                disallow_same_subjects=True,
+                idempotency_key="used",
+            )
+    entry = ledger_.get("key")
+    assert (None if entry is None else entry.status) is status
+    assert ledger_.get("used") is None
+
+
+def test_session_send_many(
+    credentials_filepath: str,
+    ledger_: ledger.SendLedger,
+    fake_gmail: testing.FakeGmailServer,
+) -> None:
+    drafts = [
+        session.Draft("foo@example.com", "body", "subject"),
+        session.Draft("bar@example.com", "body", "subject"),
+        session.Draft("foo@example.com", "body", "subject"),
+        session.Draft("foo@example.com", "other", idempotency_key="key"),
+    ]
+    with session.Session(credentials_filepath, ledger=ledger_) as sess:
+        first = sess.send_many(drafts)
+        assert isinstance(first[2], ledger.SendInProgressError)
+        second = sess.send_many(drafts)
+    assert len(fake_gmail.messages) == 3
+    for idx in [0, 1, 3]:
+        assert second[idx] == {
+            "id": first[idx]["id"],  # type: ignore[index]
+            "threadId": first[idx]["threadId"],  # type: ignore[index]
+        }
+    assert second[2] == second[0]
+
+
+def test_send(
+    credentials_filepath: str,
+    tmp_path: pathlib.Path,
+    fake_gmail: testing.FakeGmailServer,
+) -> None:
+    ledger_filepath = tmp_path / "ledger.sqlite3"
+    for _ in range(2):
+        labmail.send(
+            "foo@example.com",
+            "body",
+            credentials_filepath=credentials_filepath,
+            ledger_filepath=ledger_filepath,
+        )
+        labmail.send_many(
+            [labmail.Draft("foo@example.com", idempotency_key="key")],
+            credentials_filepath=credentials_filepath,
+            ledger_filepath=ledger_filepath,
+        )
+    assert len(fake_gmail.messages) == 2
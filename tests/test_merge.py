@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import pathlib
+import typing as t
+
+import pytest
+import pytest_mock
+
+from labmail import merge, session, text_utils
+
+
+@pytest.fixture()
+def template() -> merge.Template:
+    return merge.Template(
+        "$email",
+        "Dear $name,",
+        "Hello, ${name}",
+        text_type=text_utils.TextType.MARKDOWN,
+        headers={"CC": "$cc"},
+        sendas_address="foo@example.com",
+    )
+
+
+def test_template_render(template: merge.Template) -> None:
+    draft = template.render({"email": "bar@example.com", "name": "Bar", "cc": 1})
+    assert draft == session.Draft(
+        "bar@example.com",
+        "Dear Bar,",
+        "Hello, Bar",
+        text_type=text_utils.TextType.MARKDOWN,
+        headers={"CC": "1"},
+        sendas_address="foo@example.com",
+    )
+
+
+def test_template_render_no_headers() -> None:
+    assert merge.Template("$email").render({"email": "a"}).headers is None
+
+
+def test_template_render_missing_column(template: merge.Template) -> None:
+    with pytest.raises(KeyError):
+        template.render({"email": "bar@example.com"})
+
+
+def test_read_rows_csv(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "rows.csv"
+    filepath.write_text("email,name\nfoo@example.com,Foo\nbar@example.com,Bar\n")
+    assert list(merge.read_rows(filepath)) == [
+        {"email": "foo@example.com", "name": "Foo"},
+        {"email": "bar@example.com", "name": "Bar"},
+    ]
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".ndjson"])
+def test_read_rows_jsonl(suffix: str, tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / f"rows{suffix}"
+    filepath.write_text('{"email": "foo@example.com"}\n\n{"email": 1}\n')
+    assert list(merge.read_rows(filepath)) == [
+        {"email": "foo@example.com"},
+        {"email": 1},
+    ]
+
+
+@pytest.mark.parametrize(
+    "filename, content", [("rows.jsonl", "[]\n"), ("rows.txt", "")]
+)
+def test_read_rows_invalid(filename: str, content: str, tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / filename
+    filepath.write_text(content)
+    with pytest.raises(ValueError):
+        list(merge.read_rows(filepath))
+
+
+@pytest.fixture()
+def session_mock(mocker: pytest_mock.MockerFixture) -> t.Any:
+    def send_many(drafts: list[session.Draft], **kwargs: t.Any) -> list[t.Any]:
+        return [
+            ValueError() if draft.recipient == "error" else {"id": draft.recipient}
+            for draft in drafts
+        ]
+
+    mock = mocker.Mock()
+    mock.send_many.side_effect = send_many
+    return mock
+
+
+@pytest.mark.parametrize("num_rows", [0, 1, 7])
+@pytest.mark.parametrize("chunk_size", [1, 3, 10])
+def test_merge(num_rows: int, chunk_size: int, session_mock: t.Any) -> None:
+    rows = [{"email": str(i)} for i in range(num_rows)]
+    results = list(
+        merge.merge(
+            session_mock,
+            merge.Template("$email"),
+            iter(rows),
+            chunk_size=chunk_size,
+            dry_run=True,
+        )
+    )
+    assert [result.index for result in results] == list(range(num_rows))
+    assert [result.result for result in results] == [
+        {"id": str(i)} for i in range(num_rows)
+    ]
+    assert session_mock.send_many.call_count == -(-num_rows // chunk_size)
+    assert all(
+        len(call.args[0]) <= chunk_size
+        for call in session_mock.send_many.call_args_list
+    )
+    if num_rows > 0:
+        assert session_mock.send_many.call_args.kwargs == {
+            "disallow_same_subjects": False,
+            "dry_run": True,
+            "batch_size": 50,
+        }
+
+
+def test_merge_errors(session_mock: t.Any) -> None:
+    rows = [{"email": "foo"}, {"name": "bar"}, {"email": "error"}, {"email": "baz"}]
+    results = list(merge.merge(session_mock, merge.Template("$email"), rows))
+    assert [result.failed for result in results] == [False, True, True, False]
+    assert results[1].draft is None
+    assert isinstance(results[1].result, KeyError)
+    assert results[3].result == {"id": "baz"}
+
+
+def test_merge_streams(session_mock: t.Any) -> None:
+    consumed: list[int] = list()
+
+    def rows() -> t.Iterator[dict[str, str]]:
+        for i in range(100):
+            consumed.append(i)
+            yield {"email": str(i)}
+
+    results = merge.merge(session_mock, merge.Template("$email"), rows(), chunk_size=10)
+    assert next(results).index == 0
+    assert len(consumed) == 20
+    results.close()
+
+
+def test_merge_invalid_chunk_size(session_mock: t.Any) -> None:
+    with pytest.raises(ValueError):
+        list(merge.merge(session_mock, merge.Template(""), [], chunk_size=0))
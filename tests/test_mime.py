@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import email
+import email.mime.application as mime_application
+import email.mime.multipart as mime_multipart
+import email.mime.text as mime_text
+import io
+import os
+import pathlib
+import typing as t
+
+import pytest
+
+from labmail import mime
+
+
+@pytest.fixture()
+def attachment_filepath(tmp_path: pathlib.Path) -> pathlib.Path:
+    filepath = tmp_path / "report.pdf"
+    filepath.write_bytes(os.urandom(3 * mime.CHUNK_SIZE + 1))
+    return filepath
+
+
+@pytest.mark.parametrize(
+    "filename, mimetype, expected",
+    [
+        ("report.pdf", None, "application/pdf"),
+        ("report.txt", None, "text/plain"),
+        ("report.tar.gz", None, "application/octet-stream"),
+        ("report", None, "application/octet-stream"),
+        ("report.pdf", "application/x-foo", "application/x-foo"),
+    ],
+)
+def test_file_attachment_content_type(
+    filename: str, mimetype: str | None, expected: str, tmp_path: pathlib.Path
+) -> None:
+    filepath = tmp_path / filename
+    filepath.write_bytes(b"report")
+    attachment = mime.FileAttachment(filepath, mimetype)
+    assert attachment.get_content_type() == expected
+    assert attachment.get_filename() == filename
+    assert attachment.size == 6
+
+
+def test_file_attachment_non_ascii_filename(tmp_path: pathlib.Path) -> None:
+    filepath = tmp_path / "報告.pdf"
+    filepath.write_bytes(b"report")
+    assert mime.FileAttachment(filepath).get_filename() == "報告.pdf"
+
+
+def test_file_attachment_not_found(tmp_path: pathlib.Path) -> None:
+    with pytest.raises(FileNotFoundError):
+        mime.FileAttachment(tmp_path / "not_found.pdf")
+
+
+def test_has_streamed_parts(attachment_filepath: pathlib.Path) -> None:
+    message = mime_multipart.MIMEMultipart()
+    message.attach(mime_text.MIMEText("body"))
+    assert not mime.has_streamed_parts(message)
+    assert mime.has_streamed_parts(mime.StreamedText(["body"]))
+    message.attach(mime.FileAttachment(attachment_filepath))
+    assert mime.has_streamed_parts(message)
+
+
+@pytest.mark.parametrize("multipart", [True, False])
+def test_write_message_same_as_bytes(multipart: bool) -> None:
+    message: email.message.Message = mime_text.MIMEText("body", "html")
+    if multipart:
+        message = mime_multipart.MIMEMultipart()
+        message.attach(mime_text.MIMEText("body", "html"))
+        message.attach(mime_application.MIMEApplication(b"report"))
+    message["subject"] = "subject"
+    fp = io.BytesIO()
+    mime.write_message(message, fp)
+    assert fp.getvalue() == message.as_bytes()
+
+
+def test_write_message_file_attachment(attachment_filepath: pathlib.Path) -> None:
+    message = mime_multipart.MIMEMultipart()
+    message["subject"] = "subject"
+    message.attach(mime_text.MIMEText("body", "html"))
+    message.attach(mime.FileAttachment(attachment_filepath))
+    fp = io.BytesIO()
+    mime.write_message(message, fp)
+    expected = mime_multipart.MIMEMultipart(boundary=message.get_boundary())
+    expected["subject"] = "subject"
+    expected.attach(mime_text.MIMEText("body", "html"))
+    attachment = mime_application.MIMEApplication(
+        attachment_filepath.read_bytes(), "pdf"
+    )
+    attachment.add_header("Content-Disposition", "attachment", filename="report.pdf")
+    expected.attach(attachment)
+    assert fp.getvalue() == expected.as_bytes()
+    parsed = email.message_from_bytes(fp.getvalue())
+    assert parsed["subject"] == "subject"
+    part = t.cast("list[email.message.Message]", parsed.get_payload())[1]
+    assert part.get_filename() == "report.pdf"
+    assert part.get_payload(decode=True) == attachment_filepath.read_bytes()
+
+
+@pytest.mark.parametrize(
+    "text", ["", "body", "本文<br>" * 10000, "x" * (3 * mime.CHUNK_SIZE + 1)]
+)
+def test_write_message_streamed_text(text: str) -> None:
+    chunks = (text[idx : idx + 100] for idx in range(0, len(text), 100))
+    message = mime.StreamedText(chunks, "html")
+    message["subject"] = "subject"
+    fp = io.BytesIO()
+    mime.write_message(message, fp)
+    expected = mime_text.MIMEText(text, "html", "utf-8")
+    expected["subject"] = "subject"
+    assert fp.getvalue() == expected.as_bytes()
+    parsed = email.message_from_bytes(fp.getvalue())
+    assert parsed.get_payload(decode=True).decode() == text  # type: ignore[union-attr]
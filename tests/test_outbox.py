@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import email.mime.text as mime_text
+import pathlib
+import time
+import typing as t
+
+import httplib2
+import pytest
+import pytest_mock
+from googleapiclient import errors
+
+from labmail import outbox, retry
+
+
+@pytest.fixture()
+def outbox_(tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture) -> outbox.Outbox:
+    mocker.patch(
+        "labmail.gmail_api.encode_message",
+        side_effect=lambda message: message.get_payload(),
+    )
+    return outbox.Outbox(tmp_path / "outbox.sqlite3", visibility_timeout=10)
+
+
+@pytest.fixture()
+def build_mock(mocker: pytest_mock.MockerFixture) -> t.Any:
+    def build(creds: t.Any, **kwargs: t.Any) -> t.Any:
+        rsc_mock = mocker.Mock()
+
+        def send(userId: str, body: dict[str, str]) -> t.Any:
+            def execute() -> dict[str, t.Any]:
+                raw = body["raw"]
+                if raw == "error":
+                    raise errors.HttpError(httplib2.Response({"status": "400"}), b"")
+                if raw == "throttled":
+                    raise errors.HttpError(httplib2.Response({"status": "429"}), b"")
+                if raw == "unavailable":
+                    raise errors.HttpError(httplib2.Response({"status": "503"}), b"")
+                if raw == "timeout":
+                    raise TimeoutError("timed out")
+                return {"id": f"id-{raw}"}
+
+            return mocker.Mock(execute=execute)
+
+        rsc_mock.users().messages().send.side_effect = send
+        return rsc_mock
+
+    return mocker.patch("labmail.gmail_api.build", side_effect=build)
+
+
+def test_outbox_enqueue(outbox_: outbox.Outbox) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    entry = outbox_.get(id)
+    assert entry.id == id
+    assert entry.status == outbox.Status.QUEUED
+    assert entry.attempts == 0
+    assert entry.message_id is None
+    assert outbox_.counts() == {
+        outbox.Status.QUEUED: 1,
+        outbox.Status.SENDING: 0,
+        outbox.Status.SENT: 0,
+        outbox.Status.FAILED: 0,
+        outbox.Status.UNKNOWN: 0,
+    }
+
+
+def test_outbox_visibility_timeout(tmp_path: pathlib.Path) -> None:
+    outbox_ = outbox.Outbox(tmp_path / "outbox.sqlite3")
+    # a message is not claimed again while its send is being retried
+    assert retry.RetryPolicy().max_elapsed < outbox_.visibility_timeout
+
+
+def test_outbox_get_not_found(outbox_: outbox.Outbox) -> None:
+    with pytest.raises(KeyError):
+        outbox_.get(1)
+
+
+def _claim(outbox_: outbox.Outbox) -> outbox.Claim:
+    claim = outbox_.claim()
+    assert claim is not None
+    return claim
+
+
+def test_outbox_claim(outbox_: outbox.Outbox) -> None:
+    assert outbox_.claim() is None
+    id1 = outbox_.enqueue(mime_text.MIMEText("foo"))
+    id2 = outbox_.enqueue(mime_text.MIMEText("bar"))
+    assert outbox_.claim() == outbox.Claim(id1, "foo", 1)
+    assert outbox_.claim() == outbox.Claim(id2, "bar", 1)
+    assert outbox_.claim() is None
+    entry = outbox_.get(id1)
+    assert entry.status == outbox.Status.SENDING
+    assert entry.attempts == 1
+
+
+def test_outbox_claim_visibility_timeout(
+    outbox_: outbox.Outbox, mocker: pytest_mock.MockerFixture
+) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    assert outbox_.claim() == outbox.Claim(id, "foo", 1)
+    assert outbox_.claim() is None
+    # the worker has died while sending
+    mocker.patch("time.time", return_value=time.time() + 11)
+    assert outbox_.claim() == outbox.Claim(id, "foo", 2)
+    assert outbox_.get(id).attempts == 2
+
+
+def test_outbox_complete(outbox_: outbox.Outbox) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    assert outbox_.complete(_claim(outbox_), "message-id")
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.SENT
+    assert entry.message_id == "message-id"
+    assert outbox_.claim() is None
+
+
+def test_outbox_complete_expired_claim(
+    outbox_: outbox.Outbox, mocker: pytest_mock.MockerFixture
+) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    expired = _claim(outbox_)
+    mocker.patch("time.time", return_value=time.time() + 11)
+    claim = _claim(outbox_)
+    outbox_.fail(claim, "Bad Request", retriable=False)
+    # the late result of the expired claim does not override the re-claim
+    assert not outbox_.complete(expired, "message-id")
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.FAILED
+    assert entry.message_id is None
+
+
+def test_outbox_complete_reclaimed(
+    outbox_: outbox.Outbox, mocker: pytest_mock.MockerFixture
+) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    expired = _claim(outbox_)
+    mocker.patch("time.time", return_value=time.time() + 11)
+    claim = _claim(outbox_)
+    assert not outbox_.complete(expired, "expired-id")
+    outbox_.fail(expired, "Unavailable", retriable=True)
+    assert outbox_.get(id).status == outbox.Status.SENDING
+    assert outbox_.complete(claim, "message-id")
+    assert outbox_.get(id).message_id == "message-id"
+
+
+def test_outbox_fail_retriable(
+    outbox_: outbox.Outbox, mocker: pytest_mock.MockerFixture
+) -> None:
+    outbox_.max_attempts = 2
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    outbox_.fail(_claim(outbox_), "Unavailable", retriable=True)
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.QUEUED
+    assert entry.error == "Unavailable"
+    # retried after the delay
+    assert outbox_.claim() is None
+    mocker.patch("time.time", return_value=time.time() + 1.5)
+    claim = _claim(outbox_)
+    assert claim == outbox.Claim(id, "foo", 2)
+    outbox_.fail(claim, "Unavailable", retriable=True)
+    assert outbox_.get(id).status == outbox.Status.FAILED
+
+
+def test_outbox_fail_not_retriable(outbox_: outbox.Outbox) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    outbox_.fail(_claim(outbox_), "Bad Request", retriable=False)
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.FAILED
+    assert entry.attempts == 1
+    assert outbox_.claim() is None
+
+
+def test_outbox_fail_ambiguous(outbox_: outbox.Outbox) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    outbox_.fail(_claim(outbox_), "Unavailable", retriable=False, ambiguous=True)
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.UNKNOWN
+    assert entry.error == "Unavailable"
+    assert outbox_.claim() is None
+
+
+def test_outbox_fail_not_claimed(outbox_: outbox.Outbox) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    claim = _claim(outbox_)
+    outbox_.complete(claim, "message-id")
+    # a late failure does not override the result
+    outbox_.fail(claim, "Unavailable", retriable=False)
+    assert outbox_.get(id).status == outbox.Status.SENT
+
+
+def test_outbox_persistent(tmp_path: pathlib.Path, outbox_: outbox.Outbox) -> None:
+    id = outbox_.enqueue(mime_text.MIMEText("foo"))
+    reopened = outbox.Outbox(tmp_path / "outbox.sqlite3")
+    assert reopened.get(id).status == outbox.Status.QUEUED
+    assert reopened.claim() == outbox.Claim(id, "foo", 1)
+
+
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_outbox_workers(
+    num_workers: int,
+    outbox_: outbox.Outbox,
+    build_mock: t.Any,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    with outbox.OutboxWorkers(
+        outbox_, mocker.Mock(), num_workers=num_workers, poll_interval=0.01
+    ) as workers:
+        ids = [outbox_.enqueue(mime_text.MIMEText(str(i))) for i in range(20)]
+        assert workers.drain(timeout=10)
+    for i, id in enumerate(ids):
+        entry = outbox_.get(id)
+        assert entry.status == outbox.Status.SENT
+        assert entry.message_id == f"id-{i}"
+        assert entry.attempts == 1
+    build_mock.assert_called_once()
+    assert build_mock.call_args.kwargs["thread_safe"] is True
+
+
+def test_outbox_workers_errors(
+    outbox_: outbox.Outbox, build_mock: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    outbox_.max_attempts = 1
+    with outbox.OutboxWorkers(outbox_, mocker.Mock(), poll_interval=0.01) as workers:
+        error_id = outbox_.enqueue(mime_text.MIMEText("error"))
+        throttled_id = outbox_.enqueue(mime_text.MIMEText("throttled"))
+        sent_id = outbox_.enqueue(mime_text.MIMEText("foo"))
+        assert workers.drain(timeout=10)
+    assert outbox_.get(error_id).status == outbox.Status.FAILED
+    assert outbox_.get(throttled_id).status == outbox.Status.FAILED
+    assert outbox_.get(sent_id).status == outbox.Status.SENT
+
+
+@pytest.mark.parametrize("raw", ["unavailable", "timeout"])
+def test_outbox_workers_ambiguous(
+    raw: str,
+    outbox_: outbox.Outbox,
+    build_mock: t.Any,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    with outbox.OutboxWorkers(outbox_, mocker.Mock(), poll_interval=0.01) as workers:
+        id = outbox_.enqueue(mime_text.MIMEText(raw))
+        assert workers.drain(timeout=10)
+    # the message might have been sent, so it is not sent again
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.UNKNOWN
+    assert entry.attempts == 1
+
+
+def test_outbox_workers_retry(
+    outbox_: outbox.Outbox, build_mock: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    outbox_.max_retry_delay = 0
+    with outbox.OutboxWorkers(outbox_, mocker.Mock(), poll_interval=0.01) as workers:
+        id = outbox_.enqueue(mime_text.MIMEText("throttled"))
+        assert workers.drain(timeout=10)
+    entry = outbox_.get(id)
+    assert entry.status == outbox.Status.FAILED
+    assert entry.attempts == outbox_.max_attempts
+
+
+def test_outbox_workers_drain_timeout(
+    outbox_: outbox.Outbox, mocker: pytest_mock.MockerFixture
+) -> None:
+    outbox_.enqueue(mime_text.MIMEText("foo"))
+    workers = outbox.OutboxWorkers(outbox_, mocker.Mock())
+    assert not workers.drain(timeout=0.1)
+    # the queued messages are left after stopping
+    workers.stop()
+    assert outbox_.counts()[outbox.Status.QUEUED] == 1
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import email.mime.text as mime_text
+import pathlib
+import threading
+import time
+import typing as t
+
+import pytest
+import pytest_mock
+
+from labmail import cache, gmail_api, pool, testing
+
+
+@pytest.fixture()
+def build_mock(mocker: pytest_mock.MockerFixture) -> t.Any:
+    def build(creds: t.Any, **kwargs: t.Any) -> t.Any:
+        rsc_mock = mocker.Mock()
+
+        def send(userId: str, body: dict[str, str]) -> t.Any:
+            def execute() -> dict[str, t.Any]:
+                time.sleep(0.001)
+                if body["raw"] == "error":
+                    raise ValueError
+                return {"id": body["raw"], "threadId": str(threading.get_ident())}
+
+            return mocker.Mock(execute=execute)
+
+        rsc_mock.users().messages().send.side_effect = send
+        return rsc_mock
+
+    mocker.patch(
+        "labmail.gmail_api.encode_message",
+        side_effect=lambda message: message.get_payload(),
+    )
+    return mocker.patch("labmail.gmail_api.build", side_effect=build)
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+@pytest.mark.parametrize("num_messages", [0, 1, 30])
+def test_thread_pool_sender_send_messages(
+    max_workers: int,
+    num_messages: int,
+    build_mock: t.Any,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    messages = (mime_text.MIMEText(str(i)) for i in range(num_messages))
+    with pool.ThreadPoolSender(mocker.Mock(), max_workers=max_workers) as sender:
+        report = sender.send_messages(messages)
+    assert [result["id"] for result in report.results] == [  # type: ignore[index]
+        str(i) for i in range(num_messages)
+    ]
+    assert report.sent == num_messages
+    assert report.failed == 0
+    # the Resource object is shared across the worker threads
+    build_mock.assert_called_once()
+    assert build_mock.call_args.kwargs["thread_safe"] is True
+    thread_ids = {result["threadId"] for result in report.results}  # type: ignore[index]
+    assert len(thread_ids) <= max_workers
+
+
+def test_thread_pool_sender_fake_gmail(
+    fake_gmail: testing.FakeGmailServer, tmp_path: pathlib.Path
+) -> None:
+    filepath = tmp_path / "credentials.json"
+    testing.write_credentials(filepath)
+    creds = gmail_api.load_credentials(filepath)
+    document = dict(
+        cache.DiscoveryCache(tmp_path / "cache").load(), rootUrl=fake_gmail.root_url
+    )
+    messages = [mime_text.MIMEText(str(i)) for i in range(20)]
+    with pool.ThreadPoolSender(creds, max_workers=4, document=document) as sender:
+        report = sender.send_messages(messages)
+    assert report.sent == len(messages)
+    assert len(fake_gmail.messages) == len(messages)
+
+
+def test_thread_pool_sender_send_messages_error(
+    build_mock: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    messages = [mime_text.MIMEText("0"), mime_text.MIMEText("error")]
+    with pool.ThreadPoolSender(mocker.Mock(), max_workers=2) as sender:
+        report = sender.send_messages(messages)
+    assert report.sent == 1
+    assert report.failed == 1
+    assert isinstance(report.results[1], ValueError)
+
+
+@pytest.mark.parametrize(
+    "results, elapsed, throughput",
+    [([], 0.0, 0.0), ([{}, {}], 2.0, 1.0), ([{}, ValueError()], 0.5, 2.0)],
+)
+def test_send_report_throughput(
+    results: list[t.Any], elapsed: float, throughput: float
+) -> None:
+    assert pool.SendReport(results, elapsed).throughput == throughput
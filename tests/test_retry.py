@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import email.utils
+import threading
+import time
+
+import pytest
+import pytest_mock
+
+from labmail import retry
+
+
+@pytest.mark.parametrize(
+    "retry_num, expected", [(1, 1.0), (2, 2.0), (3, 4.0), (6, 10.0), (10, 10.0)]
+)
+def test_retry_policy_delay(retry_num: int, expected: float) -> None:
+    policy = retry.RetryPolicy(base_delay=1.0, max_delay=10.0, jitter=False)
+    assert policy.delay(retry_num) == expected
+
+
+def test_retry_policy_delay_jitter() -> None:
+    policy = retry.RetryPolicy(base_delay=1.0)
+    delays = [policy.delay(3) for _ in range(100)]
+    assert all(0 <= delay <= 4.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+@pytest.mark.parametrize("retry_after, expected", [(30.0, 30.0), (0.5, 2.0)])
+def test_retry_policy_delay_retry_after(retry_after: float, expected: float) -> None:
+    policy = retry.RetryPolicy(base_delay=1.0, jitter=False)
+    assert policy.delay(2, retry_after) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected", [(None, None), ("120", 120.0), (" 5 ", 5.0), ("soon", None)]
+)
+def test_parse_retry_after(value: str | None, expected: float | None) -> None:
+    assert retry.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_date() -> None:
+    value = email.utils.formatdate(time.time() + 60, usegmt=True)
+    delay = retry.parse_retry_after(value)
+    assert delay is not None
+    assert 55 <= delay <= 60
+    past = email.utils.formatdate(time.time() - 60, usegmt=True)
+    assert retry.parse_retry_after(past) == 0.0
+
+
+def test_aimd_controller_increase() -> None:
+    controller = retry.AIMDController(2.0, maximum=3.0)
+    controller.on_success()
+    assert controller.limit == 2.5
+    for _ in range(10):
+        controller.on_success()
+    assert controller.limit == 3.0
+
+
+def test_aimd_controller_decrease(mocker: pytest_mock.MockerFixture) -> None:
+    monotonic_mock = mocker.patch("time.monotonic", return_value=100.0)
+    controller = retry.AIMDController(8.0, minimum=3.0, cooldown=1.0)
+    controller.on_throttle()
+    assert controller.limit == 4.0
+    # throttled requests sent at the old limit
+    controller.on_throttle()
+    assert controller.limit == 4.0
+    monotonic_mock.return_value = 101.0
+    controller.on_throttle()
+    assert controller.limit == 3.0
+
+
+def test_aimd_controller_limits_concurrency() -> None:
+    controller = retry.AIMDController(2.0)
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def request() -> None:
+        nonlocal max_in_flight
+        with controller:
+            with lock:
+                max_in_flight = max(max_in_flight, controller.in_flight)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max_in_flight == 2
+    assert controller.in_flight == 0
+
+
+def test_aimd_controller_invalid_limits() -> None:
+    with pytest.raises(ValueError):
+        retry.AIMDController(1.0, minimum=2.0)
@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import email
+import email.mime.text as mime_text
+import io
+import pathlib
+import time
+import tracemalloc
+import typing as t
+
+import pytest
+import pytest_mock
+
+import labmail
+from labmail import cache, gmail_api, mime, session, testing, text_utils, timing
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import schemas
+
+
+@pytest.fixture()
+def sendas() -> schemas.SendAs:
+    return {
+        "sendAsEmail": "default@example.com",
+        "signature": "default user",
+        "isDefault": True,
+    }
+
+
+@pytest.fixture()
+def mock_gmail_api(sendas: schemas.SendAs, mocker: pytest_mock.MockerFixture) -> t.Any:
+    mock = mocker.patch("labmail.session.gmail_api")
+    mock.list_sendas.return_value = [sendas]
+    mock.index_sendas.side_effect = gmail_api.index_sendas
+    mock.list_message.return_value = ([], "", 0)
+    mock.find_subjects.return_value = set()
+    return mock
+
+
+def test_session_open_close(mock_gmail_api: t.Any) -> None:
+    sess = session.Session("creds.json")
+    assert not sess.is_open
+    with pytest.raises(RuntimeError):
+        sess.rsc
+    with sess:
+        assert sess.is_open
+        assert sess.rsc == mock_gmail_api.build.return_value
+        mock_gmail_api.credentials.assert_called_once_with("creds.json", None)
+        mock_gmail_api.credentials.return_value.__exit__.assert_not_called()
+    assert not sess.is_open
+    mock_gmail_api.credentials.return_value.__exit__.assert_called_once()
+
+
+def test_session_open_twice(mock_gmail_api: t.Any) -> None:
+    with session.Session() as sess:
+        assert sess.open() is sess
+    mock_gmail_api.build.assert_called_once()
+
+
+def test_session_close_with_exception(mock_gmail_api: t.Any) -> None:
+    with pytest.raises(KeyError):
+        with session.Session():
+            raise KeyError
+    exit_mock = mock_gmail_api.credentials.return_value.__exit__
+    assert KeyError in exit_mock.call_args.args
+
+
+def test_session_get_sendas_cached(mock_gmail_api: t.Any) -> None:
+    with session.Session() as sess:
+        for _ in range(3):
+            assert sess.get_sendas() == sess.get_sendas("default@example.com")
+    mock_gmail_api.list_sendas.assert_called_once()
+
+
+def test_session_get_sendas_not_found(mock_gmail_api: t.Any) -> None:
+    with session.Session() as sess:
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                sess.get_sendas("unknown@example.com")
+    mock_gmail_api.list_sendas.assert_called_once()
+
+
+@pytest.mark.parametrize("refresh_signature", [True, False])
+def test_session_get_sendas_disk_cache(
+    refresh_signature: bool,
+    sendas: schemas.SendAs,
+    mock_gmail_api: t.Any,
+    tmp_path: pathlib.Path,
+) -> None:
+    with session.Session(cache_dir=tmp_path) as sess:
+        sess.get_sendas()
+    with session.Session(
+        cache_dir=tmp_path, refresh_signature=refresh_signature
+    ) as sess:
+        assert sess.get_sendas() == sendas
+    assert mock_gmail_api.list_sendas.call_count == (2 if refresh_signature else 1)
+
+
+def test_session_get_sendas_disk_cache_lacks_address(
+    sendas: schemas.SendAs,
+    mock_gmail_api: t.Any,
+    tmp_path: pathlib.Path,
+) -> None:
+    with session.Session(cache_dir=tmp_path) as sess:
+        sess.get_sendas()
+    new_sendas: schemas.SendAs = {"sendAsEmail": "new@example.com", "signature": ""}
+    mock_gmail_api.list_sendas.return_value = [sendas, new_sendas]
+    with session.Session(cache_dir=tmp_path) as sess:
+        assert sess.get_sendas() == sendas
+        assert sess.get_sendas("new@example.com") == new_sendas
+    assert mock_gmail_api.list_sendas.call_count == 2
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+@pytest.mark.parametrize("text_type", list(text_utils.TextType))
+def test_session_send(
+    dry_run: bool,
+    text_type: text_utils.TextType,
+    mock_gmail_api: t.Any,
+) -> None:
+    with session.Session() as sess:
+        for _ in range(3):
+            response = sess.send(
+                ["foo@example.com", "bar@example.com"],
+                "body",
+                "subject",
+                text_type=text_type,
+                headers={"CC": "baz@example.com"},
+                dry_run=dry_run,
+            )
+    mock_gmail_api.build.assert_called_once()
+    mock_gmail_api.list_sendas.assert_called_once()
+    if dry_run:
+        assert response is None
+        mock_gmail_api.send_message.assert_not_called()
+    else:
+        assert response == mock_gmail_api.send_message.return_value
+        assert mock_gmail_api.send_message.call_count == 3
+        message = mock_gmail_api.send_message.call_args.kwargs["message"]
+        assert message["to"] == "foo@example.com,bar@example.com"
+        assert message["subject"] == "subject"
+        assert message["CC"] == "baz@example.com"
+
+
+def test_session_build_message_lines(mock_gmail_api: t.Any) -> None:
+    with session.Session() as sess:
+        message = sess.build_message(
+            "foo@example.com", iter(["foo\n", "bar\n"]), "subject"
+        )
+    assert isinstance(message, mime_text.MIMEText)
+    assert message["subject"] == "subject"
+    assert message.get_payload(decode=True).decode() == (  # type: ignore[union-attr]
+        "<p>foo<br>bar<br></p><div>--</div>default user"
+    )
+
+
+def test_session_build_message_lines_streamed(
+    mock_gmail_api: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    mocker.patch.object(session, "STREAMED_BODY_SIZE", 10)
+    with session.Session() as sess:
+        message = sess.build_message(
+            "foo@example.com", iter(["foo\n", "bar\n"]), "subject"
+        )
+    assert isinstance(message, mime.StreamedText)
+    fp = io.BytesIO()
+    mime.write_message(message, fp)
+    parsed = email.message_from_bytes(fp.getvalue())
+    assert parsed["subject"] == "subject"
+    assert parsed.get_payload(decode=True).decode() == (  # type: ignore[union-attr]
+        "<p>foo<br>bar<br></p><div>--</div>default user"
+    )
+
+
+def test_session_send_lines_memory(
+    mock_gmail_api: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    def upload_message(
+        rsc: t.Any, user_id: str = "me", *, fd: t.IO[bytes]
+    ) -> schemas.Message:
+        while fd.read(gmail_api.UPLOAD_CHUNK_SIZE):
+            pass
+        return {"id": "id"}
+
+    mock_gmail_api.send_message.side_effect = gmail_api.send_message
+    mocker.patch.object(gmail_api, "upload_message", side_effect=upload_message)
+    mocker.patch.object(session, "STREAMED_BODY_SIZE", 1024)
+
+    def measure(num_lines: int) -> int:
+        lines = ("x" * 99 + "\n" for _ in range(num_lines))
+        tracemalloc.start()
+        try:
+            with session.Session() as sess:
+                sess.send("foo@example.com", lines, "subject")
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    measure(1_000)  # warm up the caches
+    small = measure(1_000)
+    # 20 MB of the body
+    large = measure(200_000)
+    assert large - small < 2 * 1024 * 1024
+
+
+def test_session_build_message_attachments(
+    tmp_path: pathlib.Path, mock_gmail_api: t.Any
+) -> None:
+    filepath = tmp_path / "report.pdf"
+    filepath.write_bytes(b"report")
+    with session.Session() as sess:
+        message = sess.build_message(
+            "foo@example.com", "body", "subject", attachments=[filepath]
+        )
+    assert message.get_content_type() == "multipart/mixed"
+    assert message["subject"] == "subject"
+    body, attachment = t.cast("list[mime.FileAttachment]", message.get_payload())
+    assert body.get_content_type() == "text/html"
+    assert isinstance(attachment, mime.FileAttachment)
+    assert attachment.filepath == filepath
+
+
+def test_session_build_message_attachment_not_found(mock_gmail_api: t.Any) -> None:
+    with session.Session() as sess:
+        with pytest.raises(FileNotFoundError):
+            sess.build_message("foo@example.com", attachments=["not_found.pdf"])
+
+
+def test_session_send_timings(mock_gmail_api: t.Any) -> None:
+    with timing.Timer() as timer:
+        with session.Session() as sess:
+            sess.send("foo@example.com", "body", "subject", disallow_same_subjects=True)
+    assert list(timer.timings.phases) == [
+        timing.Phase.AUTH,
+        timing.Phase.BUILD,
+        timing.Phase.SUBJECT_CHECK,
+        timing.Phase.SENDAS,
+        timing.Phase.RENDER,
+    ]
+
+
+def test_send_timings(mock_gmail_api: t.Any, mocker: pytest_mock.MockerFixture) -> None:
+    hook = mocker.Mock()
+    result = labmail.send("foo@example.com", "body", "subject", on_phase=hook)
+    assert result.message == mock_gmail_api.send_message.return_value
+    assert timing.Phase.RENDER in result.timings.phases
+    assert hook.call_count == len(result.timings.phases)
+
+
+@pytest.mark.parametrize("used", [False, True])
+def test_session_send_disallow_same_subjects(used: bool, mock_gmail_api: t.Any) -> None:
+    mock_gmail_api.find_subjects.return_value = {"subject"} if used else set()
+    with session.Session() as sess:
+        if used:
+            with pytest.raises(labmail.SubjectUsedError):
+                sess.send(
+                    "foo@example.com", subject="subject", disallow_same_subjects=True
+                )
+        else:
+            sess.send("foo@example.com", subject="subject", disallow_same_subjects=True)
+        mock_gmail_api.find_subjects.assert_called_once_with(
+            mock_gmail_api.build.return_value, subjects={"subject"}
+        )
+        # the result is kept in the session
+        assert sess.is_subject_used("subject") is True
+    mock_gmail_api.find_subjects.assert_called_once()
+
+
+def test_session_find_used_subjects(mock_gmail_api: t.Any) -> None:
+    mock_gmail_api.find_subjects.side_effect = lambda rsc, subjects: {"a", "c"} & set(
+        subjects
+    )
+    with session.Session() as sess:
+        assert sess.find_used_subjects(["a", "b"]) == {"a"}
+        assert sess.find_used_subjects(["a", "b", "c"]) == {"a", "c"}
+        assert [
+            call.kwargs["subjects"]
+            for call in mock_gmail_api.find_subjects.call_args_list
+        ] == [{"a", "b"}, {"c"}]
+        sess.send("foo@example.com", subject="b")
+        assert sess.find_used_subjects(["b"]) == {"b"}
+    assert mock_gmail_api.find_subjects.call_count == 2
+
+
+def test_send(mocker: pytest_mock.MockerFixture) -> None:
+    session_mock = mocker.patch("labmail.session.Session")
+    result = labmail.send(
+        "foo@example.com", "body", "subject", credentials_filepath="c.json"
+    )
+    send_mock = session_mock.return_value.__enter__.return_value.send
+    assert result.message == send_mock.return_value
+    session_mock.assert_called_once_with(
+        "c.json", cache_dir=None, refresh_signature=False, ledger=None
+    )
+    session_mock.return_value.__enter__.return_value.send.assert_called_once_with(
+        "foo@example.com",
+        "body",
+        "subject",
+        text_type=text_utils.TextType.PLAIN,
+        headers=None,
+        disallow_same_subjects=False,
+        sendas_address=None,
+        attachments=None,
+        dry_run=False,
+        idempotency_key=None,
+    )
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+def test_session_send_many(dry_run: bool, mock_gmail_api: t.Any) -> None:
+    drafts = [
+        session.Draft(f"foo{i}@example.com", f"body {i}", f"subject {i}")
+        for i in range(3)
+    ]
+    mock_gmail_api.send_messages.side_effect = lambda rsc, messages, batch_size: [
+        {"id": message["to"]} for message in messages
+    ]
+    with session.Session() as sess:
+        results = sess.send_many(drafts, dry_run=dry_run)
+    mock_gmail_api.list_sendas.assert_called_once()
+    if dry_run:
+        assert results == [None, None, None]
+        mock_gmail_api.send_messages.assert_not_called()
+    else:
+        assert results == [{"id": draft.recipient} for draft in drafts]
+        mock_gmail_api.send_messages.assert_called_once()
+
+
+def test_session_send_many_disallow_same_subjects(mock_gmail_api: t.Any) -> None:
+    drafts = [
+        session.Draft("foo@example.com", subject="used"),
+        session.Draft("foo@example.com", subject="new"),
+        session.Draft("foo@example.com", subject="new"),
+    ]
+    mock_gmail_api.find_subjects.side_effect = lambda rsc, subjects: {"used"} & set(
+        subjects
+    )
+    mock_gmail_api.send_messages.side_effect = lambda rsc, messages, batch_size: [
+        {"id": message["subject"]} for message in messages
+    ]
+    with session.Session() as sess:
+        results = sess.send_many(drafts, disallow_same_subjects=True)
+    assert isinstance(results[0], labmail.SubjectUsedError)
+    assert results[1] == {"id": "new"}
+    assert isinstance(results[2], labmail.SubjectUsedError)
+    # the subjects are checked at once
+    mock_gmail_api.find_subjects.assert_called_once()
+
+
+def test_session_send_many_sendas_not_found(mock_gmail_api: t.Any) -> None:
+    mock_gmail_api.send_messages.return_value = []
+    with session.Session() as sess:
+        results = sess.send_many(
+            [session.Draft("foo@example.com", sendas_address="unknown@example.com")]
+        )
+    assert isinstance(results[0], ValueError)
+
+
+def test_send_many(mocker: pytest_mock.MockerFixture) -> None:
+    session_mock = mocker.patch("labmail.session.Session")
+    drafts = [labmail.Draft("foo@example.com")]
+    results = labmail.send_many(drafts, credentials_filepath="c.json")
+    session_mock.assert_called_once_with("c.json", ledger=None)
+    send_many_mock = session_mock.return_value.__enter__.return_value.send_many
+    assert results == send_many_mock.return_value
+    send_many_mock.assert_called_once_with(
+        drafts, disallow_same_subjects=False, dry_run=False, batch_size=50
+    )
+
+
+@pytest.mark.parametrize("cache_dir", [None, "cache"])
+def test_session_cache_dir(
+    cache_dir: str | None, mock_gmail_api: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    cache_mock = mocker.patch("labmail.cache.DiscoveryCache")
+    mocker.patch("labmail.cache.SendAsCache")
+    with session.Session(cache_dir=cache_dir):
+        pass
+    document = mock_gmail_api.build.call_args.kwargs["document"]
+    if cache_dir is None:
+        assert document is None
+        cache_mock.assert_not_called()
+    else:
+        cache_mock.assert_called_once_with(cache_dir)
+        assert document == cache_mock.return_value.load.return_value
+
+
+def test_session_disallow_same_subjects_subject_index(
+    tmp_path: pathlib.Path, mock_gmail_api: t.Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    mocker.patch("labmail.cache.DiscoveryCache")
+    index_mock = mocker.patch("labmail.cache.SubjectIndex")
+    index_mock.return_value.contains.side_effect = lambda subject: subject == "used"
+    mock_gmail_api.send_messages.return_value = [{"id": "0"}, ValueError()]
+    with session.Session("creds.json", cache_dir=tmp_path) as sess:
+        with pytest.raises(labmail.SubjectUsedError):
+            sess.send("foo@example.com", subject="used", disallow_same_subjects=True)
+        sess.send("foo@example.com", subject="new", disallow_same_subjects=True)
+        index_mock.return_value.add.assert_called_once_with(["new"])
+        sess.send_many(
+            [session.Draft("foo@example.com", subject=f"new{i}") for i in range(2)],
+            disallow_same_subjects=True,
+        )
+        assert list(index_mock.return_value.add.call_args.args[0]) == ["new0"]
+    index_mock.assert_called_once_with(
+        tmp_path, str(pathlib.Path("creds.json").resolve())
+    )
+    index_mock.return_value.sync.assert_called_once_with(
+        mock_gmail_api.build.return_value
+    )
+    mock_gmail_api.list_message.assert_not_called()
+
+
+@pytest.fixture()
+def credentials_filepath(
+    fake_gmail: testing.FakeGmailServer,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> str:
+    mocker.patch("labmail._env.GMAIL_API_ROOT_URL", fake_gmail.root_url)
+    filepath = str(tmp_path / "credentials.json")
+    testing.write_credentials(filepath)
+    return filepath
+
+
+def _add_sent_message(fake_gmail: testing.FakeGmailServer, subject: str) -> None:
+    message = mime_text.MIMEText("body")
+    message["Subject"] = subject
+    fake_gmail.add_message(message)
+
+
+def test_session_subject_index_backfill(
+    credentials_filepath: str,
+    tmp_path: pathlib.Path,
+    fake_gmail: testing.FakeGmailServer,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    for i in range(5):
+        _add_sent_message(fake_gmail, f"old {i}")
+    find_spy = mocker.spy(gmail_api, "find_subjects")
+    mocker.patch.object(cache.SubjectIndex, "BACKFILL_LIMIT", 2)
+    with session.Session(credentials_filepath, cache_dir=tmp_path) as sess:
+        # searched on Gmail until the backfill completes
+        assert sess.find_used_subjects(["old 0", "new"]) == {"old 0"}
+        find_spy.assert_called_once()
+        subject_index = cache.SubjectIndex(
+            tmp_path, str(pathlib.Path(credentials_filepath).resolve())
+        )
+        for _ in range(500):
+            if subject_index.synced_at is not None:
+                break
+            time.sleep(0.01)
+        assert subject_index.synced_at is not None
+        assert sess.find_used_subjects(["old 4", "new"]) == {"old 4"}
+        find_spy.assert_called_once()
+
+
+@pytest.mark.parametrize("interval", [0.0, 300.0])
+def test_session_subject_index_resync(
+    interval: float,
+    credentials_filepath: str,
+    tmp_path: pathlib.Path,
+    fake_gmail: testing.FakeGmailServer,
+) -> None:
+    account = str(pathlib.Path(credentials_filepath).resolve())
+    with session.Session(credentials_filepath, cache_dir=tmp_path) as sess:
+        cache.SubjectIndex(tmp_path, account).sync(sess.rsc)
+    with session.Session(
+        credentials_filepath, cache_dir=tmp_path, subject_sync_interval=interval
+    ) as sess:
+        assert not sess.is_subject_used("other")
+        # sent by the other client
+        _add_sent_message(fake_gmail, "other")
+        assert sess.is_subject_used("other") is (interval == 0)
+
+
+@pytest.mark.parametrize(("size", "num_requests"), [(1024, 1), (10, 2)])
+def test_session_send_lines_requests(
+    size: int,
+    num_requests: int,
+    credentials_filepath: str,
+    fake_gmail: testing.FakeGmailServer,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch.object(session, "STREAMED_BODY_SIZE", size)
+    with session.Session(credentials_filepath) as sess:
+        message = sess.build_message(
+            "foo@example.com", io.StringIO("foo\nbar\n"), "subject"
+        )
+        start = fake_gmail.num_requests
+        gmail_api.send_message(sess.rsc, message=message)
+    # a small body is sent in a single request without the resumable upload
+    assert fake_gmail.num_requests - start == num_requests
+
+
+@pytest.mark.parametrize("name", ["Draft", "Session", "SubjectUsedError"])
+def test_lazy_attributes(name: str) -> None:
+    assert getattr(labmail, name) is getattr(session, name)
+
+
+def test_unknown_attribute() -> None:
+    with pytest.raises(AttributeError):
+        labmail.unknown
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import base64
+import email.mime.text as mime_text
+import io
+import os
+import pathlib
+import time
+import typing as t
+
+import pytest
+import pytest_mock
+from google.oauth2 import credentials
+from googleapiclient import errors
+
+import labmail
+from labmail import gmail_api, testing
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from googleapiclient._apis.gmail.v1 import resources
+
+
+def make_rsc(server: testing.FakeGmailServer) -> resources.GmailResource:
+    creds = credentials.Credentials("token")  # type: ignore[no-untyped-call]
+    return gmail_api.build(creds, root_url=server.root_url)
+
+
+def make_message(subject: str, body: str = "body") -> mime_text.MIMEText:
+    message = mime_text.MIMEText(body)
+    message["To"] = "foo@example.com"
+    message["Subject"] = subject
+    return message
+
+
+def test_send_message(fake_gmail: testing.FakeGmailServer) -> None:
+    rsc = make_rsc(fake_gmail)
+    message = make_message("subject")
+    response = gmail_api.send_message(rsc, message=message)
+    assert response["labelIds"] == ["SENT"]
+    sent = gmail_api.get_message(rsc, id=response["id"], format="raw")
+    assert base64.urlsafe_b64decode(sent["raw"]) == message.as_bytes()
+    full = gmail_api.get_message(rsc, id=response["id"])
+    assert {"name": "Subject", "value": "subject"} in full["payload"]["headers"]
+    assert "raw" not in full
+    assert fake_gmail.num_requests == 3
+
+
+def test_get_message_not_found(fake_gmail: testing.FakeGmailServer) -> None:
+    with pytest.raises(errors.HttpError) as exc_info:
+        gmail_api.get_message(make_rsc(fake_gmail), id="unknown")
+    assert exc_info.value.resp.status == 404
+
+
+def test_list_message(fake_gmail: testing.FakeGmailServer) -> None:
+    now = time.time()
+    for i in range(5):
+        fake_gmail.add_message(make_message(f"Weekly report {i}"), timestamp=now + i)
+    fake_gmail.add_message(make_message("Weekly report"), label_ids=["INBOX"])
+    fake_gmail.add_message(make_message("Other"), timestamp=now - 3600)
+    rsc = make_rsc(fake_gmail)
+    _, _, size = gmail_api.list_message(rsc, query='in:sent subject:("weekly report")')
+    assert size == 5
+    _, _, size = gmail_api.list_message(rsc, query=f"in:sent after:{int(now) - 60}")
+    assert size == 5
+    _, _, size = gmail_api.list_message(
+        rsc,
+        query='in:sent (subject:("report 1") OR subject:("report 3"))'
+        f" after:{int(now) - 60}",
+    )
+    assert size == 2
+    _, _, size = gmail_api.list_message(rsc, query='subject:("report") OR in:inbox')
+    assert size == 6
+    messages = list(gmail_api.iter_messages(rsc, query="in:sent", page_size=2))
+    assert len(messages) == 6
+    subjects = [
+        message["payload"]["headers"][0]["value"]
+        for _, message in gmail_api.get_messages(
+            rsc,
+            ids=[message["id"] for message in messages],
+            format="metadata",
+            metadata_headers=["Subject"],
+        )
+        if not isinstance(message, Exception)
+    ]
+    assert subjects[:2] == ["Weekly report 4", "Weekly report 3"]
+
+
+def test_list_sendas(mocker: pytest_mock.MockerFixture) -> None:
+    sendas: t.Any = [{"sendAsEmail": "foo@example.com", "isDefault": True}]
+    with testing.FakeGmailServer(sendas=sendas) as server:
+        assert gmail_api.list_sendas(make_rsc(server)) == sendas
+
+
+def test_batch(fake_gmail: testing.FakeGmailServer) -> None:
+    rsc = make_rsc(fake_gmail)
+    responses = gmail_api.send_messages(
+        rsc, messages=[make_message(f"subject {i}") for i in range(3)]
+    )
+    assert len(fake_gmail.messages) == 3
+    ids = [
+        response["id"] for response in responses if not isinstance(response, Exception)
+    ]
+    results = dict(gmail_api.get_messages(rsc, ids=[*ids, "unknown"]))
+    assert all(not isinstance(results[id], Exception) for id in ids)
+    assert isinstance(results["unknown"], errors.HttpError)
+
+
+def test_upload_message(fake_gmail: testing.FakeGmailServer) -> None:
+    content = os.urandom(600 * 1024)
+    response = gmail_api.upload_message(
+        make_rsc(fake_gmail), fd=io.BytesIO(content), chunk_size=256 * 1024
+    )
+    raw = fake_gmail.messages[response["id"]]["raw"]
+    assert base64.urlsafe_b64decode(raw) == content
+    assert fake_gmail.num_requests == 4
+
+
+def test_error_rate(mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch("labmail.gmail_api.retry_policy", None)
+    with testing.FakeGmailServer(error_rate=1.0) as server:
+        with pytest.raises(errors.HttpError) as exc_info:
+            gmail_api.list_sendas(make_rsc(server))
+        assert exc_info.value.resp.status == 500
+        assert server.num_errors == 1
+
+
+def test_error_rate_retried(mocker: pytest_mock.MockerFixture) -> None:
+    with testing.FakeGmailServer(error_rate=0.5, seed=0) as server:
+        rsc = make_rsc(server)
+        ids = [
+            server.add_message(make_message(f"subject {i}"))["id"] for i in range(10)
+        ]
+        for id in ids:
+            assert gmail_api.get_message(rsc, id=id)["id"] == id
+        assert server.num_errors > 0
+
+
+def test_error_rate_send_not_retried() -> None:
+    with testing.FakeGmailServer(error_rate=1.0) as server:
+        with pytest.raises(errors.HttpError) as exc_info:
+            gmail_api.send_message(make_rsc(server), message=make_message("subject"))
+        assert exc_info.value.resp.status == 500
+        assert server.num_errors == 1
+
+
+def test_batch_error_rate_retried() -> None:
+    with testing.FakeGmailServer(batch_error_rate=0.5, seed=0) as server:
+        rsc = make_rsc(server)
+        ids = [
+            server.add_message(make_message(f"subject {i}"))["id"] for i in range(10)
+        ]
+        results = dict(gmail_api.get_messages(rsc, ids=ids, batch_size=2))
+        assert all(not isinstance(results[id], Exception) for id in ids)
+        assert server.num_errors > 0
+        assert gmail_api.concurrency.limit < 8.0
+
+
+def test_rate_limit(mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch("labmail.gmail_api.retry_policy", None)
+    with testing.FakeGmailServer(rate_limit=2, retry_after=1) as server:
+        rsc = make_rsc(server)
+        gmail_api.list_sendas(rsc)
+        gmail_api.list_sendas(rsc)
+        with pytest.raises(errors.HttpError) as exc_info:
+            gmail_api.list_sendas(rsc)
+        assert gmail_api.is_rate_limit_error(exc_info.value)
+        assert exc_info.value.resp["retry-after"] == "1"
+        assert server.num_throttled == 1
+
+
+def test_latency() -> None:
+    with testing.FakeGmailServer(latency=0.05) as server:
+        start = time.perf_counter()
+        gmail_api.list_sendas(make_rsc(server))
+        assert time.perf_counter() - start >= 0.05
+
+
+def test_session(
+    fake_gmail: testing.FakeGmailServer,
+    tmp_path: pathlib.Path,
+    mocker: pytest_mock.MockerFixture,
+) -> None:
+    mocker.patch("labmail._env.GMAIL_API_ROOT_URL", fake_gmail.root_url)
+    creds_filepath = tmp_path / "credentials.json"
+    testing.write_credentials(creds_filepath)
+    with labmail.Session(creds_filepath, cache_dir=tmp_path / "cache") as session:
+        session.send("foo@example.com", "body", "subject", disallow_same_subjects=True)
+        with pytest.raises(labmail.SubjectUsedError):
+            session.send(
+                "foo@example.com", "body", "subject", disallow_same_subjects=True
+            )
+    (message,) = fake_gmail.messages.values()
+    assert "Example Lab." in base64.urlsafe_b64decode(message["raw"]).decode()
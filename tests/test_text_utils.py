@@ -1,6 +1,8 @@
 import pathlib
+import typing as t
 
 import pytest
+import pytest_mock
 
 from labmail import text_utils
 from tests import get_testcase_dir
@@ -69,3 +71,78 @@ def test_convert_text_to_html_markdown(filepath: pathlib.Path) -> None:
     html_text = text_utils.convert_text_to_html(text, text_utils.TextType.MARKDOWN)
     assert html_text != ""
     _save_result(filepath, html_text)
+
+
+@pytest.mark.parametrize(
+    "filepath", _list_testcases(text_utils.convert_text_to_html.__name__ + "/*.*")
+)
+def test_html_converter_convert(filepath: pathlib.Path) -> None:
+    with open(filepath, "r") as f:
+        text = f.read()
+    text_type = text_utils.determine_text_type(filepath.name)
+    converter = text_utils.HTMLConverter()
+    for _ in range(2):
+        assert converter.convert(text, text_type) == (
+            text_utils.convert_text_to_html(text, text_type)
+        )
+
+
+def test_html_converter_resets_markdown() -> None:
+    converter = text_utils.HTMLConverter()
+    assert "href" in converter.convert(
+        "[foo]\n\n[foo]: /bar", text_utils.TextType.MARKDOWN
+    )
+    assert "href" not in converter.convert("[foo]", text_utils.TextType.MARKDOWN)
+
+
+def test_html_converter_cache(mocker: pytest_mock.MockerFixture) -> None:
+    converter = text_utils.HTMLConverter(cache_size=2)
+    convert_spy = mocker.spy(text_utils, "convert_text_to_html")
+    for text in ["foo", "bar", "foo", "baz", "bar"]:
+        converter.convert(text, text_utils.TextType.PLAIN)
+    assert [call.args[0] for call in convert_spy.call_args_list] == [
+        "foo",
+        "bar",
+        "baz",
+        "bar",
+    ]
+    converter.clear_cache()
+    converter.convert("bar", text_utils.TextType.PLAIN)
+    assert convert_spy.call_count == 5
+
+
+def test_html_converter_cache_by_text_type() -> None:
+    converter = text_utils.HTMLConverter()
+    assert converter.convert("# foo", text_utils.TextType.MARKDOWN) == "<h1>foo</h1>"
+    assert converter.convert("# foo", text_utils.TextType.PLAIN) == "<p># foo<br></p>"
+
+
+def test_html_converter_no_cache(mocker: pytest_mock.MockerFixture) -> None:
+    converter = text_utils.HTMLConverter(cache_size=0)
+    convert_spy = mocker.spy(text_utils, "convert_text_to_html")
+    for _ in range(2):
+        converter.convert("foo", text_utils.TextType.PLAIN)
+    assert convert_spy.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "filepath", _list_testcases(text_utils.convert_text_to_html.__name__ + "/*.*")
+)
+def test_iter_text_to_html(filepath: pathlib.Path) -> None:
+    with open(filepath, "r") as f:
+        text = f.read()
+    text_type = text_utils.determine_text_type(filepath.name)
+    with open(filepath, "r") as f:
+        assert "".join(text_utils.iter_text_to_html(f, text_type)) == (
+            text_utils.convert_text_to_html(text, text_type)
+        )
+
+
+def test_iter_text_to_html_streams() -> None:
+    def lines() -> t.Iterator[str]:
+        yield "foo\n"
+        yield "\r\n"
+        raise RuntimeError
+
+    chunks = text_utils.iter_text_to_html(lines(), text_utils.TextType.PLAIN)
+    assert [next(chunks) for _ in range(3)] == ["<p>", "foo<br>", "</p><p>"]
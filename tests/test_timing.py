@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+import pytest_mock
+
+from labmail import timing
+
+
+def test_timings() -> None:
+    timings = timing.Timings()
+    timings.add(timing.Phase.RENDER, 0.5)
+    timings.add(timing.Phase.HTTP, 0.25)
+    timings.add(timing.Phase.RENDER, 0.5)
+    assert timings.phases == {timing.Phase.RENDER: 1.0, timing.Phase.HTTP: 0.25}
+    assert timings.total == 1.25
+    assert timings.format().splitlines() == [
+        "render              1000.0 ms",
+        "http                 250.0 ms",
+        "total               1250.0 ms",
+    ]
+
+
+def test_phase(mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch("time.perf_counter", side_effect=[1.0, 1.5, 2.0, 4.0])
+    hook = mocker.Mock()
+    with timing.Timer(hook) as timer:
+        with timing.phase(timing.Phase.AUTH):
+            pass
+        with pytest.raises(ValueError):
+            with timing.phase(timing.Phase.HTTP):
+                raise ValueError
+    assert timer.timings.phases == {timing.Phase.AUTH: 0.5, timing.Phase.HTTP: 2.0}
+    assert hook.call_args_list == [
+        mocker.call(timing.Phase.AUTH, 0.5),
+        mocker.call(timing.Phase.HTTP, 2.0),
+    ]
+
+
+def test_phase_without_timer(mocker: pytest_mock.MockerFixture) -> None:
+    perf_counter_mock = mocker.patch("time.perf_counter")
+    with timing.phase(timing.Phase.AUTH):
+        pass
+    perf_counter_mock.assert_not_called()
+
+
+def test_timer_nested() -> None:
+    with timing.Timer() as outer:
+        with timing.phase(timing.Phase.AUTH):
+            pass
+        with timing.Timer() as inner:
+            with timing.phase(timing.Phase.BUILD):
+                pass
+        with timing.phase(timing.Phase.SENDAS):
+            pass
+    assert list(outer.timings.phases) == [
+        timing.Phase.AUTH,
+        timing.Phase.BUILD,
+        timing.Phase.SENDAS,
+    ]
+    assert list(inner.timings.phases) == [timing.Phase.BUILD]
+
+
+def test_timer_other_threads() -> None:
+    def run() -> None:
+        with timing.phase(timing.Phase.HTTP):
+            pass
+
+    with timing.Timer() as timer:
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+    assert timer.timings.phases == dict()